@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""In-process load test for the Controle de Venda API.
+
+Runs server.app through httpx's ASGI transport against a local mongod
+(MONGO_URL) or, with --mongomock, an in-memory mongomock-motor database.
+Seeds synthetic tenants, drives a weighted mix of scanner/checkout/report
+traffic concurrently and prints p50/p95/p99 latency and throughput per
+endpoint. --save-baseline/--baseline store and compare runs.
+
+    python benchmark.py --mongomock --tenants 5 --products 2000 --requests 5000
+    python benchmark.py --save-baseline bench_baseline.json
+    python benchmark.py --baseline bench_baseline.json --tolerance 0.2
+
+Compare the JSON/compression paths by saving a baseline with one setting
+and running again with the other:
+
+    python benchmark.py --mongomock --only products_page movements_page --save-baseline std.json
+    python benchmark.py --mongomock --only products_page movements_page --fast-json --baseline std.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timezone, timedelta
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "controle_venda_bench")
+
+import httpx  # noqa: E402
+
+import server  # noqa: E402
+
+# (nome, peso) de cada cenário
+SCENARIOS = [
+    ("scan", 50),
+    ("checkout", 15),
+    ("movement", 10),
+    ("summary", 10),
+    ("products_page", 8),
+    ("movements_page", 5),
+    ("timeseries", 2),
+]
+
+class Tenant:
+    def __init__(self, index: int):
+        self.user_id = f"bench_user_{index}"
+        self.session_token = f"bench_session_{index}"
+        self.product_ids = []
+        self.barcodes = []
+
+def use_mongomock():
+    try:
+        from mongomock_motor import AsyncMongoMockClient
+    except ImportError:
+        sys.exit("--mongomock requires the mongomock-motor package (pip install mongomock-motor)")
+    server.client = AsyncMongoMockClient()
+    server.db = server.client[os.environ["DB_NAME"]]
+
+async def seed(tenant_count: int, product_count: int, movement_count: int) -> list:
+    tenants = []
+    now = datetime.now(timezone.utc)
+    for i in range(tenant_count):
+        tenant = Tenant(i)
+        await server.db.users.delete_many({"user_id": tenant.user_id})
+        await server.db.user_sessions.delete_many({"user_id": tenant.user_id})
+        await server.db.products.delete_many({"user_id": tenant.user_id})
+        await server.db.stock_movements.delete_many({"user_id": tenant.user_id})
+        await server.db.report_rollups.delete_many({"user_id": tenant.user_id})
+        await server.db.sales_buckets.delete_many({"user_id": tenant.user_id})
+
+        await server.db.users.insert_one({
+            "user_id": tenant.user_id,
+            "email": f"{tenant.user_id}@bench.local",
+            "name": f"Bench {i}",
+            "created_at": now
+        })
+        await server.db.user_sessions.insert_one({
+            "user_id": tenant.user_id,
+            "session_token": tenant.session_token,
+            "expires_at": now + timedelta(days=1),
+            "created_at": now
+        })
+
+        products = []
+        for p in range(product_count):
+            product_id = f"prod_{uuid.uuid4().hex[:12]}"
+            barcode = f"{i:03d}{p:09d}"
+            colors = [{"color": "preto", "quantity": 500000}, {"color": "branco", "quantity": 500000}]
+            products.append({
+                "product_id": product_id,
+                "name": f"Produto {p}",
+                "barcode": barcode,
+                "current_stock": 1000000,
+                "purchase_price": round(random.uniform(10, 500), 2),
+                "sale_price": round(random.uniform(510, 1000), 2),
+                "currency": "MZN",
+                "image": None,
+                "colors": colors,
+                "created_at": now - timedelta(seconds=product_count - p),
+                "user_id": tenant.user_id
+            })
+            tenant.product_ids.append(product_id)
+            tenant.barcodes.append(barcode)
+        for start in range(0, len(products), 1000):
+            await server.db.products.insert_many(products[start:start + 1000])
+
+        movements = []
+        for m in range(movement_count):
+            movements.append({
+                "movement_id": f"mov_{uuid.uuid4().hex[:12]}",
+                "product_id": random.choice(tenant.product_ids),
+                "type": random.choice(["entrada", "saida"]),
+                "quantity": random.randint(1, 5),
+                "color": random.choice(["preto", "branco"]),
+                "date": now - timedelta(minutes=movement_count - m),
+                "note": None,
+                "user_id": tenant.user_id
+            })
+            if len(movements) >= 1000:
+                await server.db.stock_movements.insert_many(movements)
+                movements = []
+        if movements:
+            await server.db.stock_movements.insert_many(movements)
+
+        await server.rebuild_rollup(tenant.user_id)
+        tenants.append(tenant)
+    return tenants
+
+def build_request(scenario: str, tenant: Tenant):
+    if scenario == "scan":
+        return "GET", f"/api/products/barcode/{random.choice(tenant.barcodes)}", None, "GET /products/barcode/{barcode}"
+    if scenario == "checkout":
+        items = [
+            {"product_id": random.choice(tenant.product_ids), "type": "saida",
+             "quantity": 1, "color": random.choice(["preto", "branco"])}
+            for _ in range(random.randint(2, 6))
+        ]
+        return "POST", "/api/movements/batch", {"items": items}, "POST /movements/batch"
+    if scenario == "movement":
+        body = {"product_id": random.choice(tenant.product_ids), "type": random.choice(["entrada", "saida"]),
+                "quantity": 1, "color": random.choice(["preto", "branco"])}
+        return "POST", "/api/movements", body, "POST /movements"
+    if scenario == "summary":
+        return "GET", "/api/reports/summary", None, "GET /reports/summary"
+    if scenario == "products_page":
+        return "GET", "/api/products?view=summary&limit=100", None, "GET /products?view=summary"
+    if scenario == "movements_page":
+        return "GET", "/api/movements?limit=100", None, "GET /movements"
+    return "GET", "/api/reports/timeseries?granularity=day", None, "GET /reports/timeseries"
+
+def percentile(sorted_values: list, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+async def run_load(tenants: list, total_requests: int, concurrency: int, skip: set,
+                   accept_encoding: str = "identity") -> dict:
+    scenarios = [(name, weight) for name, weight in SCENARIOS if name not in skip]
+    names = [name for name, _ in scenarios]
+    weights = [weight for _, weight in scenarios]
+    latencies, errors, failures = {}, {}, {}
+    remaining = [total_requests]
+
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as http_client:
+        async def worker():
+            while remaining[0] > 0:
+                remaining[0] -= 1
+                tenant = random.choice(tenants)
+                method, url, body, label = build_request(random.choices(names, weights)[0], tenant)
+                started = time.perf_counter()
+                try:
+                    res = await http_client.request(
+                        method, url, json=body,
+                        headers={"Authorization": f"Bearer {tenant.session_token}", "Accept-Encoding": accept_encoding}
+                    )
+                    failed = res.status_code >= 400
+                except Exception as e:
+                    # Ex.: operadores que o mongomock não implementa ($dateTrunc); conta como erro e segue
+                    if label not in failures:
+                        failures[label] = f"{type(e).__name__}: {e}"
+                    failed = True
+                latencies.setdefault(label, []).append((time.perf_counter() - started) * 1000)
+                if failed:
+                    errors[label] = errors.get(label, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    results = {}
+    for label, values in sorted(latencies.items()):
+        values.sort()
+        results[label] = {
+            "requests": len(values),
+            "errors": errors.get(label, 0),
+            "throughput_rps": len(values) / elapsed,
+            "p50_ms": percentile(values, 50),
+            "p95_ms": percentile(values, 95),
+            "p99_ms": percentile(values, 99),
+        }
+    return {"elapsed_seconds": elapsed, "total_rps": total_requests / elapsed, "endpoints": results, "failures": failures}
+
+def print_results(report: dict):
+    print(f"\n{'endpoint':34} {'reqs':>6} {'err':>5} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for label, r in report["endpoints"].items():
+        print(f"{label:34} {r['requests']:6d} {r['errors']:5d} {r['throughput_rps']:8.1f} "
+              f"{r['p50_ms']:8.2f} {r['p95_ms']:8.2f} {r['p99_ms']:8.2f}")
+    for label, error in report.get("failures", {}).items():
+        print(f"{label}: requests raised {error}")
+    print(f"\ntotal: {report['total_rps']:.1f} req/s over {report['elapsed_seconds']:.2f}s")
+
+def compare_baseline(report: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for label, current in report["endpoints"].items():
+        previous = baseline.get("endpoints", {}).get(label)
+        if not previous:
+            continue
+        for metric in ("p95_ms", "p99_ms"):
+            if current[metric] > previous[metric] * (1 + tolerance):
+                regressions.append(f"{label} {metric}: {previous[metric]:.2f} -> {current[metric]:.2f}")
+        if current["throughput_rps"] < previous["throughput_rps"] * (1 - tolerance):
+            regressions.append(
+                f"{label} throughput: {previous['throughput_rps']:.1f} -> {current['throughput_rps']:.1f} rps"
+            )
+    return regressions
+
+async def main(args) -> int:
+    random.seed(args.seed)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    if args.mongomock:
+        use_mongomock()
+    server.FAST_JSON_ENABLED = args.fast_json
+    skip = set(args.skip)
+    if args.only:
+        skip |= {name for name, _ in SCENARIOS if name not in args.only}
+    async with server.lifespan(server.app):
+        print(f"Seeding {args.tenants} tenants x {args.products} products / {args.movements} movements...")
+        tenants = await seed(args.tenants, args.products, args.movements)
+        if args.warmup:
+            await run_load(tenants, args.warmup, args.concurrency, skip, args.accept_encoding)
+        report = await run_load(tenants, args.requests, args.concurrency, skip, args.accept_encoding)
+    report["config"] = {k: v for k, v in vars(args).items() if k not in ("baseline", "save_baseline")}
+    print_results(report)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"baseline saved to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_baseline(report, json.load(f), args.tolerance)
+        if regressions:
+            print("\nREGRESSIONS:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print(f"\nno regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Controle de Venda API benchmark")
+    parser.add_argument("--mongomock", action="store_true", help="Use an in-memory mongomock-motor database")
+    parser.add_argument("--tenants", type=int, default=3)
+    parser.add_argument("--products", type=int, default=1000, help="Products per tenant")
+    parser.add_argument("--movements", type=int, default=5000, help="Seeded movements per tenant")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--warmup", type=int, default=200, help="Requests sent before measuring")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--skip", nargs="*", default=[], choices=[name for name, _ in SCENARIOS])
+    parser.add_argument("--only", nargs="*", default=[], choices=[name for name, _ in SCENARIOS])
+    parser.add_argument("--fast-json", action="store_true", help="Use the orjson list response path")
+    parser.add_argument("--accept-encoding", default="identity", help="e.g. gzip, br")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--save-baseline", metavar="PATH")
+    parser.add_argument("--baseline", metavar="PATH")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression")
+    sys.exit(asyncio.run(main(parser.parse_args())))
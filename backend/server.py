@@ -1,28 +1,239 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Request, Response, Cookie
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, APIRouter, HTTPException, Request, Response, Cookie, Query, UploadFile, File
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
+from fastapi.routing import APIRoute
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from starlette.datastructures import Headers, MutableHeaders
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from gridfs.errors import FileExists, NoFile
+from pymongo import ASCENDING, DESCENDING, ReturnDocument, UpdateMany, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from bson import ObjectId
+from bson.errors import InvalidId
 import os
+import sys
+import time
+import contextvars
+import threading
+import asyncio
 import logging
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict, field_validator
+from pydantic import BaseModel, Field, ConfigDict, ValidationError, field_validator
 from typing import List, Optional
 import uuid
+import unicodedata
+import zlib
+from decimal import Decimal, ROUND_CEILING, ROUND_FLOOR, ROUND_HALF_UP
 from datetime import datetime, timezone, timedelta
+import argparse
+import random
+import re
+import base64
+import binascii
+import csv
+import hashlib
+import hmac
+import io
+import itertools
+import json
 import httpx
+import functools
+import numpy as np
 import bcrypt
+from PIL import Image, UnidentifiedImageError
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# ====== Instrumentation ======
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', '500'))
+SERVER_TIMING_ENABLED = os.environ.get('SERVER_TIMING_ENABLED', '1') == '1'
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+class RequestMetrics:
+    __slots__ = ("db_calls", "db_seconds", "upstream_calls", "upstream_seconds", "serialize_seconds",
+                 "endpoint_finished", "query_shapes", "lock")
+
+    def __init__(self):
+        self.db_calls = 0
+        self.db_seconds = 0.0
+        self.upstream_calls = 0
+        self.upstream_seconds = 0.0
+        self.serialize_seconds = 0.0
+        self.endpoint_finished = None
+        self.query_shapes = []
+        # Os eventos do Motor chegam das threads do executor
+        self.lock = threading.Lock()
+
+current_request_metrics: contextvars.ContextVar[Optional[RequestMetrics]] = contextvars.ContextVar(
+    "current_request_metrics", default=None
+)
+
+class Histogram:
+    def __init__(self, buckets: List[float]):
+        self.buckets = buckets
+        self.series = {}  # labels -> [contagens por bucket..., soma, total]
+        self.lock = threading.Lock()
+
+    def observe(self, labels: tuple, value: float):
+        with self.lock:
+            series = self.series.setdefault(labels, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self, name: str, label_names: tuple) -> List[str]:
+        lines = [f"# TYPE {name} histogram"]
+        with self.lock:
+            items = list(self.series.items())
+        for labels, series in items:
+            base = ",".join(f'{k}="{v}"' for k, v in zip(label_names, labels))
+            for bound, count in zip(self.buckets, series):
+                lines.append(f'{name}_bucket{{{base},le="{bound}"}} {count}')
+            lines.append(f'{name}_bucket{{{base},le="+Inf"}} {series[-1]}')
+            lines.append(f"{name}_sum{{{base}}} {series[-2]}")
+            lines.append(f"{name}_count{{{base}}} {series[-1]}")
+        return lines
+
+class Counter:
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, labels: tuple, value: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+    def render(self, name: str, label_names: tuple) -> List[str]:
+        lines = [f"# TYPE {name} counter"]
+        with self.lock:
+            items = list(self.values.items())
+        for labels, value in items:
+            base = ",".join(f'{k}="{v}"' for k, v in zip(label_names, labels))
+            lines.append(f"{name}{{{base}}} {value}")
+        return lines
+
+request_latency = Histogram(LATENCY_BUCKETS)
+request_db_calls = Counter()
+request_db_seconds = Counter()
+request_upstream_seconds = Counter()
+request_serialize_seconds = Counter()
+mongo_command_latency = Histogram(LATENCY_BUCKETS)
+
+def query_shape(value):
+    # Estrutura da consulta sem os valores, para logs e métricas
+    if isinstance(value, dict):
+        return {k: query_shape(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [query_shape(value[0])] if value else []
+    return "?"
+
+def command_shape(command_name: str, command: dict) -> str:
+    collection = command.get(command_name)
+    target = command.get("filter", command.get("query"))
+    if target is None and command.get("pipeline"):
+        target = command["pipeline"][0]
+    if target is None and command.get("updates"):
+        target = command["updates"][0].get("q")
+    if target is None and command.get("deletes"):
+        target = command["deletes"][0].get("q")
+    shape = json.dumps(query_shape(target), default=str) if target is not None else ""
+    return f"{command_name} {collection} {shape}"[:300]
+
+class MongoCommandListener(monitoring.CommandListener):
+    def __init__(self):
+        self._pending = {}
+
+    def started(self, event):
+        metrics = current_request_metrics.get()
+        shape = command_shape(event.command_name, event.command) if metrics is not None else None
+        self._pending[(event.request_id, event.connection_id)] = (metrics, shape)
+
+    def _finish(self, event):
+        metrics, shape = self._pending.pop((event.request_id, event.connection_id), (None, None))
+        seconds = event.duration_micros / 1e6
+        mongo_command_latency.observe((event.command_name,), seconds)
+        if metrics is not None:
+            with metrics.lock:
+                metrics.db_calls += 1
+                metrics.db_seconds += seconds
+                metrics.query_shapes.append(shape)
+
+    def succeeded(self, event):
+        self._finish(event)
+
+    def failed(self, event):
+        self._finish(event)
+
+mongo_command_listener = MongoCommandListener()
+
+class TimedRoute(APIRoute):
+    """Rota que mede a validação/serialização do response_model (Pydantic): o tempo entre
+    o fim do endpoint e a resposta pronta."""
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        if asyncio.iscoroutinefunction(endpoint):
+            endpoint = self._timed_endpoint(endpoint)
+        super().__init__(path, endpoint, **kwargs)
+
+    @staticmethod
+    def _timed_endpoint(endpoint):
+        @functools.wraps(endpoint)
+        async def timed(*args, **kwargs):
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                metrics = current_request_metrics.get()
+                if metrics is not None:
+                    metrics.endpoint_finished = time.perf_counter()
+        return timed
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def timed_handler(request: Request) -> Response:
+            response = await handler(request)
+            metrics = current_request_metrics.get()
+            if metrics is not None and metrics.endpoint_finished is not None:
+                metrics.serialize_seconds += time.perf_counter() - metrics.endpoint_finished
+                metrics.endpoint_finished = None
+            return response
+        return timed_handler
+
+def render_metrics() -> str:
+    lines = []
+    lines += request_latency.render("http_request_duration_seconds", ("method", "route", "status"))
+    lines += request_db_calls.render("http_request_db_roundtrips_total", ("method", "route"))
+    lines += request_db_seconds.render("http_request_db_seconds_total", ("method", "route"))
+    lines += request_upstream_seconds.render("http_request_upstream_seconds_total", ("method", "route"))
+    lines += request_serialize_seconds.render("http_request_serialize_seconds_total", ("method", "route"))
+    lines += mongo_command_latency.render("mongo_command_duration_seconds", ("command",))
+    return "\n".join(lines) + "\n"
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[mongo_command_listener])
 db = client[os.environ['DB_NAME']]
 
-app = FastAPI(title="Controle de Venda API")
-api_router = APIRouter(prefix="/api")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await startup_tasks()
+    yield
+    await shutdown_tasks()
+
+app = FastAPI(title="Controle de Venda API", lifespan=lifespan)
+api_router = APIRouter(prefix="/api", route_class=TimedRoute)
 
 # ====== Models ======
 class User(BaseModel):
@@ -36,6 +247,7 @@ class User(BaseModel):
 class ColorVariant(BaseModel):
     color: str
     quantity: int = 0
+    reorder_threshold: Optional[int] = Field(None, ge=0)  # alerta de stock baixo desta cor
 
 class Product(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -47,10 +259,22 @@ class Product(BaseModel):
     sale_price: float
     currency: str = "MZN"
     image: Optional[str] = None
+    thumbnail: Optional[str] = None
     colors: List[ColorVariant] = []  # Lista de cores e quantidades
+    reorder_threshold: Optional[int] = None  # None: LOW_STOCK_THRESHOLD
     created_at: datetime
     user_id: str
 
+class ProductSummary(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    product_id: str
+    name: str
+    barcode: str
+    current_stock: int = 0
+    purchase_price: float
+    sale_price: float
+    currency: str = "MZN"
+
 class ProductCreate(BaseModel):
     name: str = Field(..., min_length=1)
     barcode: str = Field(..., min_length=1)
@@ -59,6 +283,59 @@ class ProductCreate(BaseModel):
     currency: str = "MZN"
     image: Optional[str] = None
     colors: List[ColorVariant] = []
+    reorder_threshold: Optional[int] = Field(None, ge=0)
+
+class ColorDelta(BaseModel):
+    color: str
+    delta: int
+
+class ProductPatch(BaseModel):
+    # Só os campos enviados são alterados; color_deltas soma/subtrai stock a cores existentes
+    name: Optional[str] = Field(None, min_length=1)
+    barcode: Optional[str] = Field(None, min_length=1)
+    purchase_price: Optional[float] = Field(None, gt=0)
+    sale_price: Optional[float] = Field(None, gt=0)
+    currency: Optional[str] = None
+    image: Optional[str] = None
+    colors: Optional[List[ColorVariant]] = None
+    color_deltas: List[ColorDelta] = Field([], max_length=100)
+    reorder_threshold: Optional[int] = Field(None, ge=0)
+
+    @field_validator('name', 'barcode', 'purchase_price', 'sale_price', 'currency', 'colors')
+    def not_null(cls, v):
+        if v is None:
+            raise ValueError('Field cannot be null')
+        return v
+
+class RepriceFilter(BaseModel):
+    barcode_prefix: Optional[str] = None
+    name: Optional[str] = None
+    currency: Optional[str] = None
+    min_stock: Optional[int] = None
+    max_stock: Optional[int] = None
+    product_ids: Optional[List[str]] = Field(None, max_length=5000)
+
+class RepriceRequest(BaseModel):
+    mode: str  # margin ou markup, sobre o preço de compra
+    value: float = Field(..., ge=0)
+    round_to: Optional[float] = Field(None, gt=0)  # ex.: 1, 5, 0.5
+    round_mode: str = "nearest"
+    target_currency: Optional[str] = None
+    filters: RepriceFilter = RepriceFilter()
+    dry_run: bool = True
+    format: str = Field("ndjson", pattern="^(csv|ndjson)$")
+
+    @field_validator('mode')
+    def validate_mode(cls, v):
+        if v not in ['margin', 'markup']:
+            raise ValueError('Mode must be margin or markup')
+        return v
+
+    @field_validator('round_mode')
+    def validate_round_mode(cls, v):
+        if v not in ['nearest', 'up', 'down']:
+            raise ValueError('Round mode must be nearest, up or down')
+        return v
 
 class StockMovement(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -69,55 +346,2542 @@ class StockMovement(BaseModel):
     color: Optional[str] = None  # Cor específica (se aplicável)
     date: datetime
     note: Optional[str] = None
+    unit_cost: Optional[float] = None  # Custo unitário da entrada
+    unit_price: Optional[float] = None  # Preço unitário da saída
     user_id: str
 
-class MovementCreate(BaseModel):
-    product_id: str
-    type: str
-    quantity: int = Field(..., gt=0)
-    color: Optional[str] = None
-    note: Optional[str] = None
+class MovementCreate(BaseModel):
+    product_id: str
+    type: str
+    quantity: int = Field(..., gt=0)
+    color: Optional[str] = None
+    note: Optional[str] = None
+    # Por omissão, o preço de compra (entradas) ou de venda (saídas) do produto
+    unit_cost: Optional[float] = Field(None, ge=0)
+    unit_price: Optional[float] = Field(None, ge=0)
+
+    @field_validator('type')
+    def validate_type(cls, v):
+        if v not in ['entrada', 'saida']:
+            raise ValueError('Type must be entrada or saida')
+        return v
+
+class MovementBatchCreate(BaseModel):
+    items: List[MovementCreate] = Field(..., min_length=1, max_length=500)
+
+class SyncMovement(MovementCreate):
+    # Gerado no dispositivo: reenviar o mesmo movimento não o aplica duas vezes
+    movement_id: str = Field(..., pattern=r"^[A-Za-z0-9_-]{8,64}$")
+    date: Optional[datetime] = None
+
+class SyncPush(BaseModel):
+    since: Optional[str] = None
+    movements: List[SyncMovement] = Field([], max_length=500)
+
+class ConversionRequest(BaseModel):
+    amount: float
+    from_currency: str
+    to_currency: str
+
+# ====== Indexes ======
+ENSURE_INDEXES = os.environ.get('ENSURE_INDEXES', '1') == '1'
+SYNC_TOMBSTONE_DAYS = int(os.environ.get('SYNC_TOMBSTONE_DAYS', '30'))
+
+# (coleção, chaves, opções) para cada forma de consulta usada pela API
+INDEXES = [
+    ("users", [("user_id", ASCENDING)], {"name": "user_id_unique", "unique": True}),
+    ("users", [("email", ASCENDING)], {"name": "email_unique", "unique": True}),
+    ("user_sessions", [("session_token", ASCENDING)], {"name": "session_token_unique", "unique": True}),
+    ("user_sessions", [("expires_at", ASCENDING)], {"name": "expires_at_ttl", "expireAfterSeconds": 0}),
+    ("session_invalidations", [("created_at", ASCENDING)], {"name": "created_at_ttl", "expireAfterSeconds": 3600}),
+    ("products", [("user_id", ASCENDING), ("product_id", ASCENDING)], {"name": "user_product_unique", "unique": True}),
+    ("products", [("user_id", ASCENDING), ("barcode", ASCENDING)], {"name": "user_barcode_unique", "unique": True}),
+    # Só os produtos com stock baixo entram no índice, já pela ordem do relatório
+    ("products", [("user_id", ASCENDING), ("low_stock_severity", ASCENDING), ("current_stock", ASCENDING), ("product_id", ASCENDING)],
+     {"name": "user_low_stock", "partialFilterExpression": {"low_stock_severity": {"$exists": True}}}),
+    ("stock_movements", [("user_id", ASCENDING), ("movement_id", ASCENDING)], {"name": "user_movement_unique", "unique": True}),
+    ("products", [("user_id", ASCENDING), ("created_at", ASCENDING), ("product_id", ASCENDING)], {"name": "user_created_id"}),
+    ("stock_movements", [("user_id", ASCENDING), ("date", DESCENDING), ("movement_id", DESCENDING)], {"name": "user_date_id"}),
+    ("stock_movements", [("user_id", ASCENDING), ("product_id", ASCENDING), ("date", DESCENDING), ("movement_id", DESCENDING)], {"name": "user_product_date_id"}),
+    ("rates_cache", [("cache_key", ASCENDING)], {"name": "cache_key_unique", "unique": True}),
+    ("report_rollups", [("user_id", ASCENDING)], {"name": "user_id_unique", "unique": True}),
+    ("images", [("image_id", ASCENDING)], {"name": "image_id_unique", "unique": True}),
+    ("sales_buckets", [("user_id", ASCENDING), ("product_id", ASCENDING), ("color", ASCENDING), ("hour", ASCENDING)], {"name": "bucket_key_unique", "unique": True}),
+    ("sales_buckets", [("user_id", ASCENDING), ("hour", ASCENDING)], {"name": "user_hour"}),
+    # Páginas de sync por (change_seq, _id): muitos documentos podem partilhar a mesma sequência
+    ("products", [("user_id", ASCENDING), ("change_seq", ASCENDING), ("_id", ASCENDING)], {"name": "user_change_seq_id"}),
+    ("stock_movements", [("user_id", ASCENDING), ("change_seq", ASCENDING), ("_id", ASCENDING)], {"name": "user_change_seq_id"}),
+    ("deleted_products", [("user_id", ASCENDING), ("change_seq", ASCENDING), ("_id", ASCENDING)], {"name": "user_change_seq_id"}),
+    ("deleted_products", [("deleted_at", ASCENDING)], {"name": "deleted_at_ttl", "expireAfterSeconds": SYNC_TOMBSTONE_DAYS * 86400}),
+    ("movement_claims", [("user_id", ASCENDING), ("movement_id", ASCENDING)], {"name": "user_movement_unique", "unique": True}),
+    ("movement_claims", [("claimed_at", ASCENDING)], {"name": "claimed_at_ttl", "expireAfterSeconds": 86400}),
+    ("products", [("user_id", ASCENDING), ("search_keys", ASCENDING), ("name_key", ASCENDING), ("product_id", ASCENDING)], {"name": "user_search_keys"}),
+    ("products", [("user_id", ASCENDING), ("name", "text")], {"name": "user_name_text", "default_language": "portuguese"}),
+    ("valuation_checkpoints", [("user_id", ASCENDING), ("method", ASCENDING), ("product_id", ASCENDING), ("at", DESCENDING)], {"name": "checkpoint_key_unique", "unique": True}),
+]
+
+# Índices substituídos ou sem consultas: removidos para deixarem de impor a regra antiga
+# ou de custar uma escrita a cada alteração
+OBSOLETE_INDEXES = [
+    # ids de movimento escolhidos pelo cliente são únicos por utilizador, não globalmente
+    ("stock_movements", "movement_id_unique"),
+    ("movement_claims", "movement_id_unique"),
+    ("products", "user_stock"),  # o stock baixo passou a usar user_low_stock
+    # substituídos pelos user_change_seq_id
+    ("products", "user_change_seq"),
+    ("stock_movements", "user_change_seq"),
+    ("deleted_products", "user_change_seq"),
+]
+
+# Consultas representativas verificadas pelo relatório de índices
+QUERY_SHAPES = [
+    ("get_current_user: session", "user_sessions", {"session_token": "x"}, None),
+    ("get_current_user: user", "users", {"user_id": "x"}, None),
+    ("create_session: user by email", "users", {"email": "x"}, None),
+    ("get_products", "products", {"user_id": "x"}, {"created_at": 1, "product_id": 1}),
+    ("get_product", "products", {"product_id": "x", "user_id": "x"}, None),
+    ("get_product_by_barcode", "products", {"barcode": "x", "user_id": "x"}, None),
+    ("low_stock_page", "products", {"user_id": "x", "low_stock_severity": {"$exists": True}}, {"low_stock_severity": 1, "current_stock": 1, "product_id": 1}),
+    ("get_movements", "stock_movements", {"user_id": "x"}, {"date": -1, "movement_id": -1}),
+    ("get_movements: product", "stock_movements", {"user_id": "x", "product_id": "x"}, {"date": -1, "movement_id": -1}),
+    ("value_inventory: movements", "stock_movements", {"user_id": "x", "product_id": {"$in": ["x"]}, "date": {"$lt": "x"}}, {"product_id": -1, "date": 1, "movement_id": 1}),
+    ("convert_currency: cache", "rates_cache", {"cache_key": "x"}, None),
+    ("search_products: prefix", "products", {"user_id": "x", "search_keys": {"$all": ["x"]}}, {"name_key": 1, "product_id": 1}),
+]
+
+async def ensure_indexes() -> List[dict]:
+    results = []
+    for collection, name in OBSOLETE_INDEXES:
+        if name in await db[collection].index_information():
+            await db[collection].drop_index(name)
+            results.append({"collection": collection, "index": name, "status": "dropped"})
+    for collection, keys, options in INDEXES:
+        try:
+            await db[collection].create_index(keys, **options)
+            results.append({"collection": collection, "index": options["name"], "status": "ok"})
+        except OperationFailure as e:
+            # Ex.: códigos de barras duplicados já existentes impedem o índice único
+            logger.warning(f"Could not create index {collection}.{options['name']}: {e}")
+            results.append({"collection": collection, "index": options["name"], "status": "failed", "error": str(e)})
+    return results
+
+def _plan_stages(plan: dict) -> List[str]:
+    stages = [plan.get("stage", "")]
+    if "inputStage" in plan:
+        stages += _plan_stages(plan["inputStage"])
+    for child in plan.get("inputStages", []):
+        stages += _plan_stages(child)
+    return stages
+
+async def index_status() -> dict:
+    existing = {}
+    for collection in sorted({c for c, _, _ in INDEXES}):
+        info = await db[collection].index_information()
+        existing[collection] = sorted(info.keys())
+    missing = [
+        f"{collection}.{options['name']}"
+        for collection, _, options in INDEXES
+        if options["name"] not in existing.get(collection, [])
+    ]
+    return {"indexes": existing, "missing_indexes": missing}
+
+async def index_report() -> dict:
+    # Corre explain para cada forma de consulta: só pela CLI (index-report)
+    queries = []
+    for name, collection, query_filter, sort in QUERY_SHAPES:
+        command = {"find": collection, "filter": query_filter}
+        if sort:
+            command["sort"] = sort
+        entry = {"query": name, "collection": collection}
+        try:
+            explain = await db.command({"explain": command, "verbosity": "queryPlanner"})
+            stages = _plan_stages(explain["queryPlanner"]["winningPlan"])
+            entry["covered"] = "COLLSCAN" not in stages and "IXSCAN" in stages
+            entry["in_memory_sort"] = "SORT" in stages
+            entry["stages"] = stages
+        except Exception as e:
+            entry["covered"] = None
+            entry["error"] = str(e)
+        queries.append(entry)
+    
+    return {
+        **await index_status(),
+        "queries": queries,
+        "all_covered": all(q.get("covered") for q in queries),
+    }
+
+# ====== Session Cache ======
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', '10000'))
+SESSION_CACHE_TTL = float(os.environ.get('SESSION_CACHE_TTL', '60'))
+# "mongo" activa a invalidação entre workers através da coleção session_invalidations
+SESSION_INVALIDATION_CHANNEL = os.environ.get('SESSION_INVALIDATION_CHANNEL', '')
+SESSION_INVALIDATION_POLL_SECONDS = float(os.environ.get('SESSION_INVALIDATION_POLL_SECONDS', '2'))
+
+# LRU de session_token -> User, limitado em tamanho e pela expiração da sessão
+class SessionCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, session_token: str) -> Optional[User]:
+        entry = self._entries.get(session_token)
+        if entry is None:
+            self.misses += 1
+            return None
+        user, deadline = entry
+        if deadline <= time.monotonic():
+            del self._entries[session_token]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(session_token)
+        self.hits += 1
+        return user
+
+    def put(self, session_token: str, user: User, expires_at: datetime):
+        if self.maxsize <= 0:
+            return
+        remaining = (expires_at - datetime.now(timezone.utc)).total_seconds()
+        if remaining <= 0:
+            return
+        self._entries[session_token] = (user, time.monotonic() + min(self.ttl, remaining))
+        self._entries.move_to_end(session_token)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, session_token: str):
+        if self._entries.pop(session_token, None) is not None:
+            self.invalidations += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+session_cache = SessionCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+
+async def revoke_session(session_token: str):
+    session_cache.invalidate(session_token)
+    if SESSION_INVALIDATION_CHANNEL == "mongo":
+        await db.session_invalidations.insert_one({
+            "session_token": session_token,
+            "created_at": datetime.now(timezone.utc)
+        })
+
+async def poll_session_invalidations():
+    # Aplica os logouts feitos noutros workers ao cache local
+    last_seen = datetime.now(timezone.utc)
+    while True:
+        try:
+            cursor = db.session_invalidations.find(
+                {"created_at": {"$gt": last_seen}}, {"_id": 0}
+            ).sort("created_at", 1)
+            async for doc in cursor:
+                session_cache.invalidate(doc["session_token"])
+                created_at = doc["created_at"]
+                if created_at.tzinfo is None:
+                    created_at = created_at.replace(tzinfo=timezone.utc)
+                last_seen = created_at
+        except Exception as e:
+            logger.warning(f"Session invalidation poll failed: {e}")
+        await asyncio.sleep(SESSION_INVALIDATION_POLL_SECONDS)
+
+# ====== Auth Helper ======
+def get_session_token(request: Request) -> Optional[str]:
+    session_token = request.cookies.get("session_token")
+    if not session_token:
+        auth_header = request.headers.get("Authorization")
+        if auth_header and auth_header.startswith("Bearer "):
+            session_token = auth_header.replace("Bearer ", "")
+    return session_token
+
+async def get_current_user(request: Request) -> User:
+    # REMINDER: DO NOT HARDCODE THE URL, OR ADD ANY FALLBACKS OR REDIRECT URLS, THIS BREAKS THE AUTH
+    session_token = get_session_token(request)
+    
+    if not session_token:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    cached_user = session_cache.get(session_token)
+    if cached_user is not None:
+        return cached_user
+    
+    session = await db.user_sessions.find_one({"session_token": session_token}, {"_id": 0})
+    if not session:
+        raise HTTPException(status_code=401, detail="Invalid session")
+    
+    expires_at = session["expires_at"]
+    if isinstance(expires_at, str):
+        expires_at = datetime.fromisoformat(expires_at)
+    if expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=timezone.utc)
+    if expires_at < datetime.now(timezone.utc):
+        raise HTTPException(status_code=401, detail="Session expired")
+    
+    user_doc = await db.users.find_one({"user_id": session["user_id"]}, {"_id": 0})
+    if not user_doc:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    user = User(**user_doc)
+    session_cache.put(session_token, user, expires_at)
+    return user
+
+# ====== Report Rollups ======
+LOW_STOCK_THRESHOLD = int(os.environ.get('LOW_STOCK_THRESHOLD', '10'))
+ROLLUP_PRODUCT_FIELDS = {
+    "_id": 0, "product_id": 1, "current_stock": 1, "purchase_price": 1, "sale_price": 1, "reorder_threshold": 1
+}
+LOW_STOCK_FIELDS = {
+    "_id": 0, "product_id": 1, "current_stock": 1, "reorder_threshold": 1, "colors": 1, "change_seq": 1, "low_stock_severity": 1
+}
+# Campos devolvidos pelas escritas de stock: rollup, stock baixo e o necessário para o índice de códigos de barras
+STOCK_RESULT_FIELDS = {**ROLLUP_PRODUCT_FIELDS, **LOW_STOCK_FIELDS}
+ROLLUP_FIELDS = ["products_count", "total_stock_value", "total_potential_revenue", "total_entries", "total_exits"]
+# Rollups construídos com outro esquema são reconstruídos na próxima leitura do resumo
+ROLLUP_SCHEMA = 2
+# Tentativas de gravar uma reconstrução enquanto outras escritas incrementam o rollup
+ROLLUP_REBUILD_ATTEMPTS = int(os.environ.get('ROLLUP_REBUILD_ATTEMPTS', '5'))
+
+def low_stock_severity(product: dict) -> Optional[float]:
+    # Abaixo do limiar do produto (ou do global) ou de alguma cor com limiar próprio:
+    # severidade = menor stock / limiar (0 = esgotado); None se nada estiver abaixo
+    threshold = product.get("reorder_threshold")
+    levels = [(product.get("current_stock", 0), LOW_STOCK_THRESHOLD if threshold is None else threshold)]
+    levels += [
+        (c.get("quantity", 0), c["reorder_threshold"])
+        for c in product.get("colors") or [] if c.get("reorder_threshold") is not None
+    ]
+    if not any(quantity < limit for quantity, limit in levels):
+        return None
+    return min(quantity / max(limit, 1) for quantity, limit in levels)
+
+def set_low_stock(update: dict, product: dict) -> dict:
+    # Acrescenta a uma actualização com $set a severidade do estado final do produto
+    severity = low_stock_severity(product)
+    if severity is None:
+        update.setdefault("$unset", {})["low_stock_severity"] = ""
+    else:
+        update["$set"]["low_stock_severity"] = severity
+    return update
+
+async def update_low_stock(user_id: str, products) -> int:
+    # Acerta a severidade depois de uma escrita que não a pôde calcular (ex.: $inc de stock).
+    # O filtro pela change_seq lida faz uma escrita posterior ganhar: é ela que acerta o produto
+    ops = []
+    for product in products:
+        severity = low_stock_severity(product)
+        if severity == product.get("low_stock_severity"):
+            continue
+        update = {"$unset": {"low_stock_severity": ""}} if severity is None else {"$set": {"low_stock_severity": severity}}
+        ops.append(UpdateOne(
+            {"user_id": user_id, "product_id": product["product_id"], "change_seq": product.get("change_seq")}, update
+        ))
+    if ops:
+        await db.products.bulk_write(ops, ordered=False)
+    return len(ops)
+
+def color_docs(colors: List[ColorVariant]) -> List[dict]:
+    return [c.model_dump(exclude_none=True) for c in colors]
+
+def product_rollup_values(product: dict) -> dict:
+    stock = product.get("current_stock", 0)
+    return {
+        "products_count": 1,
+        "total_stock_value": stock * product["purchase_price"],
+        "total_potential_revenue": stock * product["sale_price"]
+    }
+
+async def update_rollup(user_id: str, inc: dict) -> int:
+    # Cada escrita incrementa "version"; um documento criado por upsert fica sem "schema"
+    # e é reconstruído na próxima leitura do resumo
+    rollup = await db.report_rollups.find_one_and_update(
+        {"user_id": user_id},
+        {"$inc": {**inc, "version": 1}, "$set": {"updated_at": datetime.now(timezone.utc)}},
+        projection={"_id": 0, "version": 1}, upsert=True, return_document=ReturnDocument.AFTER
+    )
+    return rollup["version"]
+
+async def rollup_product_created(user_id: str, product: dict) -> int:
+    return await update_rollup(user_id, product_rollup_values(product))
+
+async def rollup_product_updated(user_id: str, before: dict, after: dict) -> int:
+    old_values = product_rollup_values(before)
+    new_values = product_rollup_values(after)
+    return await update_rollup(
+        user_id,
+        {k: new_values[k] - old_values[k] for k in ("total_stock_value", "total_potential_revenue")}
+    )
+
+async def rollup_product_deleted(user_id: str, product: dict) -> int:
+    return await update_rollup(user_id, {k: -v for k, v in product_rollup_values(product).items()})
+
+async def rollup_movements_applied(user_id: str, movement_docs: List[dict], products_after: dict) -> int:
+    # products_after: product_id -> documento (STOCK_RESULT_FIELDS) depois das movimentações
+    inc = {"total_stock_value": 0, "total_potential_revenue": 0, "total_entries": 0, "total_exits": 0}
+    for doc in movement_docs:
+        product = products_after[doc["product_id"]]
+        delta = doc["quantity"] if doc["type"] == "entrada" else -doc["quantity"]
+        inc["total_stock_value"] += delta * product["purchase_price"]
+        inc["total_potential_revenue"] += delta * product["sale_price"]
+        inc["total_entries" if doc["type"] == "entrada" else "total_exits"] += 1
+    await update_low_stock(user_id, products_after.values())
+    return await update_rollup(user_id, inc)
+
+def rollup_needs_rebuild(rollup: Optional[dict]) -> bool:
+    return not rollup or rollup.get("schema") != ROLLUP_SCHEMA
+
+async def compute_rollup(user_id: str) -> dict:
+    # Recalcula o rollup a partir das coleções, no MongoDB
+    products_pipeline = [
+        {"$match": {"user_id": user_id}},
+        {"$group": {
+            "_id": None,
+            "products_count": {"$sum": 1},
+            "total_stock_value": {"$sum": {"$multiply": ["$current_stock", "$purchase_price"]}},
+            "total_potential_revenue": {"$sum": {"$multiply": ["$current_stock", "$sale_price"]}}
+        }}
+    ]
+    movements_pipeline = [
+        {"$match": {"user_id": user_id}},
+        {"$group": {"_id": "$type", "count": {"$sum": 1}}}
+    ]
+    
+    products_result, movement_counts = await asyncio.gather(
+        db.products.aggregate(products_pipeline).to_list(1),
+        db.stock_movements.aggregate(movements_pipeline).to_list(None)
+    )
+    totals = products_result[0] if products_result else {}
+    counts = {m["_id"]: m["count"] for m in movement_counts}
+    
+    return {
+        "user_id": user_id,
+        "products_count": totals.get("products_count", 0),
+        "total_stock_value": totals.get("total_stock_value", 0),
+        "total_potential_revenue": totals.get("total_potential_revenue", 0),
+        "total_entries": counts.get("entrada", 0),
+        "total_exits": counts.get("saida", 0)
+    }
+
+async def low_stock_drift(user_id: str) -> List[dict]:
+    # Produtos cuja severidade gravada não corresponde ao stock (ex.: processo caído entre as duas escritas)
+    cursor = db.products.find({"user_id": user_id}, LOW_STOCK_FIELDS)
+    return [p async for p in cursor if low_stock_severity(p) != p.get("low_stock_severity")]
+
+async def rebuild_rollup(user_id: str) -> dict:
+    # O $set só é gravado se a versão lida antes do cálculo não mudou: um $inc concorrente
+    # (que o cálculo pode não ter visto) obriga a recalcular em vez de ser apagado
+    await update_low_stock(user_id, await low_stock_drift(user_id))
+    for _ in range(ROLLUP_REBUILD_ATTEMPTS):
+        stored = await db.report_rollups.find_one_and_update(
+            {"user_id": user_id}, {"$setOnInsert": {"version": 0}},
+            projection={"_id": 0, "version": 1}, upsert=True, return_document=ReturnDocument.AFTER
+        )
+        version = stored["version"]
+        rollup = await compute_rollup(user_id)
+        rollup["schema"] = ROLLUP_SCHEMA
+        rollup["updated_at"] = datetime.now(timezone.utc)
+        result = await db.report_rollups.update_one(
+            {"user_id": user_id, "version": version},
+            {"$set": {**rollup, "version": version + 1}, "$unset": {"built": "", "low_stock_product_ids": ""}}
+        )
+        if result.modified_count:
+            rollup["version"] = version + 1
+            return rollup
+    # Escritas contínuas: devolve o valor calculado sem o gravar; a próxima leitura volta a tentar
+    logger.warning(f"Rollup rebuild for {user_id} kept racing with writes; serving it unsaved")
+    rollup["version"] = version
+    return rollup
+
+async def check_rollup(user_id: str) -> dict:
+    stored = await db.report_rollups.find_one({"user_id": user_id}, {"_id": 0}) or {}
+    actual = await compute_rollup(user_id)
+    differences = {}
+    for field in ROLLUP_FIELDS:
+        # Um rollup criado por upsert só tem os campos já incrementados: os restantes valem 0
+        stored_value = stored.get(field, 0)
+        if abs(stored_value - actual[field]) > 1e-6 * max(1, abs(actual[field])):
+            differences[field] = {"stored": stored_value, "actual": actual[field]}
+    drift = await low_stock_drift(user_id)
+    if drift:
+        differences["low_stock_severity"] = {
+            p["product_id"]: {"stored": p.get("low_stock_severity"), "actual": low_stock_severity(p)} for p in drift
+        }
+    return {"user_id": user_id, "consistent": not differences, "differences": differences}
+
+# ====== Barcode Index ======
+BARCODE_INDEX_MAX_PRODUCTS = int(os.environ.get('BARCODE_INDEX_MAX_PRODUCTS', '200000'))
+# "" (um só worker), "poll" (compara report_rollups.version) ou "changestream" (replica set)
+BARCODE_INDEX_SYNC = os.environ.get('BARCODE_INDEX_SYNC', '')
+BARCODE_INDEX_POLL_SECONDS = float(os.environ.get('BARCODE_INDEX_POLL_SECONDS', '2'))
+# Durante quanto tempo um catálogo grande demais é consultado directamente sem nova contagem
+BARCODE_INDEX_BYPASS_SECONDS = float(os.environ.get('BARCODE_INDEX_BYPASS_SECONDS', '300'))
+BARCODE_INDEX_PROJECTION = {"pending_movements": 0, "search_keys": 0, "name_prefixes": 0, "barcode_prefixes": 0}
+
+class TenantBarcodes:
+    __slots__ = ("by_barcode", "barcode_of", "version")
+
+    def __init__(self, version: Optional[int]):
+        self.by_barcode = {}  # barcode -> Product
+        self.barcode_of = {}  # product_id -> barcode
+        self.version = version
+
+class BarcodeIndex:
+    # Índice barcode -> Product por utilizador, carregado na primeira leitura e mantido pelas escritas
+    def __init__(self, max_products: int):
+        self.max_products = max_products
+        self._tenants: "OrderedDict[str, TenantBarcodes]" = OrderedDict()
+        self._loading = {}  # user_id -> asyncio.Task
+        self._pending = {}  # user_id -> escritas recebidas durante o carregamento, reaplicadas no fim
+        self._object_ids = {}  # _id -> (user_id, product_id), para deletes vindos do change stream
+        self._bypassed = {}  # user_id -> instante (monotonic) até ao qual o catálogo não é carregado
+        self.size = 0
+        self.hits = 0
+        self.loads = 0
+        self.bypasses = 0
+        self.evictions = 0
+
+    async def lookup(self, user_id: str, barcode: str) -> Optional[Product]:
+        tenant = self._tenants.get(user_id)
+        if tenant is not None:
+            self._tenants.move_to_end(user_id)
+            self.hits += 1
+            return tenant.by_barcode.get(barcode)
+        
+        bypass_until = self._bypassed.get(user_id)
+        if bypass_until is not None and bypass_until > time.monotonic():
+            tenant = None
+        else:
+            tenant = await self._warm(user_id)
+        if tenant is None:
+            # Catálogo maior que o orçamento de memória: consulta directa
+            self.bypasses += 1
+            doc = await db.products.find_one({"barcode": barcode, "user_id": user_id}, {"_id": 0, **BARCODE_INDEX_PROJECTION})
+            return Product(**doc) if doc else None
+        return tenant.by_barcode.get(barcode)
+
+    async def _warm(self, user_id: str) -> Optional[TenantBarcodes]:
+        task = self._loading.get(user_id)
+        if task is None:
+            task = asyncio.create_task(self._load(user_id))
+            self._loading[user_id] = task
+            task.add_done_callback(lambda t: self._loading.pop(user_id, None))
+        return await task
+
+    async def _load(self, user_id: str) -> Optional[TenantBarcodes]:
+        # O registo de escritas abre antes da leitura: o que chegar entretanto é reaplicado sobre ela
+        self._pending[user_id] = []
+        try:
+            return await self._load_snapshot(user_id)
+        finally:
+            self._pending.pop(user_id, None)
+
+    async def _load_snapshot(self, user_id: str) -> Optional[TenantBarcodes]:
+        # Conta antes de ler: um catálogo acima do orçamento não chega a ser transferido
+        if await db.products.count_documents({"user_id": user_id}, limit=self.max_products + 1) > self.max_products:
+            self._bypassed[user_id] = time.monotonic() + BARCODE_INDEX_BYPASS_SECONDS
+            return None
+        self._bypassed.pop(user_id, None)
+        self.loads += 1
+        rollup = await db.report_rollups.find_one({"user_id": user_id}, {"_id": 0, "version": 1})
+        docs = await db.products.find({"user_id": user_id}, BARCODE_INDEX_PROJECTION).to_list(self.max_products + 1)
+        if len(docs) > self.max_products:
+            self._bypassed[user_id] = time.monotonic() + BARCODE_INDEX_BYPASS_SECONDS
+            return None
+        
+        pending = self._pending.get(user_id, [])
+        if any(op == "invalidate" for op, _ in pending):
+            return None
+        
+        tenant = TenantBarcodes(rollup.get("version") if rollup else None)
+        self._tenants[user_id] = tenant
+        for doc in docs:
+            self._put(user_id, tenant, doc)
+        for op, arg in pending:
+            getattr(self, op)(user_id, arg)
+        # _put pode ter descartado o próprio tenant para respeitar o orçamento
+        return tenant if self._tenants.get(user_id) is tenant else None
+
+    def _put(self, user_id: str, tenant: TenantBarcodes, doc: dict):
+        if self._tenants.get(user_id) is not tenant:
+            return
+        product = Product(**doc)
+        old_barcode = tenant.barcode_of.get(product.product_id)
+        if old_barcode is None:
+            self.size += 1
+        elif old_barcode != product.barcode:
+            tenant.by_barcode.pop(old_barcode, None)
+        tenant.by_barcode[product.barcode] = product
+        tenant.barcode_of[product.product_id] = product.barcode
+        if "_id" in doc:
+            self._object_ids[doc["_id"]] = (user_id, product.product_id)
+        if old_barcode is None:
+            self._enforce_budget(user_id)
+
+    def _enforce_budget(self, user_id: str):
+        # Produtos criados depois do carregamento também contam: saem primeiro os catálogos
+        # usados há mais tempo e, se só este não couber, passa a ser consultado directamente
+        while self.size > self.max_products:
+            cold = next((u for u in self._tenants if u != user_id), None)
+            if cold is None:
+                self._evict(user_id)
+                self._bypassed[user_id] = time.monotonic() + BARCODE_INDEX_BYPASS_SECONDS
+                return
+            self._evict(cold)
+
+    def _evict(self, user_id: str):
+        tenant = self._tenants.pop(user_id, None)
+        if tenant is not None:
+            self.size -= len(tenant.barcode_of)
+            self.evictions += 1
+
+    def _defer(self, user_id: str, op: str, arg=None) -> bool:
+        # Tenant a carregar: a escrita fica registada para ser aplicada quando a leitura terminar
+        if user_id in self._pending and user_id not in self._tenants:
+            self._pending[user_id].append((op, arg))
+            return True
+        return False
+
+    def invalidate(self, user_id: str):
+        self._defer(user_id, "invalidate")
+        self._evict(user_id)
+
+    def upsert(self, user_id: str, doc: dict):
+        if self._defer(user_id, "upsert", doc):
+            return
+        tenant = self._tenants.get(user_id)
+        if tenant is not None:
+            self._put(user_id, tenant, doc)
+
+    def remove(self, user_id: str, product_id: str):
+        # O catálogo diminuiu: volta a contar na próxima leitura
+        self._bypassed.pop(user_id, None)
+        if self._defer(user_id, "remove", product_id):
+            return
+        tenant = self._tenants.get(user_id)
+        if tenant is None:
+            return
+        barcode = tenant.barcode_of.pop(product_id, None)
+        if barcode is not None:
+            tenant.by_barcode.pop(barcode, None)
+            self.size -= 1
+
+    def apply_stock(self, user_id: str, doc: dict):
+        if self._defer(user_id, "apply_stock", doc):
+            return
+        tenant = self._tenants.get(user_id)
+        barcode = tenant.barcode_of.get(doc["product_id"]) if tenant else None
+        if barcode is None:
+            return
+        tenant.by_barcode[barcode] = tenant.by_barcode[barcode].model_copy(update={
+            "current_stock": doc.get("current_stock", 0),
+            "colors": [ColorVariant(**c) for c in doc.get("colors", [])]
+        })
+
+    def record_write(self, user_id: str, version: int):
+        # Em modo "poll", uma escrita deste worker que não segue a versão conhecida
+        # significa que outro worker escreveu entretanto
+        if BARCODE_INDEX_SYNC != "poll":
+            return
+        tenant = self._tenants.get(user_id)
+        if tenant is None:
+            return
+        if tenant.version is not None and version == tenant.version + 1:
+            tenant.version = version
+        else:
+            self._evict(user_id)
+
+    async def poll_versions(self):
+        while True:
+            await asyncio.sleep(BARCODE_INDEX_POLL_SECONDS)
+            try:
+                cached = list(self._tenants)
+                if not cached:
+                    continue
+                versions = {
+                    r["user_id"]: r.get("version")
+                    async for r in db.report_rollups.find(
+                        {"user_id": {"$in": cached}}, {"_id": 0, "user_id": 1, "version": 1}
+                    )
+                }
+                for user_id in cached:
+                    tenant = self._tenants.get(user_id)
+                    if tenant is not None and versions.get(user_id) != tenant.version:
+                        self._evict(user_id)
+            except Exception as e:
+                logger.warning(f"Barcode index poll failed: {e}")
+
+    async def watch_changes(self):
+        while True:
+            try:
+                async with db.products.watch(full_document="updateLookup") as stream:
+                    async for change in stream:
+                        self._apply_change(change)
+            except Exception as e:
+                # Perdemos eventos: descarta o índice e volta a ligar
+                logger.warning(f"Barcode index change stream failed: {e}")
+                self.clear()
+                await asyncio.sleep(5)
+
+    def _apply_change(self, change: dict):
+        operation = change["operationType"]
+        if operation in ("insert", "update", "replace"):
+            doc = change.get("fullDocument")
+            if doc:
+                self.upsert(doc["user_id"], doc)
+        elif operation == "delete":
+            ref = self._object_ids.pop(change["documentKey"]["_id"], None)
+            if ref:
+                self.remove(*ref)
+
+    def clear(self):
+        self._tenants.clear()
+        self._object_ids.clear()
+        self._bypassed.clear()
+        for pending in self._pending.values():
+            pending.append(("invalidate", None))
+        self.size = 0
+
+    def stats(self) -> dict:
+        return {
+            "sync": BARCODE_INDEX_SYNC or "local",
+            "tenants": len(self._tenants),
+            "bypassed_tenants": len(self._bypassed),
+            "products": self.size,
+            "max_products": self.max_products,
+            "hits": self.hits,
+            "loads": self.loads,
+            "bypasses": self.bypasses,
+            "evictions": self.evictions,
+        }
+
+barcode_index = BarcodeIndex(BARCODE_INDEX_MAX_PRODUCTS)
+
+# ====== Change Bus ======
+# "" (escritas publicam em memória; um só worker) ou "changestream" (eventos vêm do MongoDB, todos os workers)
+STREAM_SOURCE = os.environ.get('STREAM_SOURCE', '')
+STREAM_QUEUE_SIZE = int(os.environ.get('STREAM_QUEUE_SIZE', '500'))
+STREAM_HEARTBEAT_SECONDS = float(os.environ.get('STREAM_HEARTBEAT_SECONDS', '15'))
+STREAM_PRODUCT_FIELDS = [f for f in Product.model_fields if f != "user_id"]
+
+def product_event(product: dict, version: Optional[int] = None) -> dict:
+    return {
+        "type": "product",
+        "version": version,
+        "product": {f: product[f] for f in STREAM_PRODUCT_FIELDS if f in product}
+    }
+
+def movement_event(movement_doc: dict, version: Optional[int] = None) -> dict:
+    return {
+        "type": "movement",
+        "version": version,
+        "movement": {k: v for k, v in movement_doc.items() if k not in ("_id", "user_id")}
+    }
+
+class ChangeBus:
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self._subscribers = {}  # user_id -> set de filas, uma por ligação
+        self._object_ids = {}  # _id -> (user_id, product_id), para resolver deletes do change stream
+        self.published = 0
+        self.overflows = 0
+
+    def subscribe(self, user_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(self.queue_size)
+        self._subscribers.setdefault(user_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, user_id: str, queue: asyncio.Queue):
+        queues = self._subscribers.get(user_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[user_id]
+
+    def _deliver(self, user_id: str, event: dict):
+        for queue in self._subscribers.get(user_id, ()):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Cliente lento: descarta o atraso e pede-lhe que recarregue
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait({"type": "resync"})
+                self.overflows += 1
+        self.published += 1
+
+    def publish(self, user_id: str, event: dict):
+        # Com change stream, as escritas deste worker também chegam por watch_changes
+        if STREAM_SOURCE != "changestream" and user_id in self._subscribers:
+            self._deliver(user_id, event)
+
+    def publish_stock(self, user_id: str, version: int, movement_docs: List[dict], products_after: dict):
+        for product in products_after.values():
+            self.publish(user_id, {
+                "type": "stock",
+                "version": version,
+                "product_id": product["product_id"],
+                "current_stock": product.get("current_stock", 0),
+                "colors": product.get("colors", [])
+            })
+        for movement_doc in movement_docs:
+            self.publish(user_id, movement_event(movement_doc, version))
+
+    async def watch_changes(self):
+        pipeline = [{"$match": {
+            "ns.coll": {"$in": ["products", "stock_movements"]},
+            "operationType": {"$in": ["insert", "update", "replace", "delete"]}
+        }}]
+        while True:
+            try:
+                async with db.watch(pipeline, full_document="updateLookup") as stream:
+                    async for change in stream:
+                        self._apply_change(change)
+            except Exception as e:
+                # Perdemos eventos: os clientes ligados recarregam
+                logger.warning(f"Change bus stream failed: {e}")
+                for user_id in list(self._subscribers):
+                    self._deliver(user_id, {"type": "resync"})
+                await asyncio.sleep(5)
+
+    def _apply_change(self, change: dict):
+        collection = change["ns"]["coll"]
+        if change["operationType"] == "delete":
+            ref = self._object_ids.pop(change["documentKey"]["_id"], None)
+            if ref and collection == "products":
+                self._deliver(ref[0], {"type": "product_deleted", "product_id": ref[1]})
+            return
+        doc = change.get("fullDocument")
+        if not doc or doc["user_id"] not in self._subscribers:
+            return
+        if collection == "products":
+            self._object_ids[doc["_id"]] = (doc["user_id"], doc["product_id"])
+            self._deliver(doc["user_id"], product_event(doc))
+        else:
+            self._deliver(doc["user_id"], movement_event(doc))
+
+    def stats(self) -> dict:
+        return {
+            "source": STREAM_SOURCE or "local",
+            "users": len(self._subscribers),
+            "connections": sum(len(queues) for queues in self._subscribers.values()),
+            "published": self.published,
+            "overflows": self.overflows,
+        }
+
+change_bus = ChangeBus(STREAM_QUEUE_SIZE)
+
+# ====== Sales Buckets ======
+# Um documento por (utilizador, produto, cor, hora); as séries temporais agregam estes buckets
+TIMESERIES_UNITS = {"day": "day", "week": "week", "month": "month"}
+
+def bucket_hour(date: datetime) -> datetime:
+    return date.replace(minute=0, second=0, microsecond=0)
+
+def bucket_increments(movement_docs: List[dict], prices: dict) -> dict:
+    # prices: product_id -> {"purchase_price", "sale_price"}
+    buckets = {}
+    for doc in movement_docs:
+        key = (doc["product_id"], doc.get("color"), bucket_hour(doc["date"]))
+        inc = buckets.setdefault(key, {"units_in": 0, "units_out": 0, "revenue": 0.0, "cost": 0.0, "movements": 0})
+        price = prices.get(doc["product_id"])
+        inc["movements"] += 1
+        if doc["type"] == "entrada":
+            inc["units_in"] += doc["quantity"]
+        else:
+            inc["units_out"] += doc["quantity"]
+            if price:
+                unit_price = doc.get("unit_price")
+                inc["revenue"] += doc["quantity"] * (price["sale_price"] if unit_price is None else unit_price)
+                inc["cost"] += doc["quantity"] * price["purchase_price"]
+    return buckets
+
+async def write_bucket_increments(user_id: str, buckets: dict):
+    if not buckets:
+        return
+    await db.sales_buckets.bulk_write([
+        UpdateOne(
+            {"user_id": user_id, "product_id": product_id, "color": color, "hour": hour},
+            {"$inc": inc},
+            upsert=True
+        )
+        for (product_id, color, hour), inc in buckets.items()
+    ], ordered=False)
+
+async def record_sales_buckets(user_id: str, movement_docs: List[dict], products_after: dict):
+    await write_bucket_increments(user_id, bucket_increments(movement_docs, products_after))
+
+async def backfill_sales_buckets(user_id: str, flush_every: int = 5000) -> int:
+    # Reconstrói os buckets a partir de stock_movements, em streaming. Usa os preços actuais
+    # dos produtos, porque os movimentos antigos não guardam o preço da altura.
+    cutoff = datetime.now(timezone.utc)
+    await db.sales_buckets.delete_many({"user_id": user_id})
+    prices = {
+        p["product_id"]: p
+        async for p in db.products.find({"user_id": user_id}, {"_id": 0, "product_id": 1, "purchase_price": 1, "sale_price": 1})
+    }
+    cursor = db.stock_movements.find(
+        {"user_id": user_id, "date": {"$lt": cutoff}},
+        {"_id": 0, "product_id": 1, "color": 1, "type": 1, "quantity": 1, "date": 1, "unit_price": 1}
+    ).batch_size(1000)
+    pending, processed = [], 0
+    async for doc in cursor:
+        pending.append(doc)
+        processed += 1
+        if len(pending) >= flush_every:
+            await write_bucket_increments(user_id, bucket_increments(pending, prices))
+            pending = []
+    await write_bucket_increments(user_id, bucket_increments(pending, prices))
+    await update_rollup(user_id, {})
+    return processed
+
+async def sales_timeseries(user_id: str, granularity: str, date_from: Optional[datetime], date_to: Optional[datetime],
+                           product_id: Optional[str], color: Optional[str], by_product: bool, by_color: bool) -> List[dict]:
+    match = {"user_id": user_id}
+    if date_from or date_to:
+        match["hour"] = {}
+        if date_from:
+            match["hour"]["$gte"] = bucket_hour(date_from)
+        if date_to:
+            match["hour"]["$lt"] = date_to
+    if product_id:
+        match["product_id"] = product_id
+    if color:
+        match["color"] = color
+    
+    group_id = {"period": {"$dateTrunc": {"date": "$hour", "unit": TIMESERIES_UNITS[granularity], "startOfWeek": "monday"}}}
+    if by_product:
+        group_id["product_id"] = "$product_id"
+    if by_color:
+        group_id["color"] = "$color"
+    pipeline = [
+        {"$match": match},
+        {"$group": {
+            "_id": group_id,
+            "units_in": {"$sum": "$units_in"},
+            "units_out": {"$sum": "$units_out"},
+            "revenue": {"$sum": "$revenue"},
+            "cost": {"$sum": "$cost"},
+            "movements": {"$sum": "$movements"}
+        }},
+        {"$sort": {"_id.period": 1, "_id.product_id": 1, "_id.color": 1}}
+    ]
+    rows = await db.sales_buckets.aggregate(pipeline).to_list(None)
+    return [{**row.pop("_id"), **row} for row in rows]
+
+# ====== Valuation ======
+# CMV e margem por produto e período, por custo médio ponderado ("average") ou FIFO ("fifo").
+# Os checkpoints guardam o estado de um produto no início de um mês já assente: uma avaliação
+# parte do último checkpoint antes do período e só repete os movimentos seguintes.
+VALUATION_BATCH_SIZE = int(os.environ.get('VALUATION_BATCH_SIZE', '5000'))
+# Movimentos mais recentes do que isto ainda podem chegar fora de ordem: ficam fora dos checkpoints
+VALUATION_SETTLE_SECONDS = int(os.environ.get('VALUATION_SETTLE_SECONDS', '300'))
+VALUATION_TOTAL_FIELDS = ("units_in", "units_out", "purchases", "revenue", "cogs")
+VALUATION_PRODUCT_FIELDS = {
+    "_id": 0, "product_id": 1, "name": 1, "currency": 1, "current_stock": 1, "purchase_price": 1, "sale_price": 1
+}
+VALUATION_MOVEMENT_FIELDS = {
+    "_id": 0, "product_id": 1, "type": 1, "quantity": 1, "date": 1, "unit_cost": 1, "unit_price": 1
+}
+
+def as_utc(date: datetime) -> datetime:
+    return date if date.tzinfo else date.replace(tzinfo=timezone.utc)
+
+def month_start(date: datetime) -> datetime:
+    return date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+def new_valuation_state(method: str) -> dict:
+    state = {"quantity": 0, "value": 0.0, **{f: 0 for f in VALUATION_TOTAL_FIELDS}}
+    if method == "fifo":
+        state["layers"] = []  # [quantidade, custo unitário] das entradas ainda em stock, da mais antiga
+    return state
+
+def advance_average(state: dict, is_in, qty, cost, fallback_cost: float) -> float:
+    # Cada entrada muda o custo médio das saídas seguintes: a recorrência é sequencial
+    quantity, value, cogs = state["quantity"], state["value"], 0.0
+    for inbound, q, c in zip(is_in.tolist(), qty.tolist(), cost.tolist()):
+        if inbound:
+            quantity += q
+            value += q * c
+            continue
+        taken = min(q, quantity)
+        out_value = value * taken / quantity if quantity else 0.0
+        # Stock sem entrada registada (criado ou editado no produto) sai ao preço de compra
+        cogs += out_value + (q - taken) * fallback_cost
+        quantity -= taken
+        value = value - out_value if quantity else 0.0
+    state["quantity"], state["value"] = int(quantity), value
+    return cogs
+
+def advance_fifo(state: dict, is_in, qty, cost, fallback_cost: float) -> float:
+    # As camadas em aberto entram como entradas anteriores ao lote
+    layers = state["layers"]
+    in_qty = np.concatenate([np.array([l[0] for l in layers], dtype=float), np.where(is_in, qty, 0.0)])
+    out_qty = np.concatenate([np.zeros(len(layers)), np.where(is_in, 0.0, qty)])
+    unit_cost = np.concatenate([np.array([l[1] for l in layers], dtype=float), cost])
+    entered = np.cumsum(in_qty)
+    requested = np.cumsum(out_qty)
+    # Uma saída sem stock não consome entradas futuras: consumido = pedido + mínimo acumulado de (entrado - pedido)
+    consumed = requested + np.minimum.accumulate(np.minimum(entered - requested, 0.0))
+    # Curva (unidades entradas, custo acumulado): o custo FIFO das primeiras N unidades é a curva em N
+    is_layer = in_qty > 0
+    curve_x = np.concatenate([[0.0], entered[is_layer]])
+    curve_y = np.concatenate([[0.0], np.cumsum(in_qty * unit_cost)[is_layer]])
+    end = consumed[-1]
+    cogs = float(np.interp(end, curve_x, curve_y)) + float(requested[-1] - end) * fallback_cost
+    
+    remaining = is_layer & (entered > end)
+    left = np.minimum(in_qty, entered - end)[remaining]
+    state["layers"] = [[int(q), float(c)] for q, c in zip(left.tolist(), unit_cost[remaining].tolist())]
+    state["quantity"] = int(left.sum())
+    state["value"] = float((left * unit_cost[remaining]).sum())
+    return cogs
+
+def advance_valuation(state: dict, method: str, rows: List[dict], product: dict):
+    # Um lote de movimentos (por ordem de data) em colunas; sem custo/preço gravado valem os do produto
+    if not rows:
+        return
+    is_in = np.array([r["type"] == "entrada" for r in rows])
+    qty = np.array([r["quantity"] for r in rows], dtype=float)
+    cost = np.array([product["purchase_price"] if r.get("unit_cost") is None else r["unit_cost"] for r in rows], dtype=float)
+    price = np.array([product["sale_price"] if r.get("unit_price") is None else r["unit_price"] for r in rows], dtype=float)
+    state["units_in"] += int(qty[is_in].sum())
+    state["units_out"] += int(qty[~is_in].sum())
+    state["purchases"] += float((qty * cost)[is_in].sum())
+    state["revenue"] += float((qty * price)[~is_in].sum())
+    advance = advance_fifo if method == "fifo" else advance_average
+    state["cogs"] += advance(state, is_in, qty, cost, product["purchase_price"])
+
+def stock_value(state: dict, method: str, stock: int, fallback_cost: float) -> float:
+    # Valor do stock actual ao custo do método; unidades sem entrada registada ao preço de compra
+    if method == "average":
+        return stock * (state["value"] / state["quantity"] if state["quantity"] else fallback_cost)
+    value, left = 0.0, stock
+    for q, c in reversed(state["layers"]):
+        if left <= 0:
+            break
+        taken = min(q, left)
+        value += taken * c
+        left -= taken
+    return value + max(left, 0) * fallback_cost
+
+class ProductValuation:
+    """Estado de um produto ao longo do stream de movimentos, com os checkpoints que for cruzando."""
+
+    def __init__(self, product: dict, method: str, checkpoint: Optional[dict] = None):
+        self.product = product
+        self.method = method
+        self.state = checkpoint["state"] if checkpoint else new_valuation_state(method)
+        self.checkpoint_at = as_utc(checkpoint["at"]) if checkpoint else None
+        self.opening = None  # Totais no início do período
+        self.rows = []
+        self.last_date = None  # Último movimento desde o checkpoint
+        self.checkpoints = []
+
+    def flush(self):
+        advance_valuation(self.state, self.method, self.rows, self.product)
+        self.rows = []
+
+    def mark(self, date: datetime, date_from: Optional[datetime], settled: datetime):
+        # Estado imediatamente antes de "date": início do período e/ou checkpoint de mês assente
+        if date_from and self.opening is None and date >= date_from:
+            self.flush()
+            self.opening = {f: self.state[f] for f in VALUATION_TOTAL_FIELDS}
+        boundary = month_start(min(date, settled))
+        if self.last_date is not None and boundary > self.last_date:
+            self.flush()
+            # advance_* substituem as camadas em vez de as alterar: a cópia rasa basta
+            self.checkpoints.append({"at": boundary, "state": dict(self.state)})
+            self.checkpoint_at, self.last_date = boundary, None
+
+    def add(self, row: dict, date_from: Optional[datetime], settled: datetime):
+        date = as_utc(row["date"])
+        self.mark(date, date_from, settled)
+        self.rows.append(row)
+        self.last_date = date
+        if len(self.rows) >= VALUATION_BATCH_SIZE:
+            self.flush()
+
+    def finish(self, date_to: datetime, date_from: Optional[datetime], settled: datetime):
+        self.mark(date_to, date_from, settled)
+        self.flush()
+
+async def load_checkpoints(user_id: str, method: str, before: datetime, product_id: Optional[str]) -> dict:
+    # Último checkpoint de cada produto em ou antes de "before"
+    match = {"user_id": user_id, "method": method, "at": {"$lte": before}}
+    if product_id:
+        match["product_id"] = product_id
+    pipeline = [
+        {"$match": match},
+        {"$sort": {"product_id": 1, "at": -1}},
+        {"$group": {"_id": "$product_id", "at": {"$first": "$at"}, "state": {"$first": "$state"}}}
+    ]
+    return {c["_id"]: c async for c in db.valuation_checkpoints.aggregate(pipeline)}
+
+async def save_checkpoints(user_id: str, method: str, runs: List[ProductValuation]):
+    now = datetime.now(timezone.utc)
+    ops = [
+        UpdateOne(
+            {"user_id": user_id, "method": method, "product_id": run.product["product_id"], "at": checkpoint["at"]},
+            {"$set": {"state": checkpoint["state"], "updated_at": now}},
+            upsert=True
+        )
+        for run in runs for checkpoint in run.checkpoints
+    ]
+    if ops:
+        await db.valuation_checkpoints.bulk_write(ops, ordered=False)
+
+async def invalidate_valuation(user_id: str, product_id: str, date: datetime):
+    # Movimento gravado com data passada (venda offline, outbox recuperado): os checkpoints seguintes deixam de valer
+    if as_utc(date) < datetime.now(timezone.utc) - timedelta(seconds=VALUATION_SETTLE_SECONDS):
+        await db.valuation_checkpoints.delete_many({"user_id": user_id, "product_id": product_id, "at": {"$gt": date}})
+
+async def value_inventory(user_id: str, method: str, date_from: Optional[datetime], date_to: Optional[datetime],
+                          product_id: Optional[str] = None) -> dict:
+    now = datetime.now(timezone.utc)
+    at_now = date_to is None
+    date_to = min(as_utc(date_to), now) if date_to else now
+    date_from = as_utc(date_from) if date_from else None
+    settled = min(date_to, now - timedelta(seconds=VALUATION_SETTLE_SECONDS))
+    
+    product_query = {"user_id": user_id}
+    if product_id:
+        product_query["product_id"] = product_id
+    products = await db.products.find(product_query, VALUATION_PRODUCT_FIELDS).to_list(None)
+    checkpoints = await load_checkpoints(user_id, method, date_from or date_to, product_id)
+    runs = {p["product_id"]: ProductValuation(p, method, checkpoints.get(p["product_id"])) for p in products}
+    
+    # Uma leitura por ponto de partida; produtos com o mesmo checkpoint partilham o stream
+    starts = {}
+    for pid, run in runs.items():
+        starts.setdefault(run.checkpoint_at, []).append(pid)
+    for start, product_ids in starts.items():
+        query = {"user_id": user_id, "product_id": {"$in": product_ids}, "date": {"$lt": date_to}}
+        if start:
+            query["date"]["$gte"] = start
+        cursor = db.stock_movements.find(query, VALUATION_MOVEMENT_FIELDS).sort(
+            [("product_id", -1), ("date", 1), ("movement_id", 1)]
+        ).batch_size(1000)
+        current = None
+        async for row in cursor:
+            run = runs[row["product_id"]]
+            if run is not current:
+                if current:
+                    current.flush()
+                current = run
+            run.add(row, date_from, settled)
+    for run in runs.values():
+        run.finish(date_to, date_from, settled)
+    await save_checkpoints(user_id, method, list(runs.values()))
+    
+    items, totals = [], {}
+    for run in runs.values():
+        state, opening = run.state, run.opening or {f: 0 for f in VALUATION_TOTAL_FIELDS}
+        period = {f: state[f] - opening[f] for f in VALUATION_TOTAL_FIELDS}
+        gross_margin = period["revenue"] - period["cogs"]
+        item = {
+            "product_id": run.product["product_id"],
+            "name": run.product["name"],
+            "currency": run.product.get("currency", "MZN"),
+            "units_received": period["units_in"],
+            "units_sold": period["units_out"],
+            "purchases": round(period["purchases"], 2),
+            "revenue": round(period["revenue"], 2),
+            "cogs": round(period["cogs"], 2),
+            "gross_margin": round(gross_margin, 2),
+            "margin_pct": round(gross_margin / period["revenue"] * 100, 2) if period["revenue"] else None,
+            "closing_quantity": state["quantity"],
+            "closing_value": round(state["value"], 2)
+        }
+        if at_now:
+            item["stock_value"] = round(stock_value(
+                state, method, run.product.get("current_stock", 0), run.product["purchase_price"]
+            ), 2)
+        items.append(item)
+        currency_totals = totals.setdefault(item["currency"], {})
+        for field in ("purchases", "revenue", "cogs", "gross_margin", "closing_value", "stock_value"):
+            if field in item:
+                currency_totals[field] = round(currency_totals.get(field, 0) + item[field], 2)
+    items.sort(key=lambda i: (-i["gross_margin"], i["product_id"]))
+    return {"method": method, "date_from": date_from, "date_to": date_to, "totals": totals, "products": items}
+
+async def backfill_movement_costs(user_id: str) -> int:
+    # Movimentos anteriores ao registo de custos ficam com os preços actuais dos produtos
+    ops = []
+    async for product in db.products.find({"user_id": user_id}, VALUATION_PRODUCT_FIELDS):
+        query = {"user_id": user_id, "product_id": product["product_id"]}
+        ops.append(UpdateMany({**query, "type": "entrada", "unit_cost": None}, {"$set": {"unit_cost": product["purchase_price"]}}))
+        ops.append(UpdateMany({**query, "type": "saida", "unit_price": None}, {"$set": {"unit_price": product["sale_price"]}}))
+    modified = 0
+    for start in range(0, len(ops), 1000):
+        result = await db.stock_movements.bulk_write(ops[start:start + 1000], ordered=False)
+        modified += result.modified_count
+    await db.valuation_checkpoints.delete_many({"user_id": user_id})
+    if modified:
+        # As avaliações em cache (ETag) deixam de corresponder aos movimentos
+        await update_rollup(user_id, {})
+    return modified
+
+# ====== Stock Updates ======
+# "auto" detecta replica set / mongos; "1" força transações; "0" usa sempre o outbox
+MONGO_TRANSACTIONS = os.environ.get('MONGO_TRANSACTIONS', 'auto')
+MOVEMENT_CLAIM_TIMEOUT_SECONDS = int(os.environ.get('MOVEMENT_CLAIM_TIMEOUT_SECONDS', '60'))
+_transactions_supported: Optional[bool] = None
+
+async def transactions_supported() -> bool:
+    global _transactions_supported
+    if MONGO_TRANSACTIONS in ("0", "1"):
+        return MONGO_TRANSACTIONS == "1"
+    if _transactions_supported is None:
+        try:
+            hello = await client.admin.command("hello")
+            _transactions_supported = "setName" in hello or hello.get("msg") == "isdbgrid"
+        except Exception:
+            _transactions_supported = False
+    return _transactions_supported
+
+class ChangeSequence:
+    """Sequência de alterações para a sincronização: microssegundos, estritamente crescente por processo."""
+
+    def __init__(self):
+        self._last = 0
+
+    def next(self) -> int:
+        self._last = max(self._last + 1, time.time_ns() // 1000)
+        return self._last
+
+change_sequence = ChangeSequence()
+
+def build_movement_doc(movement: MovementCreate, user_id: str, movement_id: Optional[str] = None,
+                       date: Optional[datetime] = None) -> dict:
+    now = datetime.now(timezone.utc)
+    if date is not None:
+        # Data do dispositivo (vendas offline); nunca no futuro
+        date = min(date if date.tzinfo else date.replace(tzinfo=timezone.utc), now)
+    return {
+        "movement_id": movement_id or f"mov_{uuid.uuid4().hex[:12]}",
+        "product_id": movement.product_id,
+        "type": movement.type,
+        "quantity": movement.quantity,
+        "color": movement.color,
+        "date": date or now,
+        "note": movement.note,
+        "unit_cost": movement.unit_cost,
+        "unit_price": movement.unit_price,
+        "user_id": user_id,
+        "change_seq": change_sequence.next()
+    }
+
+def price_movement_doc(movement_doc: dict, product: dict):
+    # Fixa no movimento o custo/preço da altura; a avaliação do inventário parte daqui
+    if movement_doc["type"] == "entrada" and movement_doc.get("unit_cost") is None:
+        movement_doc["unit_cost"] = product["purchase_price"]
+    elif movement_doc["type"] == "saida" and movement_doc.get("unit_price") is None:
+        movement_doc["unit_price"] = product["sale_price"]
+
+def build_stock_update(movement: MovementCreate, user_id: str):
+    # Filtro + $inc condicional: a verificação de stock e a alteração são uma só operação atómica
+    delta = movement.quantity if movement.type == "entrada" else -movement.quantity
+    query = {"product_id": movement.product_id, "user_id": user_id}
+    if movement.color:
+        color_match = {"color": movement.color}
+        if movement.type == "saida":
+            color_match["quantity"] = {"$gte": movement.quantity}
+        query["colors"] = {"$elemMatch": color_match}
+        update = {"$inc": {"colors.$.quantity": delta, "current_stock": delta}}
+    else:
+        if movement.type == "saida":
+            query["current_stock"] = {"$gte": movement.quantity}
+        update = {"$inc": {"current_stock": delta}}
+    update["$set"] = {"change_seq": change_sequence.next()}
+    return query, update
+
+async def stock_update_error(movement: MovementCreate, user_id: str) -> HTTPException:
+    # Só é chamado quando a actualização condicional não encontrou documento
+    product = await db.products.find_one(
+        {"product_id": movement.product_id, "user_id": user_id},
+        {"_id": 0, "colors": 1}
+    )
+    if not product:
+        return HTTPException(status_code=404, detail="Product not found")
+    if movement.color:
+        if not any(c["color"] == movement.color for c in product.get("colors", [])):
+            return HTTPException(status_code=400, detail=f"Color '{movement.color}' not found in product")
+        return HTTPException(status_code=400, detail="Insufficient stock for this color")
+    return HTTPException(status_code=400, detail="Insufficient stock")
+
+async def flush_movement_outbox(product_id: str, user_id: str, movement_doc: dict) -> bool:
+    # Devolve True se foi esta chamada a retirar o movimento do outbox
+    try:
+        await db.stock_movements.insert_one(dict(movement_doc))
+    except DuplicateKeyError:
+        # Já gravado numa tentativa anterior; um id de outro utilizador (índice antigo, global) não conta
+        if not await db.stock_movements.find_one(
+            {"movement_id": movement_doc["movement_id"], "user_id": user_id}, {"_id": 1}
+        ):
+            raise
+    result = await db.products.update_one(
+        {"product_id": product_id, "user_id": user_id},
+        {"$pull": {"pending_movements": {"movement_id": movement_doc["movement_id"]}}}
+    )
+    return result.modified_count > 0
+
+async def flush_pending_movements():
+    # Recupera movimentos que ficaram no outbox após uma falha entre as duas escritas.
+    # O rollup só é actualizado depois do $pull, por isso estes movimentos ainda não foram contados
+    cursor = db.products.find(
+        {"pending_movements.0": {"$exists": True}},
+        {**STOCK_RESULT_FIELDS, "user_id": 1, "pending_movements": 1}
+    )
+    async for product in cursor:
+        user_id = product["user_id"]
+        flushed = []
+        for movement_doc in product.pop("pending_movements"):
+            # Nova sequência: clientes que já sincronizaram para lá da original também o recebem
+            movement_doc["change_seq"] = change_sequence.next()
+            if await flush_movement_outbox(product["product_id"], user_id, movement_doc):
+                flushed.append(movement_doc)
+            await invalidate_valuation(user_id, product["product_id"], movement_doc["date"])
+        if flushed:
+            await rollup_movements_applied(user_id, flushed, {product["product_id"]: product})
+            await record_sales_buckets(user_id, flushed, {product["product_id"]: product})
+
+async def claim_movement_id(movement_id: str, user_id: str) -> Optional[dict]:
+    # Devolve o movimento já gravado com este id, ou None se este pedido ficou com a reserva
+    existing = await db.stock_movements.find_one({"movement_id": movement_id, "user_id": user_id}, {"_id": 0})
+    if existing:
+        return existing
+    now = datetime.now(timezone.utc)
+    try:
+        await db.movement_claims.insert_one({"movement_id": movement_id, "user_id": user_id, "claimed_at": now})
+        return None
+    except DuplicateKeyError:
+        pass
+    pending = await db.products.find_one(
+        {"user_id": user_id, "pending_movements.movement_id": movement_id},
+        {"_id": 0, "pending_movements.$": 1}
+    )
+    if pending:
+        return pending["pending_movements"][0]
+    # Reserva abandonada (o processo caiu antes de escrever): é retomada
+    stale = await db.movement_claims.find_one_and_update(
+        {"movement_id": movement_id, "user_id": user_id,
+         "claimed_at": {"$lt": now - timedelta(seconds=MOVEMENT_CLAIM_TIMEOUT_SECONDS)}},
+        {"$set": {"claimed_at": now}}
+    )
+    if stale:
+        return None
+    raise HTTPException(status_code=409, detail="Movement id already in use or still being applied")
+
+async def apply_stock_movement(movement: MovementCreate, user_id: str, movement_id: Optional[str] = None,
+                               date: Optional[datetime] = None) -> dict:
+    query, update = build_stock_update(movement, user_id)
+    movement_doc = build_movement_doc(movement, user_id, movement_id, date)
+    
+    if await transactions_supported():
+        async with await client.start_session() as session:
+            async with session.start_transaction():
+                product = await db.products.find_one_and_update(
+                    query, update, projection=STOCK_RESULT_FIELDS,
+                    return_document=ReturnDocument.AFTER, session=session
+                )
+                if product:
+                    price_movement_doc(movement_doc, product)
+                    await db.stock_movements.insert_one(dict(movement_doc), session=session)
+        if not product:
+            raise await stock_update_error(movement, user_id)
+    else:
+        # Sem transações: o movimento viaja na mesma escrita do produto (outbox) e é depois publicado
+        update["$push"] = {"pending_movements": movement_doc}
+        product = await db.products.find_one_and_update(
+            query, update, projection=STOCK_RESULT_FIELDS, return_document=ReturnDocument.AFTER
+        )
+        if not product:
+            raise await stock_update_error(movement, user_id)
+        # A cópia no outbox fica sem preço; se for ela a recuperada, a avaliação usa os preços do produto
+        price_movement_doc(movement_doc, product)
+        await flush_movement_outbox(movement.product_id, user_id, movement_doc)
+    
+    if date is not None:
+        await invalidate_valuation(user_id, movement.product_id, movement_doc["date"])
+    barcode_index.apply_stock(user_id, product)
+    version = await rollup_movements_applied(user_id, [movement_doc], {product["product_id"]: product})
+    barcode_index.record_write(user_id, version)
+    change_bus.publish_stock(user_id, version, [movement_doc], {product["product_id"]: product})
+    await record_sales_buckets(user_id, [movement_doc], {product["product_id"]: product})
+    return movement_doc
+
+async def apply_client_movement(movement: MovementCreate, user_id: str, movement_id: str,
+                                date: Optional[datetime] = None):
+    # Devolve (movimento, duplicado); um id já aplicado devolve o movimento original
+    existing = await claim_movement_id(movement_id, user_id)
+    if existing:
+        return existing, True
+    try:
+        return await apply_stock_movement(movement, user_id, movement_id, date), False
+    except Exception:
+        await db.movement_claims.delete_one({"movement_id": movement_id, "user_id": user_id})
+        raise
+
+def check_batch_stock(items: List[MovementCreate], products: dict) -> List[Optional[str]]:
+    # Simula as linhas por ordem sobre uma cópia do stock para validar o carrinho inteiro
+    stock = {}
+    for product_id, product in products.items():
+        stock[(product_id, None)] = product.get("current_stock", 0)
+        for c in product.get("colors", []):
+            stock[(product_id, c["color"])] = c["quantity"]
+    
+    errors = []
+    for item in items:
+        if item.product_id not in products:
+            errors.append("Product not found")
+            continue
+        key = (item.product_id, item.color)
+        if key not in stock:
+            errors.append(f"Color '{item.color}' not found in product")
+            continue
+        delta = item.quantity if item.type == "entrada" else -item.quantity
+        if stock[key] + delta < 0:
+            errors.append("Insufficient stock for this color" if item.color else "Insufficient stock")
+            continue
+        stock[key] += delta
+        if item.color:
+            stock[(item.product_id, None)] += delta
+        errors.append(None)
+    return errors
+
+async def revert_batch_outbox(user_id: str, movement_docs: List[dict]):
+    # Desfaz as linhas que chegaram a ser aplicadas (identificadas pelo outbox)
+    movement_ids = [d["movement_id"] for d in movement_docs]
+    applied = await db.products.find(
+        {"user_id": user_id, "pending_movements.movement_id": {"$in": movement_ids}},
+        {"_id": 0, "product_id": 1, "pending_movements": 1}
+    ).to_list(None)
+    ops = []
+    for product in applied:
+        for doc in product["pending_movements"]:
+            if doc["movement_id"] not in movement_ids:
+                continue
+            delta = -doc["quantity"] if doc["type"] == "entrada" else doc["quantity"]
+            update = {
+                "$inc": {"current_stock": delta},
+                "$pull": {"pending_movements": {"movement_id": doc["movement_id"]}}
+            }
+            array_filters = None
+            if doc.get("color"):
+                update["$inc"]["colors.$[c].quantity"] = delta
+                array_filters = [{"c.color": doc["color"]}]
+            ops.append(UpdateOne(
+                {"product_id": product["product_id"], "user_id": user_id},
+                update,
+                array_filters=array_filters
+            ))
+    if ops:
+        await db.products.bulk_write(ops, ordered=True)
+
+async def apply_stock_movements_batch(items: List[MovementCreate], user_id: str) -> List[dict]:
+    product_ids = list({item.product_id for item in items})
+    products = await db.products.find(
+        {"user_id": user_id, "product_id": {"$in": product_ids}},
+        {"_id": 0, "product_id": 1, "current_stock": 1, "colors": 1, "purchase_price": 1, "sale_price": 1}
+    ).to_list(None)
+    products = {p["product_id"]: p for p in products}
+    
+    def batch_error(errors: List[Optional[str]]) -> HTTPException:
+        return HTTPException(status_code=400, detail={
+            "message": "Batch rejected, no movements were applied",
+            "results": [
+                {"index": i, "product_id": item.product_id, "color": item.color,
+                 "status": "error" if error else "ok", "error": error}
+                for i, (item, error) in enumerate(zip(items, errors))
+            ]
+        })
+    
+    errors = check_batch_stock(items, products)
+    if any(errors):
+        raise batch_error(errors)
+    
+    movement_docs = [build_movement_doc(item, user_id) for item in items]
+    for movement_doc in movement_docs:
+        price_movement_doc(movement_doc, products[movement_doc["product_id"]])
+    ops = []
+    for item, movement_doc in zip(items, movement_docs):
+        query, update = build_stock_update(item, user_id)
+        ops.append((query, update, movement_doc))
+    
+    if await transactions_supported():
+        async with await client.start_session() as session:
+            async with session.start_transaction():
+                result = await db.products.bulk_write(
+                    [UpdateOne(q, u) for q, u, _ in ops], ordered=True, session=session
+                )
+                applied = result.matched_count == len(ops)
+                if applied:
+                    await db.stock_movements.insert_many([dict(d) for d in movement_docs], session=session)
+                else:
+                    await session.abort_transaction()
+    else:
+        result = await db.products.bulk_write(
+            [UpdateOne(q, {**u, "$push": {"pending_movements": d}}) for q, u, d in ops],
+            ordered=True
+        )
+        applied = result.matched_count == len(ops)
+        if applied:
+            try:
+                await db.stock_movements.insert_many([dict(d) for d in movement_docs], ordered=False)
+            except BulkWriteError as e:
+                if any(err["code"] != 11000 for err in e.details.get("writeErrors", [])):
+                    raise
+            await db.products.update_many(
+                {"user_id": user_id, "product_id": {"$in": product_ids}},
+                {"$pull": {"pending_movements": {"movement_id": {"$in": [d["movement_id"] for d in movement_docs]}}}}
+            )
+        else:
+            await revert_batch_outbox(user_id, movement_docs)
+    
+    if not applied:
+        # Outro terminal alterou o stock entre a validação e a escrita
+        products = await db.products.find(
+            {"user_id": user_id, "product_id": {"$in": product_ids}},
+            {"_id": 0, "product_id": 1, "current_stock": 1, "colors": 1}
+        ).to_list(None)
+        errors = check_batch_stock(items, {p["product_id"]: p for p in products})
+        if not any(errors):
+            errors = ["Stock changed during checkout, please retry"] * len(items)
+        raise batch_error(errors)
+    
+    products_after = await db.products.find(
+        {"user_id": user_id, "product_id": {"$in": product_ids}}, STOCK_RESULT_FIELDS
+    ).to_list(None)
+    for product in products_after:
+        barcode_index.apply_stock(user_id, product)
+    products_after = {p["product_id"]: p for p in products_after}
+    version = await rollup_movements_applied(user_id, movement_docs, products_after)
+    barcode_index.record_write(user_id, version)
+    change_bus.publish_stock(user_id, version, movement_docs, products_after)
+    await record_sales_buckets(user_id, movement_docs, products_after)
+    return movement_docs
+
+# ====== Images ======
+# "filesystem" (IMAGE_DIR) ou "gridfs"; os bytes são guardados uma vez por hash de conteúdo
+IMAGE_STORAGE = os.environ.get('IMAGE_STORAGE', 'filesystem')
+IMAGE_DIR = Path(os.environ.get('IMAGE_DIR', str(ROOT_DIR / 'images')))
+IMAGE_MAX_BYTES = int(os.environ.get('IMAGE_MAX_BYTES', str(5 * 1024 * 1024)))
+IMAGE_THUMBNAIL_SIZE = int(os.environ.get('IMAGE_THUMBNAIL_SIZE', '320'))
+# Limite de píxeis descomprimidos: uma imagem pequena em bytes pode expandir para gigabytes em memória
+IMAGE_MAX_PIXELS = int(os.environ.get('IMAGE_MAX_PIXELS', '50000000'))
+Image.MAX_IMAGE_PIXELS = IMAGE_MAX_PIXELS
+# Prefixo público dos URLs de imagem quando a API não está na mesma origem do frontend
+PUBLIC_BASE_URL = os.environ.get('PUBLIC_BASE_URL', '').rstrip('/')
+IMAGE_URL_PREFIX = "/api/images/"
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+class FilesystemImageStore:
+    def __init__(self, root: Path):
+        self.root = root
+
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+    def _write(self, key: str, data: bytes):
+        path = self._path(key)
+        if path.exists():
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+
+    def _read(self, key: str) -> Optional[bytes]:
+        try:
+            return self._path(key).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    async def put(self, key: str, data: bytes):
+        await asyncio.to_thread(self._write, key, data)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await asyncio.to_thread(self._read, key)
+
+class GridFSImageStore:
+    def __init__(self, database):
+        self.bucket = AsyncIOMotorGridFSBucket(database, bucket_name="images")
+
+    async def put(self, key: str, data: bytes):
+        try:
+            await self.bucket.upload_from_stream_with_id(key, key, data)
+        except FileExists:
+            pass
+
+    async def get(self, key: str) -> Optional[bytes]:
+        try:
+            stream = await self.bucket.open_download_stream(key)
+        except NoFile:
+            return None
+        return await stream.read()
+
+_image_store = None
+
+def get_image_store():
+    global _image_store
+    if _image_store is None:
+        _image_store = GridFSImageStore(db) if IMAGE_STORAGE == "gridfs" else FilesystemImageStore(IMAGE_DIR)
+    return _image_store
+
+def image_url(image_id: str, variant: str = "original") -> str:
+    url = f"{PUBLIC_BASE_URL}{IMAGE_URL_PREFIX}{image_id}"
+    return url if variant == "original" else f"{url}?variant={variant}"
+
+def image_id_from_url(url: str) -> Optional[str]:
+    path = url[len(PUBLIC_BASE_URL):] if PUBLIC_BASE_URL and url.startswith(PUBLIC_BASE_URL) else url
+    if not path.startswith(IMAGE_URL_PREFIX):
+        return None
+    return path[len(IMAGE_URL_PREFIX):].split("?", 1)[0] or None
+
+def decode_data_url(data_url: str) -> bytes:
+    try:
+        _, encoded = data_url.split(",", 1)
+        return base64.b64decode(encoded, validate=True)
+    except (ValueError, binascii.Error):
+        raise HTTPException(status_code=400, detail="Invalid image data")
+
+def _prepare_image(data: bytes) -> dict:
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            img_format = img.format
+            width, height = img.size
+            # Verificado antes de descodificar; o Pillow só recusa a partir do dobro do limite
+            if width * height > IMAGE_MAX_PIXELS:
+                raise HTTPException(status_code=400, detail="Image dimensions too large")
+            img.thumbnail((IMAGE_THUMBNAIL_SIZE, IMAGE_THUMBNAIL_SIZE))
+            thumbnail = io.BytesIO()
+            img.convert("RGBA" if img.mode in ("RGBA", "LA", "P") else "RGB").save(thumbnail, "WEBP", quality=80)
+    except Image.DecompressionBombError:
+        raise HTTPException(status_code=400, detail="Image dimensions too large")
+    except (UnidentifiedImageError, OSError):
+        raise HTTPException(status_code=400, detail="Unsupported image format")
+    return {
+        "content_type": Image.MIME.get(img_format, "application/octet-stream"),
+        "width": width,
+        "height": height,
+        "thumbnail": thumbnail.getvalue(),
+    }
+
+async def store_image(data: bytes) -> dict:
+    if len(data) > IMAGE_MAX_BYTES:
+        raise HTTPException(status_code=413, detail="Image too large")
+    image_id = hashlib.sha256(data).hexdigest()
+    existing = await db.images.find_one({"image_id": image_id}, {"_id": 0})
+    if not existing:
+        prepared = await asyncio.to_thread(_prepare_image, data)
+        store = get_image_store()
+        await store.put(image_id, data)
+        await store.put(f"{image_id}_thumb", prepared["thumbnail"])
+        await db.images.update_one(
+            {"image_id": image_id},
+            {"$setOnInsert": {
+                "image_id": image_id,
+                "content_type": prepared["content_type"],
+                "thumbnail_content_type": "image/webp",
+                "bytes": len(data),
+                "width": prepared["width"],
+                "height": prepared["height"],
+                "created_at": datetime.now(timezone.utc)
+            }},
+            upsert=True
+        )
+    return {
+        "image_id": image_id,
+        "url": image_url(image_id),
+        "thumbnail_url": image_url(image_id, "thumb")
+    }
+
+async def resolve_product_image(image: Optional[str]):
+    # Devolve (image, thumbnail) a guardar no produto; data URLs passam para o blob store
+    if not image:
+        return None, None
+    if image.startswith("data:"):
+        stored = await store_image(decode_data_url(image))
+        return stored["url"], stored["thumbnail_url"]
+    image_id = image_id_from_url(image)
+    if image_id:
+        return image_url(image_id), image_url(image_id, "thumb")
+    return image, None
+
+async def migrate_embedded_images() -> int:
+    migrated = 0
+    cursor = db.products.find(
+        {"image": {"$regex": "^data:"}},
+        {"_id": 0, "product_id": 1, "user_id": 1, "image": 1}
+    ).batch_size(50)
+    async for product in cursor:
+        try:
+            image, thumbnail = await resolve_product_image(product["image"])
+        except HTTPException as e:
+            logger.warning(f"Skipping image of {product['product_id']}: {e.detail}")
+            continue
+        await db.products.update_one(
+            {"product_id": product["product_id"], "user_id": product["user_id"]},
+            {"$set": {"image": image, "thumbnail": thumbnail, "change_seq": change_sequence.next()}}
+        )
+        await update_rollup(product["user_id"], {})  # invalida ETags
+        migrated += 1
+    return migrated
+
+# ====== Outbound HTTP ======
+HTTP_MAX_CONNECTIONS = int(os.environ.get('HTTP_MAX_CONNECTIONS', '100'))
+HTTP_MAX_KEEPALIVE = int(os.environ.get('HTTP_MAX_KEEPALIVE', '20'))
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get('HTTP_KEEPALIVE_EXPIRY', '30'))
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', '2'))
+HTTP_BACKOFF_SECONDS = float(os.environ.get('HTTP_BACKOFF_SECONDS', '0.2'))
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', '5'))
+CIRCUIT_RESET_SECONDS = float(os.environ.get('CIRCUIT_RESET_SECONDS', '30'))
+# HTTP/2 só é activado se o pacote h2 estiver instalado
+try:
+    import h2  # noqa: F401
+    HTTP2_ENABLED = os.environ.get('HTTP2_ENABLED', '1') == '1'
+except ImportError:
+    HTTP2_ENABLED = False
+
+DEFAULT_HTTP_TIMEOUT = httpx.Timeout(10.0, connect=5.0)
+HTTP_TIMEOUTS = {
+    "demobackend.emergentagent.com": httpx.Timeout(10.0, connect=3.0),
+    "api.exchangerate-api.com": httpx.Timeout(8.0, connect=3.0),
+}
+
+class CircuitOpenError(Exception):
+    pass
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        # Em half-open só passa um pedido de teste; os outros falham já até ele terminar.
+        # Um sucesso fecha o circuito, uma falha volta a abri-lo
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "open" or self.probing:
+            return False
+        self.probing = True
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.probing = False
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+class OutboundHTTP:
+    # Cliente httpx único para a aplicação, com retry, circuit breaker e métricas por host
+    def __init__(self):
+        self.client: Optional[httpx.AsyncClient] = None
+        self.breakers = {}
+        self.host_stats = {}
+
+    async def start(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                http2=HTTP2_ENABLED,
+                timeout=DEFAULT_HTTP_TIMEOUT,
+                limits=httpx.Limits(
+                    max_connections=HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+                )
+            )
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def _stats(self, host: str) -> dict:
+        if host not in self.host_stats:
+            self.host_stats[host] = {
+                "requests": 0, "failures": 0, "retries": 0,
+                "circuit_rejections": 0, "in_flight": 0, "max_in_flight": 0
+            }
+        return self.host_stats[host]
+
+    def _breaker(self, host: str) -> CircuitBreaker:
+        if host not in self.breakers:
+            self.breakers[host] = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS)
+        return self.breakers[host]
+
+    async def get(self, url: str, headers: Optional[dict] = None, retries: int = HTTP_RETRIES) -> httpx.Response:
+        await self.start()
+        host = httpx.URL(url).host
+        stats = self._stats(host)
+        breaker = self._breaker(host)
+        probe = breaker.state == "half-open"
+        if not breaker.allow():
+            stats["circuit_rejections"] += 1
+            raise CircuitOpenError(f"Circuit open for {host}")
+        
+        stats["requests"] += 1
+        stats["in_flight"] += 1
+        stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+        started = time.perf_counter()
+        try:
+            for attempt in range(retries + 1):
+                try:
+                    res = await self.client.get(url, headers=headers, timeout=HTTP_TIMEOUTS.get(host, DEFAULT_HTTP_TIMEOUT))
+                    retryable = res.status_code >= 500 or res.status_code == 429
+                except httpx.TransportError:
+                    if attempt == retries:
+                        stats["failures"] += 1
+                        breaker.record_failure()
+                        raise
+                    res, retryable = None, True
+                if not retryable or attempt == retries:
+                    if retryable:
+                        stats["failures"] += 1
+                        breaker.record_failure()
+                    else:
+                        breaker.record_success()
+                    return res
+                stats["retries"] += 1
+                # Backoff exponencial com jitter para não sincronizar as tentativas dos workers
+                await asyncio.sleep(HTTP_BACKOFF_SECONDS * (2 ** attempt) * random.uniform(0.5, 1.5))
+        finally:
+            if probe:
+                # Teste interrompido sem resultado (ex.: cancelado): o próximo pedido volta a testar
+                breaker.probing = False
+            stats["in_flight"] -= 1
+            metrics = current_request_metrics.get()
+            if metrics is not None:
+                metrics.upstream_calls += 1
+                metrics.upstream_seconds += time.perf_counter() - started
+
+    def pool_stats(self) -> dict:
+        # O httpcore não expõe o pool publicamente; lido de forma defensiva
+        connections = []
+        if self.client is not None:
+            pool = getattr(getattr(self.client, "_transport", None), "_pool", None)
+            connections = list(getattr(pool, "connections", []))
+        idle = sum(1 for c in connections if getattr(c, "is_idle", lambda: False)())
+        return {
+            "http2": HTTP2_ENABLED,
+            "max_connections": HTTP_MAX_CONNECTIONS,
+            "max_keepalive_connections": HTTP_MAX_KEEPALIVE,
+            "open_connections": len(connections),
+            "idle_connections": idle,
+            "utilisation": (len(connections) - idle) / HTTP_MAX_CONNECTIONS if HTTP_MAX_CONNECTIONS else 0.0,
+            "hosts": {
+                host: {**stats, "circuit": self._breaker(host).state}
+                for host, stats in self.host_stats.items()
+            },
+        }
+
+outbound_http = OutboundHTTP()
+
+# ====== Exchange Rates ======
+RATES_PROVIDER = os.environ.get('RATES_PROVIDER', 'exchangerate-api')
+RATES_STATIC_FILE = os.environ.get('RATES_STATIC_FILE', '')
+RATES_TTL_SECONDS = float(os.environ.get('RATES_TTL_SECONDS', '3600'))
+RATES_REFRESH_AHEAD_SECONDS = float(os.environ.get('RATES_REFRESH_AHEAD_SECONDS', '300'))
+RATES_REFRESH_INTERVAL_SECONDS = float(os.environ.get('RATES_REFRESH_INTERVAL_SECONDS', '60'))
+
+class RatesUnavailable(Exception):
+    pass
+
+class ExchangeRateApiProvider:
+    async def fetch(self, base: str) -> dict:
+        res = await outbound_http.get(f"https://api.exchangerate-api.com/v4/latest/{base}")
+        res.raise_for_status()
+        return res.json()
+
+class StaticRateProvider:
+    # Tabelas locais (ficheiro JSON {"MZN": {"USD": 0.0157, ...}}) para testes e desenvolvimento offline
+    def __init__(self, tables: dict):
+        self.tables = tables
+
+    @classmethod
+    def from_file(cls, path: str) -> "StaticRateProvider":
+        with open(path) as f:
+            return cls(json.load(f))
+
+    async def fetch(self, base: str) -> dict:
+        if base not in self.tables:
+            raise RatesUnavailable(f"No static rates for {base}")
+        return {"base": base, "rates": {base: 1, **self.tables[base]}}
+
+class RateService:
+    # Guarda em memória a tabela completa de cada moeda base; pedidos concorrentes partilham uma só chamada
+    def __init__(self, provider, ttl: float, refresh_ahead: float):
+        self.provider = provider
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self._tables = {}  # base -> {"data": dict, "expires_at": datetime}
+        self._inflight = {}  # base -> asyncio.Task
+        self.upstream_fetches = 0
+
+    def _is_fresh(self, entry: Optional[dict], margin: float = 0) -> bool:
+        return bool(entry) and entry["expires_at"] - timedelta(seconds=margin) > datetime.now(timezone.utc)
+
+    async def get_table(self, base: str) -> dict:
+        base = base.upper()
+        entry = self._tables.get(base)
+        if self._is_fresh(entry):
+            if not self._is_fresh(entry, self.refresh_ahead):
+                self._refresh(base)
+            return entry["data"]
+        
+        if entry is None:
+            entry = await self._load_persisted(base)
+            if self._is_fresh(entry):
+                self._tables[base] = entry
+                return entry["data"]
+        
+        try:
+            return await self._refresh(base)
+        except Exception as e:
+            if entry:
+                logger.warning(f"Using expired rates for {base} due to error: {e}")
+                return entry["data"]
+            raise RatesUnavailable(str(e))
+
+    def _refresh(self, base: str) -> "asyncio.Task":
+        task = self._inflight.get(base)
+        if task is None:
+            task = asyncio.create_task(self._fetch_and_store(base))
+            self._inflight[base] = task
+            task.add_done_callback(lambda t: self._on_refresh_done(base, t))
+        return task
+
+    def _on_refresh_done(self, base: str, task: "asyncio.Task"):
+        self._inflight.pop(base, None)
+        if not task.cancelled() and task.exception():
+            logger.warning(f"Exchange rate refresh for {base} failed: {task.exception()}")
+
+    async def _fetch_and_store(self, base: str) -> dict:
+        self.upstream_fetches += 1
+        data = await self.provider.fetch(base)
+        if not data.get("rates"):
+            raise RatesUnavailable(f"Empty rate table for {base}")
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=self.ttl)
+        self._tables[base] = {"data": data, "expires_at": expires_at}
+        await db.rates_cache.update_one(
+            {"cache_key": f"table_{base}"},
+            {"$set": {"cache_key": f"table_{base}", "data": data, "expires_at": expires_at}},
+            upsert=True
+        )
+        return data
+
+    async def _load_persisted(self, base: str) -> Optional[dict]:
+        cached = await db.rates_cache.find_one({"cache_key": f"table_{base}"}, {"_id": 0})
+        if not cached or not cached.get("data"):
+            return None
+        expires_at = cached["expires_at"]
+        if expires_at.tzinfo is None:
+            expires_at = expires_at.replace(tzinfo=timezone.utc)
+        return {"data": cached["data"], "expires_at": expires_at}
+
+    async def get_rate(self, from_currency: str, to_currency: str) -> Optional[float]:
+        table = await self.get_table(from_currency)
+        return table["rates"].get(to_currency.upper())
+
+    async def refresh_loop(self):
+        # Renova as tabelas já carregadas antes de expirarem
+        while True:
+            await asyncio.sleep(RATES_REFRESH_INTERVAL_SECONDS)
+            for base, entry in list(self._tables.items()):
+                if not self._is_fresh(entry, self.refresh_ahead + RATES_REFRESH_INTERVAL_SECONDS):
+                    self._refresh(base)
+
+    def stats(self) -> dict:
+        return {
+            "provider": type(self.provider).__name__,
+            "bases": {
+                base: entry["expires_at"].isoformat() for base, entry in self._tables.items()
+            },
+            "inflight": sorted(self._inflight),
+            "upstream_fetches": self.upstream_fetches,
+        }
+
+def build_rate_provider():
+    if RATES_PROVIDER == "static":
+        return StaticRateProvider.from_file(RATES_STATIC_FILE) if RATES_STATIC_FILE else StaticRateProvider({})
+    return ExchangeRateApiProvider()
+
+rate_service = RateService(build_rate_provider(), RATES_TTL_SECONDS, RATES_REFRESH_AHEAD_SECONDS)
+
+# ====== Import / Export ======
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', '1000'))
+IMPORT_MAX_ERRORS = int(os.environ.get('IMPORT_MAX_ERRORS', '1000'))
+PRODUCT_CSV_COLUMNS = ["product_id", "name", "barcode", "current_stock", "purchase_price", "sale_price", "currency", "colors", "reorder_threshold", "image", "created_at"]
+MOVEMENT_CSV_COLUMNS = ["movement_id", "product_id", "type", "quantity", "color", "date", "note", "unit_cost", "unit_price"]
+
+def format_colors(colors: List[dict]) -> str:
+    return ";".join(f"{c['color']}:{c['quantity']}" for c in colors)
+
+def parse_colors(value: str) -> List[dict]:
+    colors = []
+    for item in filter(None, (part.strip() for part in value.split(";"))):
+        color, _, quantity = item.rpartition(":")
+        if not color:
+            raise ValueError(f"Invalid color entry '{item}', expected color:quantity")
+        colors.append({"color": color, "quantity": int(quantity)})
+    return colors
+
+def detect_format(format: Optional[str], filename: Optional[str]) -> str:
+    if format:
+        return format
+    if filename and filename.lower().endswith((".ndjson", ".jsonl")):
+        return "ndjson"
+    return "csv"
+
+def iter_import_rows(file, format: str):
+    # Iterador síncrono sobre o ficheiro temporário do upload; consumido em lotes numa thread
+    text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+    if format == "ndjson":
+        for line in text:
+            if line.strip():
+                yield line
+    else:
+        yield from csv.DictReader(text)
+
+def parse_import_row(raw, format: str) -> ProductCreate:
+    if format == "ndjson":
+        return ProductCreate(**json.loads(raw))
+    row = {k.strip(): (v or "").strip() for k, v in raw.items() if k}
+    data = {
+        "name": row.get("name", ""),
+        "barcode": row.get("barcode", ""),
+        "purchase_price": row.get("purchase_price") or 0,
+        "sale_price": row.get("sale_price") or 0,
+        "currency": row.get("currency") or "MZN",
+        "image": row.get("image") or None,
+        "colors": parse_colors(row.get("colors", "")),
+    }
+    if "reorder_threshold" in row:
+        data["reorder_threshold"] = row["reorder_threshold"] or None
+    return ProductCreate(**data)
+
+async def import_products(user_id: str, file, format: str, update_existing: bool) -> dict:
+    report = {"processed": 0, "created": 0, "updated": 0, "skipped": 0, "errors": [], "errors_truncated": 0}
+    
+    def add_error(row_number: int, barcode: Optional[str], error: str):
+        if len(report["errors"]) < IMPORT_MAX_ERRORS:
+            report["errors"].append({"row": row_number, "barcode": barcode, "error": error})
+        else:
+            report["errors_truncated"] += 1
+    
+    rows = iter_import_rows(file, format)
+    row_number = 0
+    while True:
+        batch = await asyncio.to_thread(lambda: list(itertools.islice(rows, IMPORT_BATCH_SIZE)))
+        if not batch:
+            break
+        
+        parsed = {}  # barcode -> (row_number, ProductCreate); a última linha do ficheiro prevalece
+        for raw in batch:
+            row_number += 1
+            report["processed"] += 1
+            try:
+                product = parse_import_row(raw, format)
+            except ValidationError as e:
+                add_error(row_number, None, "; ".join(
+                    f"{'.'.join(str(part) for part in err['loc'])}: {err['msg']}" for err in e.errors()
+                ))
+                continue
+            except (ValueError, TypeError) as e:
+                add_error(row_number, None, str(e))
+                continue
+            if product.barcode in parsed:
+                report["skipped"] += 1
+                add_error(parsed[product.barcode][0], product.barcode, "Duplicate barcode in file, later row used")
+            parsed[product.barcode] = (row_number, product)
+        if not parsed:
+            continue
+        
+        existing = {
+            p["barcode"]: p
+            async for p in db.products.find(
+                {"user_id": user_id, "barcode": {"$in": list(parsed)}},
+                {**STOCK_RESULT_FIELDS, "barcode": 1}
+            )
+        }
+        
+        ops, rollup_inc = [], {}
+        creates = {}  # _id atribuído pelo upsert -> (linha, barcode, valores do rollup)
+        for barcode, (number, product) in parsed.items():
+            if barcode in existing and not update_existing:
+                report["skipped"] += 1
+                add_error(number, barcode, "Product with this barcode already exists")
+                continue
+            try:
+                image, thumbnail = await resolve_product_image(product.image)
+            except HTTPException as e:
+                add_error(number, barcode, e.detail)
+                continue
+            fields = {
+                "name": product.name,
+                "purchase_price": product.purchase_price,
+                "sale_price": product.sale_price,
+                "currency": product.currency,
+                "image": image,
+                "thumbnail": thumbnail,
+                "colors": color_docs(product.colors),
+                "current_stock": sum(c.quantity for c in product.colors),
+                "change_seq": change_sequence.next(),
+                **product_search_fields(product.name, barcode),
+            }
+            # Ficheiros sem a coluna não apagam o limiar já definido
+            if "reorder_threshold" in product.model_fields_set:
+                fields["reorder_threshold"] = product.reorder_threshold
+            new_values = product_rollup_values(fields)
+            if barcode in existing:
+                old_values = product_rollup_values(existing[barcode])
+                new_values = {k: new_values[k] - old_values[k] for k in ("total_stock_value", "total_potential_revenue")}
+                report["updated"] += 1
+                ops.append(UpdateOne(
+                    {"user_id": user_id, "barcode": barcode},
+                    set_low_stock({"$set": fields}, {**existing[barcode], **fields})
+                ))
+                for k, v in new_values.items():
+                    rollup_inc[k] = rollup_inc.get(k, 0) + v
+            else:
+                product_id = f"prod_{uuid.uuid4().hex[:12]}"
+                severity = low_stock_severity(fields)
+                if severity is not None:
+                    fields["low_stock_severity"] = severity
+                object_id = ObjectId()
+                creates[object_id] = (number, barcode, new_values)
+                # Upsert por (user_id, barcode): se outro pedido criou o produto entretanto, não duplica
+                ops.append(UpdateOne(
+                    {"user_id": user_id, "barcode": barcode},
+                    {"$setOnInsert": {
+                        **fields,
+                        "_id": object_id,
+                        "product_id": product_id,
+                        "barcode": barcode,
+                        "user_id": user_id,
+                        "created_at": datetime.now(timezone.utc)
+                    }},
+                    upsert=True
+                ))
+        
+        if ops:
+            try:
+                upserted = set((await db.products.bulk_write(ops, ordered=False)).upserted_ids.values())
+            except BulkWriteError as e:
+                # Dois upserts simultâneos do mesmo código: o que perdeu conta como já existente
+                if any(err["code"] != 11000 for err in e.details.get("writeErrors", [])):
+                    raise
+                upserted = {u["_id"] for u in e.details.get("upserted", [])}
+            # Só conta como criado o que o upsert inseriu (com o _id escolhido aqui);
+            # um produto criado entretanto fica intacto
+            for object_id, (number, barcode, new_values) in creates.items():
+                if object_id not in upserted:
+                    report["skipped"] += 1
+                    add_error(number, barcode, "Product with this barcode already exists")
+                    continue
+                report["created"] += 1
+                for k, v in new_values.items():
+                    rollup_inc[k] = rollup_inc.get(k, 0) + v
+            await update_rollup(user_id, rollup_inc)
+    
+    if report["created"] or report["updated"]:
+        barcode_index.invalidate(user_id)
+        change_bus.publish(user_id, {"type": "resync"})
+    return report
+
+async def stream_csv(cursor, columns: List[str], to_row):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    async for doc in cursor:
+        writer.writerow(to_row(doc))
+        if buffer.tell() > 64 * 1024:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+async def stream_ndjson(cursor):
+    async for doc in cursor:
+        yield json.dumps(jsonable_encoder(doc), ensure_ascii=False) + "\n"
+
+def export_response(cursor, format: str, name: str, columns: List[str], to_row) -> StreamingResponse:
+    if format == "ndjson":
+        body, media_type, extension = stream_ndjson(cursor), "application/x-ndjson", "ndjson"
+    else:
+        body, media_type, extension = stream_csv(cursor, columns, to_row), "text/csv; charset=utf-8", "csv"
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{name}.{extension}"'}
+    )
+
+# ====== JSON Responses ======
+# orjson e brotli são opcionais: sem eles fica o encoder normal e só gzip
+try:
+    import orjson
+    FAST_JSON_ENABLED = os.environ.get('FAST_JSON_RESPONSES', '0') == '1'
+except ImportError:
+    orjson = None
+    FAST_JSON_ENABLED = False
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', '1024'))
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/csv", "text/plain")
+
+def json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+class PlainJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return json.dumps(
+            content, ensure_ascii=False, allow_nan=False, separators=(",", ":"), default=json_default
+        ).encode("utf-8")
+
+class ORJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        # datetimes sem fuso saem como no Pydantic (ISO 8601, sem sufixo)
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+def model_projection(model) -> dict:
+    return {"_id": 0, **{name: 1 for name in model.model_fields}}
+
+def model_defaults(model) -> dict:
+    return {
+        name: field.get_default(call_default_factory=True)
+        for name, field in model.model_fields.items() if not field.is_required()
+    }
+
+PRODUCT_PROJECTION = model_projection(Product)
+PRODUCT_DEFAULTS = model_defaults(Product)
+MOVEMENT_PROJECTION = model_projection(StockMovement)
+MOVEMENT_DEFAULTS = model_defaults(StockMovement)
+COLOR_DEFAULTS = model_defaults(ColorVariant)
+# Exportações: só os campos do modelo (sem chaves de pesquisa, sequências de sync nem o dono)
+PRODUCT_EXPORT_PROJECTION = {k: v for k, v in PRODUCT_PROJECTION.items() if k not in ("thumbnail", "user_id")}
+MOVEMENT_EXPORT_PROJECTION = {k: v for k, v in MOVEMENT_PROJECTION.items() if k != "user_id"}
+
+def fast_json_response(content, headers: Optional[dict] = None) -> Response:
+    if FAST_JSON_ENABLED:
+        return ORJSONResponse(content=content, headers=headers)
+    return PlainJSONResponse(content=content, headers=headers)
+
+def list_response(items: List[dict], response: Response, defaults: Optional[dict] = None) -> Response:
+    # Documentos já projectados nos campos do modelo: serializa sem revalidar
+    if defaults:
+        items = [{**defaults, **item} for item in items]
+        # As cores também saem com os campos por omissão, como na resposta validada
+        for item in items:
+            if item.get("colors"):
+                item["colors"] = [{**COLOR_DEFAULTS, **c} for c in item["colors"]]
+    return fast_json_response(items, dict(response.headers))
+
+class GzipCompressor:
+    def __init__(self):
+        self._zlib = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    def process(self, data: bytes) -> bytes:
+        return self._zlib.compress(data)
+
+    def finish(self) -> bytes:
+        return self._zlib.flush()
+
+class BrotliCompressor:
+    def __init__(self):
+        self._brotli = brotli.Compressor(quality=4)
+
+    def process(self, data: bytes) -> bytes:
+        return self._brotli.process(data)
+
+    def finish(self) -> bytes:
+        return self._brotli.finish()
+
+class CompressionMiddleware:
+    """Comprime respostas JSON/CSV grandes com brotli (se instalado) ou gzip."""
+
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        accepted = Headers(scope=scope).get("accept-encoding", "")
+        if brotli is not None and "br" in accepted:
+            encoding, compressor_class = "br", BrotliCompressor
+        elif "gzip" in accepted:
+            encoding, compressor_class = "gzip", GzipCompressor
+        else:
+            await self.app(scope, receive, send)
+            return
+        
+        state = {"start": None, "compressor": None}
+
+        async def send_compressed(message):
+            if message["type"] == "http.response.start":
+                state["start"] = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            start = state["start"]
+            if start is not None:
+                state["start"] = None
+                headers = MutableHeaders(raw=start["headers"])
+                if (
+                    "content-encoding" in headers
+                    or not headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES)
+                    or (not more_body and len(body) < self.minimum_size)
+                ):
+                    await send(start)
+                    await send(message)
+                    return
+                state["compressor"] = compressor_class()
+                headers["Content-Encoding"] = encoding
+                headers.add_vary_header("Accept-Encoding")
+                if "content-length" in headers:
+                    del headers["content-length"]
+                data = state["compressor"].process(body)
+                if not more_body:
+                    data += state["compressor"].finish()
+                    headers["Content-Length"] = str(len(data))
+                await send(start)
+                await send({"type": "http.response.body", "body": data, "more_body": more_body})
+                return
+            compressor = state["compressor"]
+            if compressor is None:
+                await send(message)
+                return
+            data = compressor.process(body)
+            if not more_body:
+                data += compressor.finish()
+            await send({"type": "http.response.body", "body": data, "more_body": more_body})
+
+        await self.app(scope, receive, send_compressed)
+
+# ====== Pagination ======
+# As listas continuam a ser arrays; o cursor seguinte e o total seguem nos cabeçalhos
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', '1000'))
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+TOTAL_COUNT_HEADER = "X-Total-Count"
+
+def encode_cursor(sort_value: datetime, item_id: str) -> str:
+    raw = json.dumps([sort_value.isoformat(), item_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        sort_value, item_id = json.loads(raw)
+        return datetime.fromisoformat(sort_value), str(item_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
-    @field_validator('type')
-    def validate_type(cls, v):
-        if v not in ['entrada', 'saida']:
-            raise ValueError('Type must be entrada or saida')
-        return v
+def encode_offset_cursor(offset: int) -> str:
+    return base64.urlsafe_b64encode(str(offset).encode()).decode().rstrip("=")
 
-class ConversionRequest(BaseModel):
-    amount: float
-    from_currency: str
-    to_currency: str
+def decode_offset_cursor(cursor: str) -> int:
+    try:
+        offset = int(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (binascii.Error, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if offset < 0:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return offset
 
-# ====== Auth Helper ======
-async def get_current_user(request: Request) -> User:
-    # REMINDER: DO NOT HARDCODE THE URL, OR ADD ANY FALLBACKS OR REDIRECT URLS, THIS BREAKS THE AUTH
-    session_token = request.cookies.get("session_token")
-    if not session_token:
-        auth_header = request.headers.get("Authorization")
-        if auth_header and auth_header.startswith("Bearer "):
-            session_token = auth_header.replace("Bearer ", "")
-    
-    if not session_token:
-        raise HTTPException(status_code=401, detail="Not authenticated")
+def keyset_filter(cursor: str, sort_field: str, id_field: str, descending: bool) -> dict:
+    sort_value, item_id = decode_cursor(cursor)
+    op = "$lt" if descending else "$gt"
+    return {"$or": [
+        {sort_field: {op: sort_value}},
+        {sort_field: sort_value, id_field: {op: item_id}}
+    ]}
+
+async def fetch_page(collection, query: dict, projection: dict, sort_field: str, id_field: str,
+                     descending: bool, limit: int, cursor: Optional[str], include_total: bool,
+                     response: Response) -> List[dict]:
+    page_query = query
+    if cursor:
+        page_query = {"$and": [query, keyset_filter(cursor, sort_field, id_field, descending)]}
+    direction = DESCENDING if descending else ASCENDING
     
-    session = await db.user_sessions.find_one({"session_token": session_token}, {"_id": 0})
-    if not session:
-        raise HTTPException(status_code=401, detail="Invalid session")
+    find = collection.find(page_query, projection).sort([(sort_field, direction), (id_field, direction)])
+    items = await find.limit(limit + 1).to_list(limit + 1)
+    if include_total:
+        response.headers[TOTAL_COUNT_HEADER] = str(await collection.count_documents(query))
+    if len(items) > limit:
+        items = items[:limit]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(items[-1][sort_field], items[-1][id_field])
+    return items
+
+# ====== Conditional GET ======
+# O ETag deriva de report_rollups.version, incrementado por todas as escritas do utilizador
+async def data_version(user_id: str) -> int:
+    rollup = await db.report_rollups.find_one({"user_id": user_id}, {"_id": 0, "version": 1})
+    return rollup.get("version", 0) if rollup else 0
+
+def make_etag(request: Request, user_id: str, version: int) -> str:
+    key = f"{user_id}:{version}:{request.url.path}?{request.url.query}"
+    return f'W/"{version}-{hashlib.sha1(key.encode()).hexdigest()[:16]}"'
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    # Comparação fraca: ignora o prefixo W/ (proxies que comprimem podem alterá-lo)
+    tags = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+    return etag.removeprefix("W/") in tags
+
+def conditional_response(request: Request, response: Response, user_id: str, version: int) -> Optional[Response]:
+    # Devolve um 304 se o cliente já tem esta versão; senão anota o ETag na resposta
+    etag = make_etag(request, user_id, version)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
+
+# ====== Sync ======
+# Os dispositivos guardam um token opaco com a última change_seq vista. Como a sequência é
+# gerada por processo, um pull repete os últimos SYNC_OVERLAP_SECONDS para apanhar escritas
+# lentas ou de outro worker; os clientes aplicam as alterações por id, por isso repetir é inofensivo.
+SYNC_PAGE_SIZE = int(os.environ.get('SYNC_PAGE_SIZE', '500'))
+SYNC_OVERLAP_SECONDS = float(os.environ.get('SYNC_OVERLAP_SECONDS', '10'))
+SYNC_PRODUCT_PROJECTION = {**PRODUCT_PROJECTION, "change_seq": 1}
+SYNC_MOVEMENT_PROJECTION = {**MOVEMENT_PROJECTION, "change_seq": 1}
+
+async def record_product_deleted(user_id: str, product_id: str):
+    # Tombstone para que os dispositivos saibam que o produto foi apagado
+    await db.deleted_products.insert_one({
+        "user_id": user_id,
+        "product_id": product_id,
+        "change_seq": change_sequence.next(),
+        "deleted_at": datetime.now(timezone.utc)
+    })
+
+def encode_sync_token(seq: int, exact: bool, last_id: Optional[ObjectId] = None) -> str:
+    # Um token exacto continua uma página cortada logo a seguir a (seq, last_id)
+    token = {"s": seq, "x": int(exact)}
+    if last_id is not None:
+        token["i"] = str(last_id)
+    raw = json.dumps(token).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_sync_token(token: str):
+    try:
+        raw = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        last_id = ObjectId(raw["i"]) if "i" in raw else None
+        return int(raw["s"]), bool(raw["x"]), last_id
+    except (binascii.Error, ValueError, KeyError, TypeError, InvalidId):
+        raise HTTPException(status_code=400, detail="Invalid sync token")
+
+def sync_key(doc: dict) -> tuple:
+    return doc["change_seq"], doc["_id"]
+
+async def sync_changes(user_id: str, since: Optional[str], limit: int) -> dict:
+    started_seq = change_sequence.next()
+    # Sem token (ou vazio) é uma sincronização completa
+    reset = not since
+    after = {"change_seq": {"$gt": -1}}
+    if not reset:
+        seq, exact, last_id = decode_sync_token(since)
+        if exact and last_id is not None:
+            # Continuação de uma página cortada: a posição é exacta, por isso não há nada
+            # a perder com a idade do token (uma sincronização completa pode ir em seq 0)
+            after = {"$or": [{"change_seq": {"$gt": seq}}, {"change_seq": seq, "_id": {"$gt": last_id}}]}
+        else:
+            # Mais antigo que os tombstones: já não sabemos o que foi apagado
+            reset = seq < started_seq - SYNC_TOMBSTONE_DAYS * 86400 * 1_000_000
+            if not reset:
+                floor = seq if exact else seq - int(SYNC_OVERLAP_SECONDS * 1_000_000)
+                after = {"change_seq": {"$gt": floor}}
     
-    expires_at = session["expires_at"]
-    if isinstance(expires_at, str):
-        expires_at = datetime.fromisoformat(expires_at)
-    if expires_at.tzinfo is None:
-        expires_at = expires_at.replace(tzinfo=timezone.utc)
-    if expires_at < datetime.now(timezone.utc):
-        raise HTTPException(status_code=401, detail="Session expired")
+    sources = [("products", db.products, SYNC_PRODUCT_PROJECTION),
+               ("movements", db.stock_movements, SYNC_MOVEMENT_PROJECTION)]
+    if not reset:
+        sources.append(("deleted", db.deleted_products, {"product_id": 1, "change_seq": 1}))
+    changes = {}
+    for name, collection, projection in sources:
+        changes[name] = await collection.find(
+            {"user_id": user_id, **after}, {**projection, "_id": 1}
+        ).sort([("change_seq", ASCENDING), ("_id", ASCENDING)]).limit(limit + 1).to_list(limit + 1)
     
-    user_doc = await db.users.find_one({"user_id": session["user_id"]}, {"_id": 0})
-    if not user_doc:
-        raise HTTPException(status_code=404, detail="User not found")
+    # A página leva as primeiras `limit` alterações de todas as listas juntas; cada lista foi lida
+    # por ordem até limit + 1, por isso nenhuma alteração até ao corte ficou por ler
+    merged = sorted((sync_key(d) for docs in changes.values() for d in docs))
+    cut = merged[limit - 1] if len(merged) > limit else None
+    if cut is not None:
+        changes = {name: [d for d in docs if sync_key(d) <= cut] for name, docs in changes.items()}
+        next_token = encode_sync_token(cut[0], exact=True, last_id=cut[1])
+    else:
+        seen = merged[-1][0] if merged else 0
+        next_token = encode_sync_token(max(seen, started_seq), exact=False)
+    for docs in changes.values():
+        for d in docs:
+            d.pop("_id")
     
-    return User(**user_doc)
+    return {
+        "reset": reset,
+        "products": [{**PRODUCT_DEFAULTS, **p} for p in changes["products"]],
+        "movements": [{**MOVEMENT_DEFAULTS, **m} for m in changes["movements"]],
+        "deleted_product_ids": [d["product_id"] for d in changes.get("deleted", [])],
+        "next": next_token,
+        "has_more": cut is not None
+    }
+
+async def backfill_sync_sequences(user_id: Optional[str] = None) -> int:
+    # Documentos anteriores à sincronização ficam com sequência 0 (entram nas sincronizações completas)
+    query = {"change_seq": {"$exists": False}}
+    if user_id:
+        query["user_id"] = user_id
+    updated = 0
+    for collection in (db.products, db.stock_movements):
+        updated += (await collection.update_many(query, {"$set": {"change_seq": 0}})).modified_count
+    return updated
 
 # ====== Auth Endpoints ======
 @api_router.post("/auth/session")
@@ -129,39 +2893,45 @@ async def create_session(request: Request, response: Response):
     if not session_id:
         raise HTTPException(status_code=400, detail="session_id required")
     
-    async with httpx.AsyncClient() as http_client:
-        try:
-            res = await http_client.get(
-                "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data",
-                headers={"X-Session-ID": session_id},
-                timeout=10.0
-            )
-            res.raise_for_status()
-            data = res.json()
-        except Exception as e:
-            raise HTTPException(status_code=400, detail=f"Failed to fetch session data: {str(e)}")
+    try:
+        res = await outbound_http.get(
+            "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data",
+            headers={"X-Session-ID": session_id}
+        )
+        res.raise_for_status()
+        data = res.json()
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Failed to fetch session data: {str(e)}")
     
-    user_id = f"user_{uuid.uuid4().hex[:12]}"
     session_token = data["session_token"]
     
-    existing_user = await db.users.find_one({"email": data["email"]}, {"_id": 0})
-    if existing_user:
-        user_id = existing_user["user_id"]
-    else:
-        await db.users.insert_one({
-            "user_id": user_id,
-            "email": data["email"],
-            "name": data["name"],
-            "picture": data.get("picture"),
-            "created_at": datetime.now(timezone.utc)
-        })
-    
-    await db.user_sessions.insert_one({
-        "user_id": user_id,
-        "session_token": session_token,
-        "expires_at": datetime.now(timezone.utc) + timedelta(days=7),
+    # Upserts: dois primeiros logins em simultâneo ou um token repetido não violam os índices únicos
+    new_user = {
+        "user_id": f"user_{uuid.uuid4().hex[:12]}",
+        "email": data["email"],
+        "name": data["name"],
+        "picture": data.get("picture"),
         "created_at": datetime.now(timezone.utc)
-    })
+    }
+    try:
+        user_doc = await db.users.find_one_and_update(
+            {"email": data["email"]}, {"$setOnInsert": new_user},
+            projection={"_id": 0}, upsert=True, return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # O outro pedido inseriu primeiro
+        user_doc = await db.users.find_one({"email": data["email"]}, {"_id": 0})
+    user_id = user_doc["user_id"]
+    
+    await db.user_sessions.update_one(
+        {"session_token": session_token},
+        {
+            "$set": {"user_id": user_id, "expires_at": datetime.now(timezone.utc) + timedelta(days=7)},
+            "$setOnInsert": {"created_at": datetime.now(timezone.utc)}
+        },
+        upsert=True
+    )
+    session_cache.invalidate(session_token)
     
     response.set_cookie(
         key="session_token",
@@ -173,7 +2943,6 @@ async def create_session(request: Request, response: Response):
         max_age=7*24*60*60
     )
     
-    user_doc = await db.users.find_one({"user_id": user_id}, {"_id": 0})
     return User(**user_doc)
 
 @api_router.get("/auth/me")
@@ -183,23 +2952,358 @@ async def get_me(request: Request):
 
 @api_router.post("/auth/logout")
 async def logout(request: Request, response: Response):
-    session_token = request.cookies.get("session_token")
+    session_token = get_session_token(request)
     if session_token:
         await db.user_sessions.delete_one({"session_token": session_token})
+        await revoke_session(session_token)
     
     response.delete_cookie("session_token", path="/")
     return {"message": "Logged out"}
 
+# ====== Product Search ======
+# Chaves de prefixo sem acentos ("Calça" -> c, ca, cal, calc, calca) num índice multikey
+SEARCH_PREFIX_MAX = int(os.environ.get('SEARCH_PREFIX_MAX', '12'))
+SEARCH_BARCODE_PREFIX_MIN = 3
+SEARCH_PROJECTION = {"_id": 0, **{f: 1 for f in ProductSummary.model_fields}, "thumbnail": 1}
+
+def fold_text(text: str) -> str:
+    decomposed = unicodedata.normalize("NFKD", text or "")
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).lower()
+
+def search_tokens(text: str) -> List[str]:
+    return "".join(c if c.isalnum() else " " for c in fold_text(text)).split()
+
+def name_search_prefixes(name: str) -> List[str]:
+    keys = set()
+    for token in search_tokens(name):
+        keys.update(token[:i] for i in range(1, min(len(token), SEARCH_PREFIX_MAX) + 1))
+    return sorted(keys)
+
+def barcode_search_prefixes(barcode: str) -> List[str]:
+    # Códigos de barras passam pela mesma normalização que a pesquisa ("ABC-123" -> abc, 123)
+    keys = set()
+    for token in search_tokens(barcode):
+        keys.update(token[:i] for i in range(min(SEARCH_BARCODE_PREFIX_MIN, len(token)), len(token) + 1))
+    return sorted(keys)
+
+def product_search_fields(name: str, barcode: str) -> dict:
+    # As duas partes ficam também guardadas à parte: um PATCH só do nome (ou só do código)
+    # recalcula search_keys no servidor juntando-as, na mesma escrita
+    name_prefixes = name_search_prefixes(name)
+    barcode_prefixes = barcode_search_prefixes(barcode)
+    return {
+        "search_keys": sorted(set(name_prefixes) | set(barcode_prefixes)),
+        "name_key": " ".join(search_tokens(name)),
+        "name_prefixes": name_prefixes,
+        "barcode_prefixes": barcode_prefixes
+    }
+
+async def backfill_search_keys(user_id: Optional[str] = None, rebuild: bool = False) -> int:
+    # rebuild: recalcula também as chaves já gravadas (ex.: depois de mudar a normalização)
+    # Sem rebuild: produtos sem chaves ou ainda sem as partes separadas por nome/código
+    query = {} if rebuild else {"$or": [{"search_keys": {"$exists": False}}, {"barcode_prefixes": {"$exists": False}}]}
+    if user_id:
+        query["user_id"] = user_id
+    ops, updated, users = [], 0, set()
+    async for product in db.products.find(query, {"_id": 1, "user_id": 1, "name": 1, "barcode": 1}):
+        ops.append(UpdateOne({"_id": product["_id"]}, {"$set": product_search_fields(product["name"], product["barcode"])}))
+        users.add(product["user_id"])
+        if len(ops) >= 1000:
+            updated += (await db.products.bulk_write(ops, ordered=False)).modified_count
+            ops = []
+    if ops:
+        updated += (await db.products.bulk_write(ops, ordered=False)).modified_count
+    # Resultados de pesquisa em cache (ETag) de cada utilizador abrangido
+    for user in users:
+        await update_rollup(user, {})
+    return updated
+
+def encode_search_cursor(mode: str, offset: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([mode, offset]).encode()).decode().rstrip("=")
+
+def decode_search_cursor(cursor: str):
+    try:
+        mode, offset = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if mode not in ("prefix", "text") or not isinstance(offset, int) or offset < 0:
+            raise ValueError(mode)
+        return mode, offset
+    except (binascii.Error, ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+async def search_products(user_id: str, q: str, limit: int, mode: Optional[str] = None, offset: int = 0):
+    # Prefixo (autocomplete) primeiro; sem resultados, procura no índice de texto (stemming em português)
+    tokens = [t[:SEARCH_PREFIX_MAX] for t in search_tokens(q)]
+    if not tokens:
+        return "prefix", []
+    if mode in (None, "prefix"):
+        results = await db.products.find(
+            {"user_id": user_id, "search_keys": {"$all": tokens}}, SEARCH_PROJECTION
+        ).sort([("name_key", ASCENDING), ("product_id", ASCENDING)]).skip(offset).limit(limit + 1).to_list(limit + 1)
+        if results or mode == "prefix":
+            return "prefix", results
+    results = await db.products.find(
+        {"user_id": user_id, "$text": {"$search": q}},
+        {**SEARCH_PROJECTION, "score": {"$meta": "textScore"}}
+    ).sort([("score", {"$meta": "textScore"}), ("product_id", ASCENDING)]).skip(offset).limit(limit + 1).to_list(limit + 1)
+    return "text", results
+
+# ====== Repricing ======
+# Preços calculados aqui e gravados em lotes de bulk_write, cada produto com a sua change_seq
+REPRICE_BATCH_SIZE = 1000
+REPRICE_COLUMNS = ["product_id", "barcode", "name", "current_stock", "currency", "new_currency",
+                   "purchase_price", "new_purchase_price", "sale_price", "new_sale_price"]
+ROUNDING_MODES = {"nearest": ROUND_HALF_UP, "up": ROUND_CEILING, "down": ROUND_FLOOR}
+
+def reprice_query(user_id: str, filters: RepriceFilter) -> dict:
+    query = {"user_id": user_id}
+    if filters.barcode_prefix:
+        query["barcode"] = {"$regex": f"^{re.escape(filters.barcode_prefix)}"}
+    if filters.name:
+        tokens = [t[:SEARCH_PREFIX_MAX] for t in search_tokens(filters.name)]
+        if tokens:
+            query["search_keys"] = {"$all": tokens}
+    if filters.currency:
+        query["currency"] = filters.currency.upper()
+    if filters.min_stock is not None or filters.max_stock is not None:
+        query["current_stock"] = {}
+        if filters.min_stock is not None:
+            query["current_stock"]["$gte"] = filters.min_stock
+        if filters.max_stock is not None:
+            query["current_stock"]["$lte"] = filters.max_stock
+    if filters.product_ids is not None:
+        query["product_id"] = {"$in": filters.product_ids}
+    return query
+
+async def reprice_rates(query: dict, target_currency: Optional[str]) -> dict:
+    # Taxas de cada moeda presente para a moeda de destino, obtidas antes de começar a escrever
+    if not target_currency:
+        return {}
+    rates = {}
+    for currency in await db.products.distinct("currency", query):
+        currency = currency or "MZN"
+        if currency == target_currency:
+            continue
+        rate = await rate_service.get_rate(currency, target_currency)
+        if rate is None:
+            raise HTTPException(status_code=400, detail=f"No exchange rate from {currency} to {target_currency}")
+        rates[currency] = rate
+    return rates
+
+def round_price(value: float, step: Optional[float], mode: str) -> float:
+    step = Decimal(str(step or 0.01))
+    return float((Decimal(str(value)) / step).quantize(Decimal(1), rounding=ROUNDING_MODES[mode]) * step)
+
+def reprice_product(product: dict, rule: RepriceRequest, rates: dict) -> Optional[dict]:
+    # Devolve a linha de diferenças, ou None se o preço não muda
+    currency = product.get("currency") or "MZN"
+    new_currency = rule.target_currency or currency
+    purchase_price = product["purchase_price"]
+    if new_currency != currency:
+        purchase_price = round(purchase_price * rates[currency], 2)
+    if rule.mode == "margin":
+        sale_price = purchase_price / (1 - rule.value / 100)
+    else:
+        sale_price = purchase_price * (1 + rule.value / 100)
+    sale_price = round_price(sale_price, rule.round_to, rule.round_mode)
+    if (new_currency, purchase_price, sale_price) == (currency, product["purchase_price"], product["sale_price"]):
+        return None
+    return {
+        "product_id": product["product_id"],
+        "barcode": product["barcode"],
+        "name": product["name"],
+        "current_stock": product.get("current_stock", 0),
+        "currency": currency,
+        "new_currency": new_currency,
+        "purchase_price": product["purchase_price"],
+        "new_purchase_price": purchase_price,
+        "sale_price": product["sale_price"],
+        "new_sale_price": sale_price,
+    }
+
+async def iter_reprice_diffs(query: dict, rule: RepriceRequest, rates: dict):
+    cursor = db.products.find(query, {
+        "_id": 0, "product_id": 1, "barcode": 1, "name": 1, "current_stock": 1,
+        "currency": 1, "purchase_price": 1, "sale_price": 1
+    }).sort([("product_id", ASCENDING)]).batch_size(REPRICE_BATCH_SIZE)
+    async for product in cursor:
+        diff = reprice_product(product, rule, rates)
+        if diff:
+            yield diff
+
+async def apply_reprice(user_id: str, query: dict, rule: RepriceRequest, rates: dict) -> dict:
+    report = {"updated": 0, "conflicts": 0}
+    rollup_inc = {"total_stock_value": 0.0, "total_potential_revenue": 0.0}
+    
+    async def flush(batch: List[dict]):
+        # O filtro fixa os preços lidos: uma edição concorrente ganha e conta como conflito
+        ops = [
+            UpdateOne(
+                {"user_id": user_id, "product_id": d["product_id"],
+                 "purchase_price": d["purchase_price"], "sale_price": d["sale_price"]},
+                {"$set": {"purchase_price": d["new_purchase_price"], "sale_price": d["new_sale_price"],
+                          "currency": d["new_currency"], "change_seq": change_sequence.next()}}
+            )
+            for d in batch
+        ]
+        result = await db.products.bulk_write(ops, ordered=False)
+        report["updated"] += result.modified_count
+        report["conflicts"] += len(ops) - result.matched_count
+        for d in batch:
+            rollup_inc["total_stock_value"] += d["current_stock"] * (d["new_purchase_price"] - d["purchase_price"])
+            rollup_inc["total_potential_revenue"] += d["current_stock"] * (d["new_sale_price"] - d["sale_price"])
+    
+    batch = []
+    async for diff in iter_reprice_diffs(query, rule, rates):
+        batch.append(diff)
+        if len(batch) >= REPRICE_BATCH_SIZE:
+            await flush(batch)
+            batch = []
+    if batch:
+        await flush(batch)
+    
+    if report["conflicts"]:
+        # Não sabemos que linhas falharam: recalcula o rollup em vez de aplicar os deltas
+        await rebuild_rollup(user_id)
+    elif report["updated"]:
+        await update_rollup(user_id, rollup_inc)
+    if report["updated"]:
+        barcode_index.invalidate(user_id)
+        change_bus.publish(user_id, {"type": "resync"})
+    return report
+
 # ====== Products Endpoints ======
+async def check_barcode_available(user_id: str, barcode: str, product_id: Optional[str] = None):
+    # O índice único também o garante; esta verificação dá a mensagem certa mesmo sem o índice
+    query = {"user_id": user_id, "barcode": barcode}
+    if product_id:
+        query["product_id"] = {"$ne": product_id}
+    if await db.products.find_one(query, {"_id": 1}):
+        raise HTTPException(status_code=400, detail="Product with this barcode already exists")
+
+PRODUCT_SUMMARY_PROJECTION = {"_id": 0, "created_at": 1, **{f: 1 for f in ProductSummary.model_fields}}
+PRODUCT_SUMMARY_DEFAULTS = model_defaults(ProductSummary)
+
+def product_fields_projection(fields: str) -> dict:
+    requested = {f.strip() for f in fields.split(",") if f.strip()}
+    unknown = requested - set(Product.model_fields)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown product fields: {', '.join(sorted(unknown))}")
+    # product_id e created_at são sempre lidos porque formam o cursor
+    return {"_id": 0, "product_id": 1, "created_at": 1, **{f: 1 for f in requested}}
+
 @api_router.get("/products", response_model=List[Product])
-async def get_products(request: Request):
+async def get_products(
+    request: Request,
+    response: Response,
+    limit: int = Query(MAX_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    color: Optional[str] = None,
+    include_total: bool = False,
+    view: str = Query("full", pattern="^(full|summary)$"),
+    fields: Optional[str] = None
+):
     user = await get_current_user(request)
-    products = await db.products.find({"user_id": user.user_id}, {"_id": 0}).to_list(1000)
+    not_modified = conditional_response(request, response, user.user_id, await data_version(user.user_id))
+    if not_modified:
+        return not_modified
+    query = {"user_id": user.user_id}
+    if color:
+        query["colors.color"] = color
+    
+    if fields:
+        projection = product_fields_projection(fields)
+    elif view == "summary":
+        projection = PRODUCT_SUMMARY_PROJECTION
+    else:
+        projection = PRODUCT_PROJECTION
+    
+    products = await fetch_page(
+        db.products, query, projection, "created_at", "product_id",
+        descending=False, limit=limit, cursor=cursor, include_total=include_total, response=response
+    )
+    if fields or view == "summary":
+        # Projecção já feita no MongoDB: responde directamente, sem revalidar com o modelo completo
+        if not fields or "created_at" not in {f.strip() for f in fields.split(",")}:
+            for product in products:
+                product.pop("created_at", None)
+        return list_response(products, response, None if fields else PRODUCT_SUMMARY_DEFAULTS)
+    if FAST_JSON_ENABLED:
+        return list_response(products, response, PRODUCT_DEFAULTS)
     return products
 
+@api_router.get("/products/export")
+async def export_products(request: Request, format: str = Query("csv", pattern="^(csv|ndjson)$")):
+    user = await get_current_user(request)
+    cursor = db.products.find(
+        {"user_id": user.user_id}, PRODUCT_EXPORT_PROJECTION
+    ).sort([("created_at", 1), ("product_id", 1)]).batch_size(1000)
+    return export_response(
+        cursor, format, "products", PRODUCT_CSV_COLUMNS,
+        lambda p: [
+            p["product_id"], p["name"], p["barcode"], p.get("current_stock", 0),
+            p["purchase_price"], p["sale_price"], p.get("currency", "MZN"),
+            format_colors(p.get("colors", [])),
+            "" if p.get("reorder_threshold") is None else p["reorder_threshold"],
+            p.get("image") or "", p["created_at"].isoformat()
+        ]
+    )
+
+@api_router.post("/products/import")
+async def import_products_file(
+    request: Request,
+    file: UploadFile = File(...),
+    format: Optional[str] = Query(None, pattern="^(csv|ndjson)$"),
+    update_existing: bool = False
+):
+    user = await get_current_user(request)
+    return await import_products(user.user_id, file.file, detect_format(format, file.filename), update_existing)
+
+@api_router.post("/products/reprice")
+async def reprice_products(rule: RepriceRequest, request: Request):
+    user = await get_current_user(request)
+    if rule.mode == "margin" and rule.value >= 100:
+        raise HTTPException(status_code=400, detail="Margin must be below 100%")
+    if rule.target_currency:
+        rule.target_currency = rule.target_currency.upper()
+    query = reprice_query(user.user_id, rule.filters)
+    try:
+        rates = await reprice_rates(query, rule.target_currency)
+    except RatesUnavailable:
+        raise HTTPException(status_code=503, detail="Exchange rate service temporarily unavailable")
+    
+    if rule.dry_run:
+        return export_response(
+            iter_reprice_diffs(query, rule, rates), rule.format, "reprice-preview", REPRICE_COLUMNS,
+            lambda d: [d[column] for column in REPRICE_COLUMNS]
+        )
+    return await apply_reprice(user.user_id, query, rule, rates)
+
+@api_router.get("/products/search")
+async def search_products_endpoint(
+    request: Request,
+    response: Response,
+    q: str = Query(..., min_length=1, max_length=100),
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = None
+):
+    user = await get_current_user(request)
+    not_modified = conditional_response(request, response, user.user_id, await data_version(user.user_id))
+    if not_modified:
+        return not_modified
+    mode, offset = decode_search_cursor(cursor) if cursor else (None, 0)
+    mode, results = await search_products(user.user_id, q, limit, mode, offset)
+    if len(results) > limit:
+        results = results[:limit]
+        response.headers[NEXT_CURSOR_HEADER] = encode_search_cursor(mode, offset + limit)
+    response.headers["X-Search-Mode"] = mode
+    return list_response(results, response, PRODUCT_SUMMARY_DEFAULTS)
+
 @api_router.get("/products/{product_id}", response_model=Product)
-async def get_product(product_id: str, request: Request):
+async def get_product(product_id: str, request: Request, response: Response):
     user = await get_current_user(request)
+    not_modified = conditional_response(request, response, user.user_id, await data_version(user.user_id))
+    if not_modified:
+        return not_modified
     product = await db.products.find_one({"product_id": product_id, "user_id": user.user_id}, {"_id": 0})
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
@@ -209,14 +3313,13 @@ async def get_product(product_id: str, request: Request):
 async def create_product(product: ProductCreate, request: Request):
     user = await get_current_user(request)
     
-    existing = await db.products.find_one({"barcode": product.barcode, "user_id": user.user_id})
-    if existing:
-        raise HTTPException(status_code=400, detail="Product with this barcode already exists")
+    await check_barcode_available(user.user_id, product.barcode)
     
     product_id = f"prod_{uuid.uuid4().hex[:12]}"
     
     # Calcular stock total a partir das cores
     total_stock = sum(color.quantity for color in product.colors) if product.colors else 0
+    image, thumbnail = await resolve_product_image(product.image)
     
     product_doc = {
         "product_id": product_id,
@@ -226,13 +3329,27 @@ async def create_product(product: ProductCreate, request: Request):
         "purchase_price": product.purchase_price,
         "sale_price": product.sale_price,
         "currency": product.currency,
-        "image": product.image,
-        "colors": [{"color": c.color, "quantity": c.quantity} for c in product.colors],
+        "image": image,
+        "thumbnail": thumbnail,
+        "colors": color_docs(product.colors),
+        "reorder_threshold": product.reorder_threshold,
         "created_at": datetime.now(timezone.utc),
-        "user_id": user.user_id
+        "user_id": user.user_id,
+        "change_seq": change_sequence.next(),
+        **product_search_fields(product.name, product.barcode)
     }
+    severity = low_stock_severity(product_doc)
+    if severity is not None:
+        product_doc["low_stock_severity"] = severity
     
-    await db.products.insert_one(product_doc)
+    try:
+        await db.products.insert_one(product_doc)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Product with this barcode already exists")
+    barcode_index.upsert(user.user_id, product_doc)
+    version = await rollup_product_created(user.user_id, product_doc)
+    barcode_index.record_write(user.user_id, version)
+    change_bus.publish(user.user_id, product_event(product_doc, version))
     return Product(**product_doc)
 
 @api_router.put("/products/{product_id}", response_model=Product)
@@ -242,9 +3359,12 @@ async def update_product(product_id: str, product: ProductCreate, request: Reque
     existing = await db.products.find_one({"product_id": product_id, "user_id": user.user_id}, {"_id": 0})
     if not existing:
         raise HTTPException(status_code=404, detail="Product not found")
+    if product.barcode != existing["barcode"]:
+        await check_barcode_available(user.user_id, product.barcode, product_id)
     
     # Calcular stock total a partir das cores
     total_stock = sum(color.quantity for color in product.colors) if product.colors else 0
+    image, thumbnail = await resolve_product_image(product.image)
     
     update_data = {
         "name": product.name,
@@ -252,163 +3372,306 @@ async def update_product(product_id: str, product: ProductCreate, request: Reque
         "purchase_price": product.purchase_price,
         "sale_price": product.sale_price,
         "currency": product.currency,
-        "image": product.image,
-        "colors": [{"color": c.color, "quantity": c.quantity} for c in product.colors],
-        "current_stock": total_stock
+        "image": image,
+        "thumbnail": thumbnail,
+        "colors": color_docs(product.colors),
+        "reorder_threshold": product.reorder_threshold,
+        "current_stock": total_stock,
+        "change_seq": change_sequence.next(),
+        **product_search_fields(product.name, product.barcode)
+    }
+    
+    try:
+        await db.products.update_one(
+            {"product_id": product_id, "user_id": user.user_id},
+            set_low_stock({"$set": update_data}, {**existing, **update_data})
+        )
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Product with this barcode already exists")
+    
+    updated = await db.products.find_one({"product_id": product_id, "user_id": user.user_id}, {"_id": 0})
+    barcode_index.upsert(user.user_id, updated)
+    version = await rollup_product_updated(user.user_id, existing, updated)
+    barcode_index.record_write(user.user_id, version)
+    change_bus.publish(user.user_id, product_event(updated, version))
+    return Product(**updated)
+
+@api_router.patch("/products/{product_id}", response_model=Product)
+async def patch_product(product_id: str, patch: ProductPatch, request: Request):
+    user = await get_current_user(request)
+    sent = patch.model_fields_set
+    if patch.colors is not None and patch.color_deltas:
+        raise HTTPException(status_code=400, detail="Send either colors or color_deltas, not both")
+    if "barcode" in sent:
+        await check_barcode_available(user.user_id, patch.barcode, product_id)
+    
+    fields = {
+        f: getattr(patch, f)
+        for f in ("name", "barcode", "purchase_price", "sale_price", "currency", "reorder_threshold") if f in sent
     }
+    if "image" in sent:
+        fields["image"], fields["thumbnail"] = await resolve_product_image(patch.image)
+    if patch.colors is not None:
+        fields["colors"] = color_docs(patch.colors)
+        fields["current_stock"] = sum(c.quantity for c in patch.colors)
+    fields["change_seq"] = change_sequence.next()
     
-    await db.products.update_one({"product_id": product_id}, {"$set": update_data})
+    deltas = {}
+    for item in patch.color_deltas:
+        deltas[item.color] = deltas.get(item.color, 0) + item.delta
+    deltas = {color: delta for color, delta in deltas.items() if delta}
+    
+    # Uma só escrita em pipeline: os valores enviados entram como literais e o que depende do
+    # documento gravado (cores com delta, stock, chaves de pesquisa) é calculado no servidor
+    stage = {f: {"$literal": v} for f, v in fields.items()}
+    if "name" in sent and "barcode" in sent:
+        stage.update({f: {"$literal": v} for f, v in product_search_fields(patch.name, patch.barcode).items()})
+    elif "name" in sent:
+        prefixes = name_search_prefixes(patch.name)
+        stage["name_prefixes"] = {"$literal": prefixes}
+        stage["name_key"] = {"$literal": " ".join(search_tokens(patch.name))}
+        stage["search_keys"] = {"$setUnion": [{"$literal": prefixes}, {"$ifNull": ["$barcode_prefixes", []]}]}
+    elif "barcode" in sent:
+        prefixes = barcode_search_prefixes(patch.barcode)
+        stage["barcode_prefixes"] = {"$literal": prefixes}
+        stage["search_keys"] = {"$setUnion": [{"$literal": prefixes}, {"$ifNull": ["$name_prefixes", []]}]}
+    
+    query = {"product_id": product_id, "user_id": user.user_id}
+    if deltas:
+        # Cada cor tem de existir e, se desce, ter stock suficiente: a verificação faz parte do filtro
+        query["$and"] = [
+            {"colors": {"$elemMatch": {"color": color, **({"quantity": {"$gte": -delta}} if delta < 0 else {})}}}
+            for color, delta in deltas.items()
+        ]
+        quantity = {"$switch": {
+            "branches": [
+                {"case": {"$eq": ["$$c.color", {"$literal": color}]}, "then": {"$add": ["$$c.quantity", delta]}}
+                for color, delta in deltas.items()
+            ],
+            "default": "$$c.quantity"
+        }}
+        stage["colors"] = {"$map": {
+            "input": "$colors", "as": "c",
+            "in": {f: quantity if f == "quantity" else f"$$c.{f}" for f in ColorVariant.model_fields}
+        }}
+        stage["current_stock"] = {"$add": ["$current_stock", sum(deltas.values())]}
+    
+    # Devolve o documento anterior (o rollup precisa dos preços antigos) e aplica as mesmas alterações aqui
+    try:
+        existing = await db.products.find_one_and_update(
+            query, [{"$set": stage}], projection={"_id": 0, "pending_movements": 0, "search_keys": 0},
+            return_document=ReturnDocument.BEFORE
+        )
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Product with this barcode already exists")
+    if not existing:
+        product = await db.products.find_one({"product_id": product_id, "user_id": user.user_id}, {"_id": 0, "colors": 1})
+        if not product:
+            raise HTTPException(status_code=404, detail="Product not found")
+        colors = {c["color"]: c.get("quantity", 0) for c in product.get("colors", [])}
+        missing = [color for color in deltas if color not in colors]
+        if missing:
+            raise HTTPException(status_code=400, detail=f"Color '{missing[0]}' not found in product")
+        raise HTTPException(status_code=400, detail="Insufficient stock for this color")
+    
+    updated = {**existing, **fields}
+    if deltas:
+        updated["colors"] = [
+            {**c, "quantity": c.get("quantity", 0) + deltas.get(c["color"], 0)} for c in existing.get("colors", [])
+        ]
+        updated["current_stock"] = existing.get("current_stock", 0) + sum(deltas.values())
+    if ("name" in sent) != ("barcode" in sent) and "barcode_prefixes" not in existing:
+        # Produto anterior às partes separadas (até correr backfill-search): chaves completas à parte
+        await db.products.update_one(
+            {"product_id": product_id, "user_id": user.user_id},
+            {"$set": product_search_fields(updated["name"], updated["barcode"])}
+        )
     
-    updated = await db.products.find_one({"product_id": product_id}, {"_id": 0})
+    await update_low_stock(user.user_id, [updated])
+    barcode_index.upsert(user.user_id, updated)
+    version = await rollup_product_updated(user.user_id, existing, updated)
+    barcode_index.record_write(user.user_id, version)
+    change_bus.publish(user.user_id, product_event(updated, version))
     return Product(**updated)
 
 @api_router.delete("/products/{product_id}")
 async def delete_product(product_id: str, request: Request):
     user = await get_current_user(request)
-    result = await db.products.delete_one({"product_id": product_id, "user_id": user.user_id})
-    if result.deleted_count == 0:
+    deleted = await db.products.find_one_and_delete(
+        {"product_id": product_id, "user_id": user.user_id}, projection=ROLLUP_PRODUCT_FIELDS
+    )
+    if not deleted:
         raise HTTPException(status_code=404, detail="Product not found")
+    barcode_index.remove(user.user_id, product_id)
+    await record_product_deleted(user.user_id, product_id)
+    await db.valuation_checkpoints.delete_many({"user_id": user.user_id, "product_id": product_id})
+    version = await rollup_product_deleted(user.user_id, deleted)
+    barcode_index.record_write(user.user_id, version)
+    change_bus.publish(user.user_id, {"type": "product_deleted", "version": version, "product_id": product_id})
     return {"message": "Product deleted"}
 
 @api_router.get("/products/barcode/{barcode}")
 async def get_product_by_barcode(barcode: str, request: Request):
     user = await get_current_user(request)
-    product = await db.products.find_one({"barcode": barcode, "user_id": user.user_id}, {"_id": 0})
+    product = await barcode_index.lookup(user.user_id, barcode)
     if not product:
         return {"found": False}
-    return {"found": True, "product": Product(**product)}
+    return {"found": True, "product": product}
+
+# ====== Images Endpoints ======
+@api_router.post("/images")
+async def upload_image(request: Request, file: UploadFile = File(...)):
+    await get_current_user(request)
+    data = await file.read(IMAGE_MAX_BYTES + 1)
+    return await store_image(data)
+
+@api_router.get("/images/{image_id}")
+async def get_image(image_id: str, request: Request, variant: str = Query("original", pattern="^(original|thumb)$")):
+    etag = f'"{image_id}-{variant}"'
+    headers = {"ETag": etag, "Cache-Control": IMAGE_CACHE_CONTROL}
+    if request.headers.get("If-None-Match") == etag:
+        return Response(status_code=304, headers=headers)
+    
+    meta = await db.images.find_one({"image_id": image_id}, {"_id": 0})
+    if not meta:
+        raise HTTPException(status_code=404, detail="Image not found")
+    key = image_id if variant == "original" else f"{image_id}_thumb"
+    data = await get_image_store().get(key)
+    if data is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    media_type = meta["content_type"] if variant == "original" else meta["thumbnail_content_type"]
+    return Response(content=data, media_type=media_type, headers=headers)
 
 # ====== Stock Movements Endpoints ======
 @api_router.get("/movements", response_model=List[StockMovement])
-async def get_movements(request: Request, product_id: Optional[str] = None):
+async def get_movements(
+    request: Request,
+    response: Response,
+    product_id: Optional[str] = None,
+    type: Optional[str] = Query(None, pattern="^(entrada|saida)$"),
+    color: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    limit: int = Query(MAX_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    include_total: bool = False
+):
     user = await get_current_user(request)
+    not_modified = conditional_response(request, response, user.user_id, await data_version(user.user_id))
+    if not_modified:
+        return not_modified
     query = {"user_id": user.user_id}
     if product_id:
         query["product_id"] = product_id
-    movements = await db.stock_movements.find(query, {"_id": 0}).sort("date", -1).to_list(1000)
+    if type:
+        query["type"] = type
+    if color:
+        query["color"] = color
+    if date_from or date_to:
+        query["date"] = {}
+        if date_from:
+            query["date"]["$gte"] = date_from
+        if date_to:
+            query["date"]["$lt"] = date_to
+    movements = await fetch_page(
+        db.stock_movements, query, MOVEMENT_PROJECTION, "date", "movement_id",
+        descending=True, limit=limit, cursor=cursor, include_total=include_total, response=response
+    )
+    if FAST_JSON_ENABLED:
+        return list_response(movements, response, MOVEMENT_DEFAULTS)
     return movements
 
+@api_router.get("/movements/export")
+async def export_movements(
+    request: Request,
+    format: str = Query("csv", pattern="^(csv|ndjson)$"),
+    product_id: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None
+):
+    user = await get_current_user(request)
+    query = {"user_id": user.user_id}
+    if product_id:
+        query["product_id"] = product_id
+    if date_from or date_to:
+        query["date"] = {}
+        if date_from:
+            query["date"]["$gte"] = date_from
+        if date_to:
+            query["date"]["$lt"] = date_to
+    cursor = db.stock_movements.find(query, MOVEMENT_EXPORT_PROJECTION).sort([("date", -1), ("movement_id", -1)]).batch_size(1000)
+    return export_response(
+        cursor, format, "movements", MOVEMENT_CSV_COLUMNS,
+        lambda m: [
+            m["movement_id"], m["product_id"], m["type"], m["quantity"],
+            m.get("color") or "", m["date"].isoformat(), m.get("note") or "",
+            "" if m.get("unit_cost") is None else m["unit_cost"],
+            "" if m.get("unit_price") is None else m["unit_price"]
+        ]
+    )
+
 @api_router.post("/movements", response_model=StockMovement)
 async def create_movement(movement: MovementCreate, request: Request):
     user = await get_current_user(request)
-    
-    product = await db.products.find_one({"product_id": movement.product_id, "user_id": user.user_id}, {"_id": 0})
-    if not product:
-        raise HTTPException(status_code=404, detail="Product not found")
-    
-    # Se o produto tem cores e uma cor específica foi fornecida
-    if movement.color:
-        colors = product.get("colors", [])
-        color_index = next((i for i, c in enumerate(colors) if c["color"] == movement.color), None)
-        
-        if color_index is None:
-            raise HTTPException(status_code=400, detail=f"Color '{movement.color}' not found in product")
-        
-        if movement.type == "saida" and colors[color_index]["quantity"] < movement.quantity:
-            raise HTTPException(status_code=400, detail="Insufficient stock for this color")
-        
-        # Atualizar quantidade da cor específica
-        if movement.type == "entrada":
-            colors[color_index]["quantity"] += movement.quantity
-        else:
-            colors[color_index]["quantity"] -= movement.quantity
-        
-        # Recalcular stock total
-        total_stock = sum(c["quantity"] for c in colors)
-        
-        await db.products.update_one(
-            {"product_id": movement.product_id},
-            {"$set": {"colors": colors, "current_stock": total_stock}}
-        )
-    else:
-        # Movimento sem cor específica (comportamento antigo)
-        if movement.type == "saida" and product["current_stock"] < movement.quantity:
-            raise HTTPException(status_code=400, detail="Insufficient stock")
-        
-        if movement.type == "entrada":
-            new_stock = product["current_stock"] + movement.quantity
-        else:
-            new_stock = product["current_stock"] - movement.quantity
-        
-        await db.products.update_one(
-            {"product_id": movement.product_id},
-            {"$set": {"current_stock": new_stock}}
-        )
-    
-    movement_id = f"mov_{uuid.uuid4().hex[:12]}"
-    movement_doc = {
-        "movement_id": movement_id,
-        "product_id": movement.product_id,
-        "type": movement.type,
-        "quantity": movement.quantity,
-        "color": movement.color,
-        "date": datetime.now(timezone.utc),
-        "note": movement.note,
-        "user_id": user.user_id
-    }
-    
-    await db.stock_movements.insert_one(movement_doc)
-    
+    # Com Idempotency-Key, repetir o pedido devolve o movimento já gravado
+    idempotency_key = request.headers.get("Idempotency-Key")
+    if idempotency_key:
+        try:
+            client_movement = SyncMovement(**movement.model_dump(), movement_id=idempotency_key)
+        except ValidationError:
+            raise HTTPException(status_code=400, detail="Invalid Idempotency-Key")
+        movement_doc, _ = await apply_client_movement(movement, user.user_id, client_movement.movement_id)
+        return StockMovement(**movement_doc)
+    movement_doc = await apply_stock_movement(movement, user.user_id)
     return StockMovement(**movement_doc)
 
+@api_router.post("/movements/batch")
+async def create_movements_batch(batch: MovementBatchCreate, request: Request):
+    user = await get_current_user(request)
+    movement_docs = await apply_stock_movements_batch(batch.items, user.user_id)
+    return {
+        "results": [
+            {"index": i, "product_id": doc["product_id"], "color": doc["color"],
+             "status": "ok", "movement": StockMovement(**doc)}
+            for i, doc in enumerate(movement_docs)
+        ]
+    }
+
+# ====== Sync Endpoints ======
+@api_router.get("/sync")
+async def sync_pull(
+    request: Request,
+    since: Optional[str] = None,
+    limit: int = Query(SYNC_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)
+):
+    user = await get_current_user(request)
+    return fast_json_response(await sync_changes(user.user_id, since, limit))
+
+@api_router.post("/sync")
+async def sync_push(push: SyncPush, request: Request, limit: int = Query(SYNC_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)):
+    # Reaplica a fila offline por ordem e devolve o delta numa só ida e volta
+    user = await get_current_user(request)
+    results = []
+    for item in push.movements:
+        try:
+            movement_doc, duplicate = await apply_client_movement(item, user.user_id, item.movement_id, item.date)
+            results.append({"movement_id": item.movement_id, "status": "duplicate" if duplicate else "applied"})
+        except HTTPException as e:
+            results.append({"movement_id": item.movement_id, "status": "error", "error": e.detail})
+    changes = await sync_changes(user.user_id, push.since, limit)
+    return fast_json_response({"results": results, **changes})
+
 # ====== Currency Endpoints ======
 @api_router.post("/currency/convert")
 async def convert_currency(conversion: ConversionRequest, request: Request):
     user = await get_current_user(request)
     
-    cache_key = f"{conversion.from_currency}_{conversion.to_currency}"
-    cached = await db.rates_cache.find_one({"cache_key": cache_key}, {"_id": 0})
-    
-    # Fix timezone comparison
-    if cached and cached.get("expires_at"):
-        expires_at = cached["expires_at"]
-        if isinstance(expires_at, str):
-            expires_at = datetime.fromisoformat(expires_at.replace('Z', '+00:00'))
-        elif expires_at.tzinfo is None:
-            expires_at = expires_at.replace(tzinfo=timezone.utc)
-        
-        if expires_at > datetime.now(timezone.utc):
-            rate = cached["rate"]
-        else:
-            cached = None  # Force refresh
-    
-    if not cached or not cached.get("rate"):
-        async with httpx.AsyncClient() as http_client:
-            try:
-                res = await http_client.get(
-                    f"https://api.exchangerate-api.com/v4/latest/{conversion.from_currency}",
-                    timeout=10.0
-                )
-                res.raise_for_status()
-                data = res.json()
-                rate = data["rates"].get(conversion.to_currency)
-                
-                if not rate:
-                    raise HTTPException(status_code=400, detail="Currency not supported")
-                
-                await db.rates_cache.update_one(
-                    {"cache_key": cache_key},
-                    {"$set": {
-                        "cache_key": cache_key,
-                        "rate": rate,
-                        "expires_at": datetime.now(timezone.utc) + timedelta(hours=1)
-                    }},
-                    upsert=True
-                )
-            except httpx.HTTPStatusError as e:
-                # If API fails, try to use cached data even if expired
-                if cached and cached.get("rate"):
-                    rate = cached["rate"]
-                    logger.warning(f"Using expired cache due to API error: {e}")
-                else:
-                    raise HTTPException(status_code=503, detail="Exchange rate service temporarily unavailable")
-            except Exception as e:
-                # Fallback to cache if available
-                if cached and cached.get("rate"):
-                    rate = cached["rate"]
-                    logger.warning(f"Using cached rate due to error: {e}")
-                else:
-                    raise HTTPException(status_code=500, detail=f"Failed to fetch exchange rate: {str(e)}")
+    try:
+        rate = await rate_service.get_rate(conversion.from_currency, conversion.to_currency)
+    except RatesUnavailable:
+        raise HTTPException(status_code=503, detail="Exchange rate service temporarily unavailable")
+    if not rate:
+        raise HTTPException(status_code=400, detail="Currency not supported")
     
     converted_amount = conversion.amount * rate
     
@@ -424,45 +3687,188 @@ async def convert_currency(conversion: ConversionRequest, request: Request):
 async def get_rates(base_currency: str, request: Request):
     user = await get_current_user(request)
     
-    async with httpx.AsyncClient() as http_client:
-        try:
-            res = await http_client.get(
-                f"https://api.exchangerate-api.com/v4/latest/{base_currency}",
-                timeout=10.0
-            )
-            res.raise_for_status()
-            data = res.json()
-            return data
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Failed to fetch rates: {str(e)}")
+    try:
+        return await rate_service.get_table(base_currency)
+    except RatesUnavailable:
+        raise HTTPException(status_code=503, detail="Exchange rate service temporarily unavailable")
 
 # ====== Reports Endpoints ======
+LOW_STOCK_QUERY_FIELDS = {"low_stock_severity": {"$exists": True}}
+LOW_STOCK_PROJECTION = {**{k: v for k, v in PRODUCT_PROJECTION.items() if k != "image"}, "low_stock_severity": 1}
+LOW_STOCK_DEFAULTS = {k: v for k, v in PRODUCT_DEFAULTS.items() if k != "image"}
+
+async def low_stock_page(user_id: str, offset: int, limit: int) -> List[dict]:
+    # Lido pelo índice parcial, já ordenado por severidade (stock / limiar, 0 = esgotado)
+    products = await db.products.find(
+        {"user_id": user_id, **LOW_STOCK_QUERY_FIELDS}, LOW_STOCK_PROJECTION
+    ).sort([("low_stock_severity", ASCENDING), ("current_stock", ASCENDING), ("product_id", ASCENDING)]).skip(offset).limit(limit).to_list(limit)
+    for product in products:
+        product["severity"] = product.pop("low_stock_severity")
+    return products
+
+async def low_stock_count(user_id: str) -> int:
+    return await db.products.count_documents({"user_id": user_id, **LOW_STOCK_QUERY_FIELDS})
+
 @api_router.get("/reports/summary")
-async def get_summary(request: Request):
+async def get_summary(request: Request, response: Response):
     user = await get_current_user(request)
     
-    products_count = await db.products.count_documents({"user_id": user.user_id})
+    # Leitura O(1) do rollup mantido incrementalmente pelas escritas
+    rollup = await db.report_rollups.find_one({"user_id": user.user_id}, {"_id": 0})
+    if rollup_needs_rebuild(rollup):
+        rollup = await rebuild_rollup(user.user_id)
+    not_modified = conditional_response(request, response, user.user_id, rollup["version"])
+    if not_modified:
+        return not_modified
     
-    products = await db.products.find({"user_id": user.user_id}, {"_id": 0}).to_list(1000)
+    low_stock_total, low_stock_products = await asyncio.gather(
+        low_stock_count(user.user_id), low_stock_page(user.user_id, 0, 5)
+    )
     
-    total_stock_value = sum(p["current_stock"] * p["purchase_price"] for p in products)
-    total_potential_revenue = sum(p["current_stock"] * p["sale_price"] for p in products)
+    return {
+        "products_count": rollup["products_count"],
+        "total_stock_value": rollup["total_stock_value"],
+        "total_potential_revenue": rollup["total_potential_revenue"],
+        "total_entries": rollup["total_entries"],
+        "total_exits": rollup["total_exits"],
+        "low_stock_count": low_stock_total,
+        "low_stock_products": low_stock_products
+    }
+
+@api_router.get("/reports/low-stock")
+async def get_low_stock(
+    request: Request,
+    response: Response,
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None
+):
+    user = await get_current_user(request)
+    rollup = await db.report_rollups.find_one({"user_id": user.user_id}, {"_id": 0, "version": 1, "schema": 1})
+    if rollup_needs_rebuild(rollup):
+        # Também acerta as severidades de produtos anteriores ao esquema actual
+        rollup = await rebuild_rollup(user.user_id)
+    not_modified = conditional_response(request, response, user.user_id, rollup["version"])
+    if not_modified:
+        return not_modified
     
-    movements = await db.stock_movements.find({"user_id": user.user_id}, {"_id": 0}).to_list(10000)
-    total_entries = sum(1 for m in movements if m["type"] == "entrada")
-    total_exits = sum(1 for m in movements if m["type"] == "saida")
+    offset = decode_offset_cursor(cursor) if cursor else 0
+    total, products = await asyncio.gather(
+        low_stock_count(user.user_id), low_stock_page(user.user_id, offset, limit)
+    )
+    response.headers[TOTAL_COUNT_HEADER] = str(total)
+    if offset + limit < total:
+        response.headers[NEXT_CURSOR_HEADER] = encode_offset_cursor(offset + limit)
+    return list_response(products, response, LOW_STOCK_DEFAULTS)
+
+@api_router.get("/reports/valuation")
+async def get_valuation(
+    request: Request,
+    response: Response,
+    method: str = Query("average", pattern="^(average|fifo)$"),
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    product_id: Optional[str] = None
+):
+    user = await get_current_user(request)
+    not_modified = conditional_response(request, response, user.user_id, await data_version(user.user_id))
+    if not_modified:
+        return not_modified
+    if date_from and date_to and as_utc(date_from) >= as_utc(date_to):
+        raise HTTPException(status_code=400, detail="date_from must be before date_to")
+    report = await value_inventory(user.user_id, method, date_from, date_to, product_id)
+    if product_id and not report["products"]:
+        raise HTTPException(status_code=404, detail="Product not found")
+    return fast_json_response(report, dict(response.headers))
+
+@api_router.get("/reports/timeseries")
+async def get_timeseries(
+    request: Request,
+    response: Response,
+    granularity: str = Query("day", pattern="^(day|week|month)$"),
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    product_id: Optional[str] = None,
+    color: Optional[str] = None,
+    by_product: bool = True,
+    by_color: bool = False
+):
+    user = await get_current_user(request)
+    not_modified = conditional_response(request, response, user.user_id, await data_version(user.user_id))
+    if not_modified:
+        return not_modified
+    series = await sales_timeseries(
+        user.user_id, granularity, date_from, date_to, product_id, color, by_product, by_color
+    )
+    return {"granularity": granularity, "series": series}
+
+# ====== Stream Endpoint ======
+@api_router.get("/stream")
+async def stream_changes(request: Request):
+    # Server-Sent Events com as alterações de stock, produtos e movimentos do utilizador
+    user = await get_current_user(request)
+    queue = change_bus.subscribe(user.user_id)
     
-    low_stock_products = [p for p in products if p["current_stock"] < 10]
+    async def events():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), STREAM_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                lines = f"event: {event['type']}\n"
+                if event.get("version") is not None:
+                    lines += f"id: {event['version']}\n"
+                yield lines + f"data: {json.dumps(event, default=json_default)}\n\n"
+        finally:
+            change_bus.unsubscribe(user.user_id, queue)
     
-    return {
-        "products_count": products_count,
-        "total_stock_value": total_stock_value,
-        "total_potential_revenue": total_potential_revenue,
-        "total_entries": total_entries,
-        "total_exits": total_exits,
-        "low_stock_count": len(low_stock_products),
-        "low_stock_products": low_stock_products[:5]
-    }
+    return StreamingResponse(
+        events(), media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# ====== Health Endpoints ======
+# Health e /metrics: com HEALTH_TOKEN definido só esse token dá acesso (cabeçalho X-Health-Token); sem ele, exige sessão
+HEALTH_TOKEN = os.environ.get('HEALTH_TOKEN', '')
+
+async def require_health_access(request: Request):
+    if HEALTH_TOKEN:
+        if not hmac.compare_digest(request.headers.get("X-Health-Token", ""), HEALTH_TOKEN):
+            raise HTTPException(status_code=403, detail="Invalid health token")
+        return
+    await get_current_user(request)
+
+@api_router.get("/health/indexes")
+async def indexes_health(request: Request):
+    await require_health_access(request)
+    return await index_status()
+
+@api_router.get("/health/barcode-index")
+async def barcode_index_health(request: Request):
+    await require_health_access(request)
+    return barcode_index.stats()
+
+@api_router.get("/health/http")
+async def http_health(request: Request):
+    await require_health_access(request)
+    return outbound_http.pool_stats()
+
+@api_router.get("/health/rates")
+async def rates_health(request: Request):
+    await require_health_access(request)
+    return rate_service.stats()
+
+@api_router.get("/health/stream")
+async def stream_health(request: Request):
+    await require_health_access(request)
+    return change_bus.stats()
+
+@api_router.get("/health/session-cache")
+async def session_cache_stats(request: Request):
+    await require_health_access(request)
+    return session_cache.stats()
 
 # ====== Support Endpoint ======
 @api_router.post("/support/contact")
@@ -492,14 +3898,139 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER, TOTAL_COUNT_HEADER, "ETag", "X-Search-Mode"],
 )
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
+app.add_middleware(CompressionMiddleware)
+
+@app.middleware("http")
+async def instrument_requests(request: Request, call_next):
+    metrics = RequestMetrics()
+    token = current_request_metrics.set(metrics)
+    started = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        current_request_metrics.reset(token)
+    total = time.perf_counter() - started
+    
+    route = request.scope.get("route")
+    route_path = route.path if route is not None else "unmatched"
+    labels = (request.method, route_path)
+    request_latency.observe((*labels, response.status_code), total)
+    request_db_calls.inc(labels, metrics.db_calls)
+    request_db_seconds.inc(labels, metrics.db_seconds)
+    request_upstream_seconds.inc(labels, metrics.upstream_seconds)
+    request_serialize_seconds.inc(labels, metrics.serialize_seconds)
+    
+    if SERVER_TIMING_ENABLED:
+        app_seconds = max(0.0, total - metrics.db_seconds - metrics.upstream_seconds - metrics.serialize_seconds)
+        response.headers["Server-Timing"] = ", ".join([
+            f'db;dur={metrics.db_seconds * 1000:.1f};desc="{metrics.db_calls} round-trips"',
+            f'upstream;dur={metrics.upstream_seconds * 1000:.1f};desc="{metrics.upstream_calls} calls"',
+            f"serialize;dur={metrics.serialize_seconds * 1000:.1f}",
+            f"app;dur={app_seconds * 1000:.1f}",
+            f"total;dur={total * 1000:.1f}",
+        ])
+    if total * 1000 >= SLOW_REQUEST_MS:
+        logger.warning(
+            f"Slow request {request.method} {route_path} {response.status_code} {total * 1000:.0f}ms "
+            f"db={metrics.db_calls}/{metrics.db_seconds * 1000:.0f}ms "
+            f"upstream={metrics.upstream_calls}/{metrics.upstream_seconds * 1000:.0f}ms "
+            f"serialize={metrics.serialize_seconds * 1000:.0f}ms queries={metrics.query_shapes}"
+        )
+    return response
+
+@app.get("/metrics")
+async def metrics_endpoint(request: Request):
+    await require_health_access(request)
+    return Response(content=render_metrics(), media_type="text/plain; version=0.0.4")
+
+background_tasks = []
+
+async def startup_tasks():
+    await outbound_http.start()
+    if ENSURE_INDEXES:
+        await ensure_indexes()
+    await flush_pending_movements()
+    if SESSION_INVALIDATION_CHANNEL == "mongo":
+        background_tasks.append(asyncio.create_task(poll_session_invalidations()))
+    background_tasks.append(asyncio.create_task(rate_service.refresh_loop()))
+    if BARCODE_INDEX_SYNC == "poll":
+        background_tasks.append(asyncio.create_task(barcode_index.poll_versions()))
+    elif BARCODE_INDEX_SYNC == "changestream":
+        background_tasks.append(asyncio.create_task(barcode_index.watch_changes()))
+    if STREAM_SOURCE == "changestream":
+        background_tasks.append(asyncio.create_task(change_bus.watch_changes()))
+
+async def shutdown_tasks():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await outbound_http.close()
+    client.close()
+
+# ====== CLI ======
+async def _run_cli(args):
+    if args.command == "ensure-indexes":
+        for result in await ensure_indexes():
+            print(f"{result['collection']}.{result['index']}: {result['status']}")
+    elif args.command == "index-report":
+        report = await index_report()
+        for query in report["queries"]:
+            status = {True: "covered", False: "NOT COVERED", None: "unknown"}[query["covered"]]
+            print(f"{status:12} {query['collection']:18} {query['query']}")
+        for name in report["missing_indexes"]:
+            print(f"missing index: {name}")
+        return 0 if report["all_covered"] else 1
+    elif args.command == "migrate-images":
+        print(f"migrated {await migrate_embedded_images()} product images")
+    elif args.command == "backfill-search":
+        print(f"indexed {await backfill_search_keys(args.user, args.all)} products for search")
+    elif args.command == "backfill-sync":
+        print(f"stamped {await backfill_sync_sequences(args.user)} documents for sync")
+    elif args.command == "backfill-costs":
+        user_ids = [args.user] if args.user else await db.users.distinct("user_id")
+        for user_id in user_ids:
+            print(f"{user_id}: {await backfill_movement_costs(user_id)} movements")
+    elif args.command == "backfill-buckets":
+        user_ids = [args.user] if args.user else await db.users.distinct("user_id")
+        for user_id in user_ids:
+            print(f"{user_id}: {await backfill_sales_buckets(user_id)} movements")
+    elif args.command in ("rebuild-rollups", "check-rollups"):
+        user_ids = [args.user] if args.user else await db.users.distinct("user_id")
+        inconsistent = 0
+        for user_id in user_ids:
+            if args.command == "rebuild-rollups":
+                await rebuild_rollup(user_id)
+                print(f"{user_id}: rebuilt")
+            else:
+                result = await check_rollup(user_id)
+                if result["consistent"]:
+                    print(f"{user_id}: ok")
+                else:
+                    inconsistent += 1
+                    print(f"{user_id}: INCONSISTENT {result['differences']}")
+        return 1 if inconsistent else 0
+    return 0
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Controle de Venda maintenance commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("ensure-indexes", help="Create all declared indexes")
+    subparsers.add_parser("index-report", help="Show which API queries are index-covered")
+    subparsers.add_parser("migrate-images", help="Move embedded base64 product images to the image store")
+    for command, help_text in (
+        ("backfill-buckets", "Rebuild hourly sales buckets from stock_movements"),
+        ("backfill-search", "Add search keys to products created before product search"),
+        ("backfill-sync", "Give products and movements created before sync a change sequence"),
+        ("backfill-costs", "Stamp current product prices on movements recorded without unit cost/price"),
+        ("rebuild-rollups", "Recompute report rollups from products and movements"),
+        ("check-rollups", "Compare stored report rollups with a full recomputation"),
+    ):
+        command_parser = subparsers.add_parser(command, help=help_text)
+        command_parser.add_argument("--user", help="Only this user_id (default: all users)")
+        if command == "backfill-search":
+            command_parser.add_argument("--all", action="store_true", help="Recompute keys of already indexed products too")
+    sys.exit(asyncio.run(_run_cli(parser.parse_args())))
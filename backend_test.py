@@ -1,24 +1,28 @@
 #!/usr/bin/env python3
 
+import os
 import requests
 import sys
 import json
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 class ControleVendaAPITester:
-    def __init__(self, base_url="https://controle-vendas-1.preview.emergentagent.com"):
-        self.base_url = base_url
-        self.session_token = "test_session_1766496853344"  # From mongosh creation
+    def __init__(self, base_url=None):
+        self.base_url = base_url or os.environ.get("BACKEND_URL", "https://controle-vendas-1.preview.emergentagent.com")
+        self.session_token = os.environ.get("TEST_SESSION_TOKEN", "test_session_1766496853344")  # From mongosh creation
         self.tests_run = 0
         self.tests_passed = 0
         self.test_results = []
 
-    def run_test(self, name, method, endpoint, expected_status, data=None, description=""):
+    def run_test(self, name, method, endpoint, expected_status, data=None, description="", headers=None, raw=False):
         """Run a single API test"""
         url = f"{self.base_url}/api/{endpoint}"
         headers = {
             'Content-Type': 'application/json',
-            'Authorization': f'Bearer {self.session_token}'
+            'Authorization': f'Bearer {self.session_token}',
+            **(headers or {})
         }
 
         self.tests_run += 1
@@ -33,6 +37,8 @@ class ControleVendaAPITester:
                 response = requests.post(url, json=data, headers=headers, timeout=10)
             elif method == 'PUT':
                 response = requests.put(url, json=data, headers=headers, timeout=10)
+            elif method == 'PATCH':
+                response = requests.patch(url, json=data, headers=headers, timeout=10)
             elif method == 'DELETE':
                 response = requests.delete(url, headers=headers, timeout=10)
 
@@ -59,6 +65,8 @@ class ControleVendaAPITester:
                 "response_preview": response.text[:100] if not success else "OK"
             })
 
+            if raw:
+                return success, response.text if success else ""
             return success, response.json() if success and response.text else {}
 
         except Exception as e:
@@ -74,6 +82,48 @@ class ControleVendaAPITester:
             })
             return False, {}
 
+    def check(self, name, condition, detail=""):
+        """Record a behavioural assertion on data returned by earlier calls"""
+        self.tests_run += 1
+        if condition:
+            self.tests_passed += 1
+            print(f"✅ Check passed - {name}")
+        else:
+            print(f"❌ Check failed - {name}: {detail}")
+        self.test_results.append({
+            "name": name,
+            "method": "CHECK",
+            "endpoint": "",
+            "expected_status": None,
+            "actual_status": None,
+            "success": bool(condition),
+            "response_preview": "OK" if condition else str(detail)[:100]
+        })
+        return bool(condition)
+
+    def create_test_product(self, name, colors=None, purchase_price=10.0, sale_price=20.0):
+        """Create a throwaway product with a unique barcode"""
+        success, product = self.run_test(
+            f"Create Product ({name})",
+            "POST",
+            "products",
+            200,
+            data={
+                "name": name,
+                "barcode": f"T{uuid.uuid4().hex[:11]}",
+                "purchase_price": purchase_price,
+                "sale_price": sale_price,
+                "currency": "MZN",
+                "colors": colors or []
+            },
+            description=f"Create product for {name} tests"
+        )
+        return product if success else None
+
+    def get_stock(self, product_id):
+        _, product = self.run_test("Get Product Stock", "GET", f"products/{product_id}", 200)
+        return product.get("current_stock")
+
     def test_auth_endpoints(self):
         """Test authentication endpoints"""
         print("\n" + "="*50)
@@ -91,6 +141,37 @@ class ControleVendaAPITester:
         
         if success:
             self.current_user = user_data
+            
+            _, before = self.run_test(
+                "Session Cache Stats (before)",
+                "GET",
+                "health/session-cache",
+                200,
+                description="Get session cache hit/miss counters"
+            )
+            
+            # Second call should be served from the session cache
+            self.run_test(
+                "Get Current User (cached)",
+                "GET",
+                "auth/me",
+                200,
+                description="Repeat auth lookup through the session cache"
+            )
+            
+            success, after = self.run_test(
+                "Session Cache Stats (after)",
+                "GET",
+                "health/session-cache",
+                200,
+                description="Get session cache hit/miss counters"
+            )
+            if success and before:
+                # Cada pedido autenticado com a sessão já em cache conta um hit e nenhum miss
+                self.check("Cached lookups count as hits", after["hits"] >= before["hits"] + 2,
+                           f"hits {before['hits']} -> {after['hits']}")
+                self.check("Cached lookups do not miss", after["misses"] == before["misses"],
+                           f"misses {before['misses']} -> {after['misses']}")
             return True
         return False
 
@@ -223,6 +304,40 @@ class ControleVendaAPITester:
             description="Add stock exit movement"
         )
         
+        # Batch checkout (one request for the whole cart)
+        batch = {
+            "items": [
+                {"product_id": product_id, "type": "saida", "quantity": 1},
+                {"product_id": product_id, "type": "saida", "quantity": 2}
+            ]
+        }
+        
+        self.run_test(
+            "Create Movements Batch",
+            "POST",
+            "movements/batch",
+            200,
+            data=batch,
+            description="Apply a multi-item checkout in one request"
+        )
+        
+        # Batch exceeding stock must be rejected without applying any line
+        oversold_batch = {
+            "items": [
+                {"product_id": product_id, "type": "saida", "quantity": 1},
+                {"product_id": product_id, "type": "saida", "quantity": 1000}
+            ]
+        }
+        
+        self.run_test(
+            "Create Movements Batch (insufficient stock)",
+            "POST",
+            "movements/batch",
+            400,
+            data=oversold_batch,
+            description="Reject the whole cart when one line lacks stock"
+        )
+        
         # Get movements for specific product
         self.run_test(
             "Get Product Movements",
@@ -232,6 +347,158 @@ class ControleVendaAPITester:
             description=f"Get movements for product {product_id}"
         )
 
+    def test_patch_product(self):
+        """Test sparse PATCH updates, color deltas and the barcode check"""
+        print("\n" + "="*50)
+        print("TESTING PRODUCT PATCH")
+        print("="*50)
+        
+        product = self.create_test_product("Patch", colors=[{"color": "preto", "quantity": 5}])
+        other = self.create_test_product("Patch Other")
+        if not product or not other:
+            return
+        product_id = product["product_id"]
+        
+        success, patched = self.run_test("Patch Sale Price", "PATCH", f"products/{product_id}", 200,
+                                         data={"sale_price": 99.0}, description="Only the sent field changes")
+        if success:
+            self.check("PATCH updates the sent field", patched["sale_price"] == 99.0, patched["sale_price"])
+            self.check("PATCH keeps fields that were not sent",
+                       patched["name"] == product["name"] and patched["purchase_price"] == product["purchase_price"],
+                       patched)
+        
+        success, patched = self.run_test("Patch Color Delta", "PATCH", f"products/{product_id}", 200,
+                                         data={"color_deltas": [{"color": "preto", "delta": 3}]})
+        if success:
+            self.check("Color delta applied to the color", patched["colors"][0]["quantity"] == 8, patched["colors"])
+            self.check("Color delta applied to total stock", patched["current_stock"] == 8, patched["current_stock"])
+        self.run_test("Patch Color Delta (insufficient stock)", "PATCH", f"products/{product_id}", 400,
+                      data={"color_deltas": [{"color": "preto", "delta": -100}]})
+        self.check("Rejected delta leaves stock unchanged", self.get_stock(product_id) == 8, "expected stock 8")
+        
+        self.run_test("Patch Duplicate Barcode", "PATCH", f"products/{product_id}", 400,
+                      data={"barcode": other["barcode"]}, description="Barcode already used by another product")
+        self.run_test("Patch Colors And Deltas", "PATCH", f"products/{product_id}", 400,
+                      data={"colors": [{"color": "preto", "quantity": 1}],
+                            "color_deltas": [{"color": "preto", "delta": 1}]})
+        
+        self.run_test("Delete Patch Product", "DELETE", f"products/{product_id}", 200)
+        self.run_test("Delete Patch Other Product", "DELETE", f"products/{other['product_id']}", 200)
+
+    def test_reprice(self):
+        """Test bulk repricing: dry run previews without writing, apply writes"""
+        print("\n" + "="*50)
+        print("TESTING BULK REPRICING")
+        print("="*50)
+        
+        product = self.create_test_product("Reprice", purchase_price=40.0, sale_price=45.0)
+        if not product:
+            return
+        product_id = product["product_id"]
+        rule = {"mode": "markup", "value": 50, "filters": {"product_ids": [product_id]}}
+        
+        success, preview = self.run_test("Reprice Dry Run", "POST", "products/reprice", 200,
+                                         data={**rule, "dry_run": True}, raw=True)
+        if success:
+            rows = [json.loads(line) for line in preview.splitlines() if line.strip()]
+            self.check("Dry run previews the filtered product",
+                       len(rows) == 1 and rows[0]["product_id"] == product_id, rows)
+            self.check("Dry run computes the new price", rows and rows[0]["new_sale_price"] == 60.0, rows)
+        _, unchanged = self.run_test("Get Product After Dry Run", "GET", f"products/{product_id}", 200)
+        self.check("Dry run does not write", unchanged.get("sale_price") == 45.0, unchanged.get("sale_price"))
+        
+        success, report = self.run_test("Reprice Apply", "POST", "products/reprice", 200,
+                                        data={**rule, "dry_run": False})
+        if success:
+            self.check("Apply reports one update", report.get("updated") == 1 and report.get("conflicts") == 0, report)
+        _, repriced = self.run_test("Get Product After Apply", "GET", f"products/{product_id}", 200)
+        self.check("Apply writes the new price", repriced.get("sale_price") == 60.0, repriced.get("sale_price"))
+        
+        self.run_test("Delete Reprice Product", "DELETE", f"products/{product_id}", 200)
+
+    def test_oversell_race(self):
+        """Concurrent exits must never sell more than the available stock"""
+        print("\n" + "="*50)
+        print("TESTING CONCURRENT STOCK EXITS")
+        print("="*50)
+        
+        product = self.create_test_product("Oversell", colors=[{"color": "preto", "quantity": 5}])
+        if not product:
+            return
+        product_id = product["product_id"]
+        headers = {'Content-Type': 'application/json', 'Authorization': f'Bearer {self.session_token}'}
+        movement = {"product_id": product_id, "type": "saida", "quantity": 1, "color": "preto"}
+        
+        def sell(_):
+            return requests.post(f"{self.base_url}/api/movements", json=movement, headers=headers, timeout=30).status_code
+        
+        with ThreadPoolExecutor(max_workers=10) as pool:
+            statuses = list(pool.map(sell, range(10)))
+        self.check("Exactly the available units were sold", statuses.count(200) == 5, statuses)
+        self.check("Remaining exits rejected for insufficient stock", statuses.count(400) == 5, statuses)
+        self.check("Stock never goes negative", self.get_stock(product_id) == 0, "expected stock 0")
+        self.run_test("Delete Oversell Product", "DELETE", f"products/{product_id}", 200)
+
+    def test_sync_endpoints(self):
+        """Test offline sync pull/push, idempotent replays and tombstones"""
+        print("\n" + "="*50)
+        print("TESTING SYNC ENDPOINTS")
+        print("="*50)
+        
+        product = self.create_test_product("Sync", colors=[{"color": "preto", "quantity": 10}])
+        if not product:
+            return
+        product_id = product["product_id"]
+        
+        success, full = self.run_test("Sync Pull (full)", "GET", "sync", 200, description="First sync returns everything")
+        if success:
+            self.check("Full sync is a reset", full.get("reset") is True, full.get("reset"))
+            self.check("Full sync includes new product",
+                       any(p["product_id"] == product_id for p in full.get("products", [])), "product missing")
+        
+        success, empty = self.run_test("Sync Pull (empty token)", "GET", "sync?since=", 200,
+                                       description="An empty token behaves like a full sync")
+        if success:
+            self.check("Empty token is a reset", empty.get("reset") is True, empty.get("reset"))
+        
+        # O mesmo movimento enviado duas vezes só é aplicado uma vez
+        movement_id = f"test_{uuid.uuid4().hex[:16]}"
+        push = {
+            "since": full.get("next"),
+            "movements": [{"movement_id": movement_id, "product_id": product_id, "type": "saida",
+                           "quantity": 2, "color": "preto"}]
+        }
+        success, first = self.run_test("Sync Push", "POST", "sync", 200, data=push)
+        if success:
+            self.check("Pushed movement applied", first["results"][0]["status"] == "applied", first["results"])
+        success, replay = self.run_test("Sync Push (replay)", "POST", "sync", 200, data=push)
+        if success:
+            self.check("Replayed movement reported as duplicate", replay["results"][0]["status"] == "duplicate",
+                       replay["results"])
+        self.check("Replayed push applied once", self.get_stock(product_id) == 8, "expected stock 8")
+        
+        # Idempotency-Key: repetir o pedido devolve o mesmo movimento
+        key = f"test_{uuid.uuid4().hex[:16]}"
+        movement = {"product_id": product_id, "type": "saida", "quantity": 1, "color": "preto"}
+        _, first_movement = self.run_test("Create Movement (Idempotency-Key)", "POST", "movements", 200,
+                                          data=movement, headers={"Idempotency-Key": key})
+        _, second_movement = self.run_test("Create Movement (Idempotency-Key replay)", "POST", "movements", 200,
+                                           data=movement, headers={"Idempotency-Key": key})
+        self.check("Idempotent replay returns the original movement",
+                   first_movement.get("movement_id") == second_movement.get("movement_id") == key,
+                   (first_movement.get("movement_id"), second_movement.get("movement_id")))
+        self.check("Idempotent replay applied once", self.get_stock(product_id) == 7, "expected stock 7")
+        
+        # Apagar deixa um tombstone para quem já tinha sincronizado
+        success, before_delete = self.run_test("Sync Pull (incremental)", "GET", f"sync?since={full.get('next')}", 200)
+        self.run_test("Delete Sync Product", "DELETE", f"products/{product_id}", 200)
+        if success:
+            token = before_delete["next"]
+            success, after_delete = self.run_test("Sync Pull (after delete)", "GET", f"sync?since={token}", 200)
+            if success:
+                self.check("Deleted product sent as tombstone",
+                           product_id in after_delete.get("deleted_product_ids", []), after_delete)
+
     def test_currency_endpoints(self):
         """Test currency conversion endpoints"""
         print("\n" + "="*50)
@@ -277,6 +544,77 @@ class ControleVendaAPITester:
             description="Get dashboard summary data"
         )
 
+    def test_rollup_consistency(self):
+        """Summary totals must follow product and movement writes exactly"""
+        print("\n" + "="*50)
+        print("TESTING REPORT ROLLUP CONSISTENCY")
+        print("="*50)
+        
+        success, before = self.run_test("Get Summary (before)", "GET", "reports/summary", 200)
+        if not success:
+            return
+        product = self.create_test_product("Rollup", colors=[{"color": "preto", "quantity": 4}],
+                                           purchase_price=10.0, sale_price=20.0)
+        if not product:
+            return
+        product_id = product["product_id"]
+        self.run_test("Rollup Entry", "POST", "movements", 200,
+                      data={"product_id": product_id, "type": "entrada", "quantity": 3, "color": "preto"})
+        self.run_test("Rollup Exit", "POST", "movements", 200,
+                      data={"product_id": product_id, "type": "saida", "quantity": 2, "color": "preto"})
+        
+        success, after = self.run_test("Get Summary (after)", "GET", "reports/summary", 200)
+        if success:
+            # 4 + 3 - 2 = 5 unidades a 10 (compra) / 20 (venda)
+            expected = {"products_count": 1, "total_stock_value": 50.0, "total_potential_revenue": 100.0,
+                        "total_entries": 1, "total_exits": 1}
+            for field, delta in expected.items():
+                self.check(f"Summary {field} follows writes", abs(after[field] - before[field] - delta) < 1e-6,
+                           f"{before[field]} -> {after[field]}, expected +{delta}")
+        
+        self.run_test("Delete Rollup Product", "DELETE", f"products/{product_id}", 200)
+        success, final = self.run_test("Get Summary (after delete)", "GET", "reports/summary", 200)
+        if success:
+            for field in ("products_count", "total_stock_value", "total_potential_revenue"):
+                self.check(f"Summary {field} restored after delete", abs(final[field] - before[field]) < 1e-6,
+                           f"{before[field]} -> {final[field]}")
+
+    def test_valuation(self):
+        """Test weighted-average and FIFO COGS from recorded unit costs"""
+        print("\n" + "="*50)
+        print("TESTING INVENTORY VALUATION")
+        print("="*50)
+        
+        product = self.create_test_product("Valuation", purchase_price=5.0, sale_price=20.0)
+        if not product:
+            return
+        product_id = product["product_id"]
+        for quantity, unit_cost in ((10, 5.0), (10, 8.0)):
+            self.run_test(f"Valuation Entry @ {unit_cost}", "POST", "movements", 200,
+                          data={"product_id": product_id, "type": "entrada", "quantity": quantity, "unit_cost": unit_cost})
+        success, sale = self.run_test("Valuation Exit", "POST", "movements", 200,
+                                      data={"product_id": product_id, "type": "saida", "quantity": 15})
+        if success:
+            self.check("Exit records the product sale price", sale.get("unit_price") == 20.0, sale.get("unit_price"))
+        
+        # 20 unidades (10 a 5, 10 a 8), 15 vendidas a 20
+        expected = {"average": {"cogs": 97.5, "closing_value": 32.5}, "fifo": {"cogs": 90.0, "closing_value": 40.0}}
+        for method, values in expected.items():
+            success, report = self.run_test(f"Valuation ({method})", "GET",
+                                            f"reports/valuation?method={method}&product_id={product_id}", 200)
+            if not success:
+                continue
+            item = report["products"][0]
+            self.check(f"{method} revenue", item["revenue"] == 300.0, item["revenue"])
+            self.check(f"{method} COGS", item["cogs"] == values["cogs"], item["cogs"])
+            self.check(f"{method} gross margin", item["gross_margin"] == 300.0 - values["cogs"], item["gross_margin"])
+            self.check(f"{method} closing stock",
+                       item["closing_quantity"] == 5 and item["closing_value"] == values["closing_value"], item)
+        
+        self.run_test("Valuation Invalid Period", "GET",
+                      "reports/valuation?date_from=2025-02-01T00:00:00Z&date_to=2025-01-01T00:00:00Z", 400)
+        self.run_test("Delete Valuation Product", "DELETE", f"products/{product_id}", 200)
+
     def test_support_endpoints(self):
         """Test support endpoints"""
         print("\n" + "="*50)
@@ -356,8 +694,14 @@ def main():
         product_id = product_data['product_id']
     
     tester.test_movements_endpoints(product_id)
+    tester.test_patch_product()
+    tester.test_reprice()
+    tester.test_oversell_race()
+    tester.test_sync_endpoints()
     tester.test_currency_endpoints()
     tester.test_reports_endpoints()
+    tester.test_rollup_consistency()
+    tester.test_valuation()
     tester.test_support_endpoints()
     
     # Clean up
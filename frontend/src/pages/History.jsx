@@ -39,7 +39,7 @@ const History = ({ user }) => {
     try {
       const [movementsRes, productsRes] = await Promise.all([
         axios.get(`${BACKEND_URL}/api/movements`, { withCredentials: true }),
-        axios.get(`${BACKEND_URL}/api/products`, { withCredentials: true })
+        axios.get(`${BACKEND_URL}/api/products?fields=name,current_stock,colors`, { withCredentials: true })
       ]);
       setMovements(movementsRes.data);
       setProducts(productsRes.data);
@@ -57,9 +57,20 @@ const Products = ({ user }) => {
     
     try {
       if (editingProduct) {
-        await axios.put(
+        // Envia só os campos alterados (a imagem só volta a subir se mudou)
+        const changes = {};
+        ['name', 'barcode', 'currency', 'image'].forEach((field) => {
+          if (formData[field] !== editingProduct[field]) changes[field] = formData[field];
+        });
+        ['purchase_price', 'sale_price'].forEach((field) => {
+          if (parseFloat(formData[field]) !== editingProduct[field]) changes[field] = formData[field];
+        });
+        if (JSON.stringify(formData.colors) !== JSON.stringify(editingProduct.colors || [])) {
+          changes.colors = formData.colors;
+        }
+        await axios.patch(
           `${BACKEND_URL}/api/products/${editingProduct.product_id}`,
-          formData,
+          changes,
           { withCredentials: true }
         );
         toast.success(t('product_updated'));
@@ -451,7 +462,7 @@ const Products = ({ user }) => {
                   {product.image ? (
                     <div className="mb-4 overflow-hidden rounded-lg">
                       <img 
-                        src={product.image} 
+                        src={product.thumbnail || product.image} 
                         alt={product.name}
                         className="w-full h-40 object-cover hover:scale-105 transition-transform duration-200"
                       />
@@ -24,7 +24,7 @@ const Reports = ({ user }) => {
     try {
       const [summaryRes, productsRes] = await Promise.all([
         axios.get(`${BACKEND_URL}/api/reports/summary`, { withCredentials: true }),
-        axios.get(`${BACKEND_URL}/api/products`, { withCredentials: true })
+        axios.get(`${BACKEND_URL}/api/products?view=summary`, { withCredentials: true })
       ]);
       setSummary(summaryRes.data);
       setProducts(productsRes.data);
@@ -253,7 +253,7 @@ const Scanner = ({ user }) => {
             {product && (
               <div className="space-y-4">
                 {product.image && (
-                  <img src={product.image} alt={product.name} className="w-full h-40 object-cover rounded-lg" />
+                  <img src={product.thumbnail || product.image} alt={product.name} className="w-full h-40 object-cover rounded-lg" />
                 )}
                 <div>
                   <h3 className="font-bold text-xl">{product.name}</h3>
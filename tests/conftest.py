@@ -0,0 +1,98 @@
+"""Testes em processo: server.app via o transporte ASGI do httpx sobre uma base mongomock-motor."""
+import os
+import sys
+import uuid
+from datetime import datetime, timezone, timedelta
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "controle_venda_test")
+# O mongomock não tem transações: as escritas de stock usam o outbox
+os.environ.setdefault("MONGO_TRANSACTIONS", "0")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+import httpx  # noqa: E402
+
+import server  # noqa: E402
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def db(monkeypatch, tmp_path):
+    # Base nova por teste, com os índices declarados, e caches do processo vazios
+    client = mongomock_motor.AsyncMongoMockClient()
+    database = client[os.environ["DB_NAME"]]
+    monkeypatch.setattr(server, "client", client)
+    monkeypatch.setattr(server, "db", database)
+    monkeypatch.setattr(server, "session_cache", server.SessionCache(server.SESSION_CACHE_SIZE, server.SESSION_CACHE_TTL))
+    monkeypatch.setattr(server, "barcode_index", server.BarcodeIndex(server.BARCODE_INDEX_MAX_PRODUCTS))
+    monkeypatch.setattr(server, "change_bus", server.ChangeBus(server.STREAM_QUEUE_SIZE))
+    monkeypatch.setattr(server, "IMAGE_DIR", tmp_path / "images")
+    monkeypatch.setattr(server, "_image_store", None)
+    await server.ensure_indexes()
+    return database
+
+
+@pytest.fixture
+def make_user(db):
+    async def make(user_id=None):
+        user_id = user_id or f"user_{uuid.uuid4().hex[:12]}"
+        now = datetime.now(timezone.utc)
+        await db.users.insert_one({
+            "user_id": user_id, "email": f"{user_id}@test.local", "name": user_id, "created_at": now
+        })
+        session_token = f"session_{uuid.uuid4().hex}"
+        await db.user_sessions.insert_one({
+            "user_id": user_id, "session_token": session_token,
+            "expires_at": now + timedelta(days=1), "created_at": now
+        })
+        return {"user_id": user_id, "session_token": session_token}
+    return make
+
+
+@pytest.fixture
+async def make_client():
+    clients = []
+
+    def make(session_token=None, headers=None):
+        headers = dict(headers or {})
+        if session_token:
+            headers["Authorization"] = f"Bearer {session_token}"
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://test", headers=headers)
+        clients.append(client)
+        return client
+
+    yield make
+    for client in clients:
+        await client.aclose()
+
+
+@pytest.fixture
+async def user(make_user):
+    return await make_user()
+
+
+@pytest.fixture
+def api(user, make_client):
+    return make_client(user["session_token"])
+
+
+@pytest.fixture
+def create_product(api):
+    async def create(client=None, **fields):
+        body = {
+            "name": "Produto", "barcode": uuid.uuid4().hex[:12], "purchase_price": 10, "sale_price": 25,
+            "colors": [{"color": "preto", "quantity": 20}], **fields
+        }
+        res = await (client or api).post("/api/products", json=body)
+        assert res.status_code == 200, res.text
+        return res.json()
+    return create
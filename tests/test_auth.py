@@ -0,0 +1,53 @@
+import asyncio
+
+import httpx
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeOAuth:
+    # Responde ao pedido de session-data do fornecedor de OAuth
+    def __init__(self, email="ana@test.local", session_token="oauth-token-1"):
+        self.payload = {"email": email, "name": "Ana", "picture": None, "session_token": session_token}
+
+    async def get(self, url, headers=None):
+        await asyncio.sleep(0)
+        return httpx.Response(200, json=self.payload, request=httpx.Request("GET", url))
+
+
+async def login(make_client, session_id="sid"):
+    return await make_client().post("/api/auth/session", json={"session_id": session_id})
+
+
+async def test_concurrent_first_logins_create_one_user(db, make_client, monkeypatch):
+    monkeypatch.setattr(server, "outbound_http", FakeOAuth())
+    responses = await asyncio.gather(*(login(make_client) for _ in range(5)))
+    assert [r.status_code for r in responses] == [200] * 5
+    assert len({r.json()["user_id"] for r in responses}) == 1
+    assert await db.users.count_documents({"email": "ana@test.local"}) == 1
+    assert await db.user_sessions.count_documents({"session_token": "oauth-token-1"}) == 1
+
+
+async def test_reused_session_token_is_reassigned(db, make_client, monkeypatch):
+    monkeypatch.setattr(server, "outbound_http", FakeOAuth("ana@test.local", "shared-token"))
+    first = (await login(make_client)).json()
+    me = await make_client("shared-token").get("/api/auth/me")
+    assert me.json()["user_id"] == first["user_id"]
+
+    monkeypatch.setattr(server, "outbound_http", FakeOAuth("rui@test.local", "shared-token"))
+    second = await login(make_client)
+    assert second.status_code == 200
+    assert second.json()["user_id"] != first["user_id"]
+    # A sessão em cache do primeiro utilizador é descartada
+    me = await make_client("shared-token").get("/api/auth/me")
+    assert me.json()["user_id"] == second.json()["user_id"]
+
+
+async def test_existing_user_keeps_its_id(db, make_user, make_client, monkeypatch):
+    existing = await make_user("user_existing")
+    monkeypatch.setattr(server, "outbound_http", FakeOAuth(f"{existing['user_id']}@test.local", "oauth-token-2"))
+    res = await login(make_client)
+    assert res.json()["user_id"] == "user_existing"
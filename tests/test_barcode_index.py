@@ -0,0 +1,70 @@
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def scan(client, barcode):
+    res = await client.get(f"/api/products/barcode/{barcode}")
+    assert res.status_code == 200
+    return res.json()
+
+
+async def test_lookups_are_served_from_memory_and_follow_writes(db, api, create_product):
+    product = await create_product(barcode="7890001")
+    assert (await scan(api, "7890001"))["product"]["current_stock"] == 20
+    res = await api.post("/api/movements", json={
+        "product_id": product["product_id"], "type": "saida", "quantity": 5, "color": "preto"
+    })
+    assert res.status_code == 200
+    res = await api.patch(f"/api/products/{product['product_id']}", json={"barcode": "7890002"})
+    assert res.status_code == 200
+    assert (await scan(api, "7890001")) == {"found": False}
+    found = (await scan(api, "7890002"))["product"]
+    assert (found["product_id"], found["current_stock"]) == (product["product_id"], 15)
+    stats = server.barcode_index.stats()
+    assert (stats["loads"], stats["hits"], stats["bypasses"]) == (1, 2, 0)
+
+
+async def test_inserts_evict_the_coldest_tenant(db, make_user, make_client, create_product, monkeypatch):
+    monkeypatch.setattr(server.barcode_index, "max_products", 3)
+    cold, warm = [make_client((await make_user())["session_token"]) for _ in range(2)]
+    for barcode in ("1000001", "1000002"):
+        await create_product(cold, barcode=barcode)
+    await create_product(warm, barcode="2000001")
+    await scan(cold, "1000001")
+    await scan(warm, "2000001")
+    assert server.barcode_index.size == 3
+
+    await create_product(warm, barcode="2000002")
+    stats = server.barcode_index.stats()
+    assert (stats["tenants"], stats["products"], stats["evictions"]) == (1, 2, 1)
+    assert (await scan(warm, "2000002"))["found"]
+    assert (await scan(cold, "1000002"))["found"]
+    assert server.barcode_index.size <= 3
+
+
+async def test_a_tenant_that_outgrows_the_budget_is_bypassed(db, api, create_product, monkeypatch):
+    monkeypatch.setattr(server.barcode_index, "max_products", 2)
+    for barcode in ("3000001", "3000002"):
+        await create_product(barcode=barcode)
+    await scan(api, "3000001")
+    assert server.barcode_index.size == 2
+
+    await create_product(barcode="3000003")
+    stats = server.barcode_index.stats()
+    assert (stats["tenants"], stats["bypassed_tenants"], stats["products"]) == (0, 1, 0)
+    # Sem nova contagem nem carregamento: consulta directa
+    assert (await scan(api, "3000003"))["found"]
+    assert server.barcode_index.stats()["loads"] == 1
+    assert server.barcode_index.bypasses == 1
+
+
+async def test_catalogs_over_the_budget_are_never_loaded(db, api, create_product, monkeypatch):
+    monkeypatch.setattr(server.barcode_index, "max_products", 1)
+    for barcode in ("4000001", "4000002"):
+        await create_product(barcode=barcode)
+    assert (await scan(api, "4000002"))["found"]
+    stats = server.barcode_index.stats()
+    assert (stats["loads"], stats["tenants"], stats["bypassed_tenants"]) == (0, 0, 1)
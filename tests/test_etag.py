@@ -0,0 +1,82 @@
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def etag(api, path="/api/products"):
+    res = await api.get(path)
+    assert res.status_code == 200
+    return res.headers["ETag"]
+
+
+async def test_unchanged_reads_return_304(db, api, create_product):
+    await create_product()
+    tag = await etag(api)
+    res = await api.get("/api/products", headers={"If-None-Match": tag})
+    assert res.status_code == 304
+    assert res.headers["ETag"] == tag
+    assert res.content == b""
+
+
+async def test_writes_change_the_etag(db, api, create_product):
+    product = await create_product()
+    tag = await etag(api)
+    res = await api.post("/api/movements", json={
+        "product_id": product["product_id"], "type": "entrada", "quantity": 1, "color": "preto"
+    })
+    assert res.status_code == 200
+    res = await api.get("/api/products", headers={"If-None-Match": tag})
+    assert res.status_code == 200
+    assert res.headers["ETag"] != tag
+
+
+async def test_etag_depends_on_the_query(db, api, create_product):
+    await create_product()
+    assert await etag(api, "/api/products?limit=1") != await etag(api, "/api/products?limit=2")
+
+
+async def test_backfill_movement_costs_bumps_the_version(db, api, user, create_product):
+    product = await create_product()
+    await db.stock_movements.insert_one({
+        "movement_id": "mov_legacy", "user_id": user["user_id"], "product_id": product["product_id"],
+        "type": "saida", "quantity": 1, "unit_price": None, "change_seq": 1
+    })
+    tag = await etag(api)
+    assert await server.backfill_movement_costs(user["user_id"]) == 1
+    assert await etag(api) != tag
+    # Sem movimentos por preencher, nada muda
+    tag = await etag(api)
+    assert await server.backfill_movement_costs(user["user_id"]) == 0
+    assert await etag(api) == tag
+
+
+async def test_backfill_sales_buckets_bumps_the_version(db, api, user, create_product):
+    await create_product()
+    tag = await etag(api)
+    await server.backfill_sales_buckets(user["user_id"])
+    assert await etag(api) != tag
+
+
+async def test_backfill_search_keys_bumps_the_version(db, api, user, create_product):
+    product = await create_product()
+    await db.products.update_one({"product_id": product["product_id"]}, {"$unset": {"search_keys": ""}})
+    tag = await etag(api)
+    assert await server.backfill_search_keys() == 1
+    assert await etag(api) != tag
+
+
+async def test_recovered_movements_bump_the_version(db, api, user, create_product):
+    product = await create_product()
+    movement = server.build_movement_doc(
+        server.MovementCreate(product_id=product["product_id"], type="entrada", quantity=2, color="preto"),
+        user["user_id"]
+    )
+    await db.products.update_one(
+        {"product_id": product["product_id"]},
+        {"$inc": {"current_stock": 2, "colors.0.quantity": 2}, "$push": {"pending_movements": movement}}
+    )
+    tag = await etag(api)
+    await server.flush_pending_movements()
+    assert await etag(api) != tag
@@ -0,0 +1,73 @@
+import base64
+import io
+
+import pytest
+from PIL import Image
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+def png(width=64, height=48, mode="RGB"):
+    buffer = io.BytesIO()
+    Image.new(mode, (width, height)).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+async def upload(api, data, name="foto.png"):
+    return await api.post("/api/images", files={"file": (name, data, "image/png")})
+
+
+async def test_upload_stores_the_original_and_a_thumbnail(db, api, monkeypatch):
+    monkeypatch.setattr(server, "IMAGE_THUMBNAIL_SIZE", 16)
+    data = png()
+    res = await upload(api, data)
+    assert res.status_code == 200, res.text
+    body = res.json()
+    meta = await db.images.find_one({"image_id": body["image_id"]})
+    assert (meta["width"], meta["height"], meta["content_type"]) == (64, 48, "image/png")
+
+    original = await api.get(body["url"])
+    assert original.content == data
+    assert original.headers["Cache-Control"] == server.IMAGE_CACHE_CONTROL
+    thumb = await api.get(body["thumbnail_url"])
+    assert thumb.headers["content-type"] == "image/webp"
+    assert max(Image.open(io.BytesIO(thumb.content)).size) == 16
+    assert (await api.get(body["url"], headers={"If-None-Match": original.headers["ETag"]})).status_code == 304
+
+
+async def test_identical_uploads_are_stored_once(db, api):
+    first = (await upload(api, png())).json()
+    second = (await upload(api, png(), "copia.png")).json()
+    assert first["image_id"] == second["image_id"]
+    assert await db.images.count_documents({}) == 1
+
+
+async def test_embedded_images_move_to_the_store(db, api, create_product):
+    data_url = "data:image/png;base64," + base64.b64encode(png()).decode()
+    product = await create_product(image=data_url)
+    assert product["image"].startswith(server.IMAGE_URL_PREFIX)
+    assert product["thumbnail"].endswith("?variant=thumb")
+
+
+async def test_rejects_oversized_and_invalid_uploads(db, api, monkeypatch):
+    assert (await upload(api, b"not an image")).status_code == 400
+    monkeypatch.setattr(server, "IMAGE_MAX_BYTES", 10)
+    assert (await upload(api, png())).status_code == 413
+
+
+async def test_rejects_images_above_the_pixel_limit(db, api, monkeypatch):
+    monkeypatch.setattr(server, "IMAGE_MAX_PIXELS", 1000)
+    res = await upload(api, png(100, 100))
+    assert res.status_code == 400
+    assert res.json()["detail"] == "Image dimensions too large"
+    assert await db.images.count_documents({}) == 0
+
+
+async def test_decompression_bombs_are_a_client_error(db, api, monkeypatch):
+    # Acima do dobro do limite do Pillow o Image.open recusa a imagem
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 100)
+    res = await upload(api, png(100, 100, "1"))
+    assert res.status_code == 400
+    assert res.json()["detail"] == "Image dimensions too large"
@@ -0,0 +1,93 @@
+import csv
+import io
+import json
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+CSV_HEADER = "name,barcode,purchase_price,sale_price,colors\n"
+
+
+async def import_file(api, content, filename="produtos.csv", **params):
+    res = await api.post("/api/products/import", params=params, files={"file": (filename, content.encode())})
+    assert res.status_code == 200, res.text
+    return res.json()
+
+
+async def assert_rollup_consistent(user_id):
+    check = await server.check_rollup(user_id)
+    assert check["consistent"], check["differences"]
+
+
+async def test_csv_import_creates_products(db, api, user):
+    report = await import_file(api, CSV_HEADER + "Camisa,5001,10,20,preto:3;azul:2\nCalça,5002,15,30,\n")
+    assert (report["processed"], report["created"], report["updated"], report["skipped"]) == (2, 2, 0, 0)
+    product = await db.products.find_one({"barcode": "5001"})
+    assert product["current_stock"] == 5
+    assert product["colors"] == [{"color": "preto", "quantity": 3}, {"color": "azul", "quantity": 2}]
+    await assert_rollup_consistent(user["user_id"])
+
+
+async def test_existing_barcodes_are_skipped_or_updated(db, api, user, create_product):
+    await create_product(barcode="6001", name="Antigo")
+    content = CSV_HEADER + "Novo,6001,12,24,preto:1\n"
+    report = await import_file(api, content)
+    assert (report["created"], report["skipped"]) == (0, 1)
+    assert report["errors"] == [{"row": 1, "barcode": "6001", "error": "Product with this barcode already exists"}]
+
+    report = await import_file(api, content, update_existing="true")
+    assert report["updated"] == 1
+    assert (await db.products.find_one({"barcode": "6001"}))["name"] == "Novo"
+    await assert_rollup_consistent(user["user_id"])
+
+
+async def test_invalid_and_duplicate_rows_are_reported(db, api):
+    content = CSV_HEADER + "A,7001,1,2,\n,7002,1,2,\nB,7003,1,2,preto\nC,7001,3,4,\n"
+    report = await import_file(api, content)
+    assert (report["processed"], report["created"], report["skipped"]) == (4, 1, 1)
+    assert [e["row"] for e in report["errors"]] == [2, 3, 1]
+    assert (await db.products.find_one({"barcode": "7001"}))["name"] == "C"
+
+
+async def test_ndjson_import(db, api):
+    lines = [{"name": "Saia", "barcode": "8001", "purchase_price": 5, "sale_price": 9, "reorder_threshold": 2}]
+    report = await import_file(api, "\n".join(json.dumps(line) for line in lines) + "\n", "produtos.ndjson")
+    assert report["created"] == 1
+    assert (await db.products.find_one({"barcode": "8001"}))["reorder_threshold"] == 2
+
+
+async def test_products_created_during_the_import_are_not_counted(db, api, user, monkeypatch):
+    resolve_product_image = server.resolve_product_image
+    created = []
+
+    async def racing_resolve(image):
+        # Outro pedido cria o mesmo código depois da verificação de existentes
+        if not created:
+            doc = {
+                "product_id": "prod_outro", "user_id": user["user_id"], "name": "Outro pedido", "barcode": "9001",
+                "purchase_price": 1, "sale_price": 2, "current_stock": 30, "colors": [{"color": "preto", "quantity": 30}]
+            }
+            await db.products.insert_one(dict(doc))
+            await server.rollup_product_created(user["user_id"], doc)
+            created.append(doc)
+        return await resolve_product_image(image)
+
+    monkeypatch.setattr(server, "resolve_product_image", racing_resolve)
+    report = await import_file(api, CSV_HEADER + "Importado,9001,10,20,preto:4\nSegundo,9002,10,20,\n")
+    assert (report["created"], report["skipped"]) == (1, 1)
+    assert report["errors"][0]["barcode"] == "9001"
+    assert (await db.products.find_one({"barcode": "9001"}))["name"] == "Outro pedido"
+    await assert_rollup_consistent(user["user_id"])
+
+
+async def test_export_round_trip(db, api, create_product):
+    await create_product(barcode="1201", colors=[{"color": "preto", "quantity": 2}], reorder_threshold=1)
+    res = await api.get("/api/products/export")
+    assert res.status_code == 200
+    [row] = list(csv.DictReader(io.StringIO(res.text)))
+    assert (row["barcode"], row["colors"], row["reorder_threshold"]) == ("1201", "preto:2", "1")
+    res = await api.get("/api/products/export", params={"format": "ndjson"})
+    assert json.loads(res.text.splitlines()[0])["barcode"] == "1201"
@@ -0,0 +1,58 @@
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+HEALTH_ENDPOINTS = [
+    "/api/health/indexes", "/api/health/barcode-index", "/api/health/http",
+    "/api/health/rates", "/api/health/stream", "/api/health/session-cache",
+]
+
+
+async def test_ensure_indexes_creates_every_declared_index(db):
+    status = await server.index_status()
+    assert status["missing_indexes"] == []
+    for collection, _, options in server.INDEXES:
+        assert options["name"] in status["indexes"][collection]
+
+
+async def test_ensure_indexes_drops_obsolete_indexes(db):
+    await db.stock_movements.create_index("movement_id", name="movement_id_unique", unique=True)
+    results = await server.ensure_indexes()
+    assert {"collection": "stock_movements", "index": "movement_id_unique", "status": "dropped"} in results
+    assert "movement_id_unique" not in await db.stock_movements.index_information()
+
+
+async def test_index_status_reports_missing_indexes(db):
+    await db.products.drop_index("user_barcode_unique")
+    assert "products.user_barcode_unique" in (await server.index_status())["missing_indexes"]
+
+
+async def test_unique_indexes_reject_duplicates(db, api, create_product):
+    product = await create_product(barcode="123456")
+    res = await api.post("/api/products", json={
+        "name": "Outro", "barcode": "123456", "purchase_price": 1, "sale_price": 2
+    })
+    assert res.status_code == 400
+    assert await db.products.count_documents({"barcode": product["barcode"]}) == 1
+
+
+@pytest.mark.parametrize("path", HEALTH_ENDPOINTS)
+async def test_health_endpoints_require_a_session(db, api, make_client, path):
+    assert (await make_client().get(path)).status_code == 401
+    assert (await api.get(path)).status_code == 200
+
+
+@pytest.mark.parametrize("path", HEALTH_ENDPOINTS)
+async def test_health_endpoints_use_the_health_token_when_set(db, api, make_client, monkeypatch, path):
+    monkeypatch.setattr(server, "HEALTH_TOKEN", "secret-token")
+    assert (await api.get(path)).status_code == 403
+    assert (await make_client(headers={"X-Health-Token": "wrong"}).get(path)).status_code == 403
+    assert (await make_client(headers={"X-Health-Token": "secret-token"}).get(path)).status_code == 200
+
+
+async def test_health_indexes_does_not_run_explain(db, api):
+    body = (await api.get("/api/health/indexes")).json()
+    assert body["missing_indexes"] == []
+    assert "queries" not in body
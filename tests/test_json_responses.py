@@ -0,0 +1,52 @@
+from datetime import datetime
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+def parse_dates(items, *fields):
+    return [{**item, **{f: datetime.fromisoformat(item[f]) for f in fields}} for item in items]
+
+
+async def listing(api, url, fast, monkeypatch):
+    monkeypatch.setattr(server, "FAST_JSON_ENABLED", fast)
+    res = await api.get(url)
+    assert res.status_code == 200
+    return res
+
+
+@pytest.mark.skipif(server.orjson is None, reason="orjson não instalado")
+async def test_fast_path_matches_the_validated_response(db, api, create_product, monkeypatch):
+    product = await create_product(colors=[{"color": "preto", "quantity": 5}, {"color": "azul", "quantity": 4}])
+    res = await api.post("/api/movements", json={
+        "product_id": product["product_id"], "type": "saida", "quantity": 2, "color": "azul"
+    })
+    assert res.status_code == 200
+
+    for url, date_field in (("/api/products", "created_at"), ("/api/movements", "date")):
+        validated = await listing(api, url, False, monkeypatch)
+        fast = await listing(api, url, True, monkeypatch)
+        assert isinstance(fast, type(validated))
+        assert parse_dates(fast.json(), date_field) == parse_dates(validated.json(), date_field)
+        assert fast.headers["ETag"] == validated.headers["ETag"]
+
+
+async def test_large_lists_are_compressed(db, api, create_product):
+    for i in range(12):
+        await create_product(name=f"Produto com um nome comprido {i}")
+    res = await api.get("/api/products", headers={"Accept-Encoding": "gzip"})
+    assert res.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in res.headers["Vary"]
+    assert len(res.json()) == 12
+    if server.brotli is not None:
+        res = await api.get("/api/products", headers={"Accept-Encoding": "br, gzip"})
+        assert (res.headers["Content-Encoding"], len(res.json())) == ("br", 12)
+
+
+async def test_small_responses_are_sent_as_is(db, api):
+    res = await api.get("/api/products", headers={"Accept-Encoding": "gzip, br"})
+    assert "Content-Encoding" not in res.headers
+    assert res.json() == []
@@ -0,0 +1,100 @@
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def severity(db, product_id):
+    doc = await db.products.find_one({"product_id": product_id}, {"_id": 0, "low_stock_severity": 1})
+    return doc.get("low_stock_severity")
+
+
+async def move(api, product, type_, quantity, color="preto"):
+    res = await api.post("/api/movements", json={
+        "product_id": product["product_id"], "type": type_, "quantity": quantity, "color": color
+    })
+    assert res.status_code == 200, res.text
+
+
+async def test_movements_set_and_clear_the_flag(db, api, create_product):
+    product = await create_product(reorder_threshold=16)
+    assert await severity(db, product["product_id"]) is None
+    await move(api, product, "saida", 8)
+    assert await severity(db, product["product_id"]) == 0.75
+    await move(api, product, "entrada", 10)
+    assert await severity(db, product["product_id"]) is None
+
+
+async def test_product_writes_maintain_the_flag(db, api, create_product):
+    product = await create_product(colors=[{"color": "preto", "quantity": 3}], reorder_threshold=6)
+    assert await severity(db, product["product_id"]) == 0.5
+    res = await api.patch(f"/api/products/{product['product_id']}", json={"reorder_threshold": 2})
+    assert res.status_code == 200
+    assert await severity(db, product["product_id"]) is None
+    res = await api.put(f"/api/products/{product['product_id']}", json={
+        "name": "Produto", "barcode": product["barcode"], "purchase_price": 10, "sale_price": 25,
+        "colors": [{"color": "preto", "quantity": 1}], "reorder_threshold": 4
+    })
+    assert res.status_code == 200
+    assert await severity(db, product["product_id"]) == 0.25
+
+
+async def test_color_threshold_marks_the_product(db, create_product):
+    product = await create_product(colors=[
+        {"color": "preto", "quantity": 30}, {"color": "azul", "quantity": 2, "reorder_threshold": 8}
+    ])
+    assert await severity(db, product["product_id"]) == 0.25
+
+
+async def test_report_is_sorted_by_severity_and_paginated(db, api, create_product):
+    quantities = [4, 0, 8, 2, 50]
+    products = [await create_product(colors=[{"color": "preto", "quantity": q}]) for q in quantities]
+    res = await api.get("/api/reports/low-stock", params={"limit": 2})
+    assert res.headers[server.TOTAL_COUNT_HEADER] == "4"
+    first = res.json()
+    assert [p["current_stock"] for p in first] == [0, 2]
+    assert first[0]["severity"] == 0
+    res = await api.get("/api/reports/low-stock", params={"limit": 2, "cursor": res.headers[server.NEXT_CURSOR_HEADER]})
+    assert [p["current_stock"] for p in res.json()] == [4, 8]
+    assert server.NEXT_CURSOR_HEADER not in res.headers
+    assert products[4]["product_id"] not in {p["product_id"] for p in first + res.json()}
+
+
+async def test_summary_counts_flagged_products(db, api, create_product):
+    for quantity in (1, 3, 40):
+        await create_product(colors=[{"color": "preto", "quantity": quantity}])
+    body = (await api.get("/api/reports/summary")).json()
+    assert body["low_stock_count"] == 2
+    assert [p["current_stock"] for p in body["low_stock_products"]] == [1, 3]
+
+
+async def test_user_stock_index_is_dropped(db):
+    await db.products.create_index([("user_id", 1), ("current_stock", 1)], name="user_stock")
+    await server.ensure_indexes()
+    indexes = await db.products.index_information()
+    assert "user_stock" not in indexes
+    assert "user_low_stock" in indexes
+
+
+async def test_rebuild_repairs_drift(db, api, user, create_product):
+    product = await create_product(colors=[{"color": "preto", "quantity": 2}])
+    await db.products.update_one({"product_id": product["product_id"]}, {"$unset": {"low_stock_severity": ""}})
+    check = await server.check_rollup(user["user_id"])
+    assert "low_stock_severity" in check["differences"]
+    await server.rebuild_rollup(user["user_id"])
+    assert await severity(db, product["product_id"]) == 0.2
+    assert (await server.check_rollup(user["user_id"]))["consistent"]
+
+
+async def test_rollup_from_an_older_schema_is_rebuilt(db, api, user, create_product):
+    product = await create_product(colors=[{"color": "preto", "quantity": 2}])
+    await db.products.update_one({"product_id": product["product_id"]}, {"$unset": {"low_stock_severity": ""}})
+    await db.report_rollups.update_one(
+        {"user_id": user["user_id"]}, {"$unset": {"schema": ""}, "$set": {"low_stock_product_ids": []}}
+    )
+    res = await api.get("/api/reports/low-stock")
+    assert [p["product_id"] for p in res.json()] == [product["product_id"]]
+    rollup = await db.report_rollups.find_one({"user_id": user["user_id"]})
+    assert rollup["schema"] == server.ROLLUP_SCHEMA
+    assert "low_stock_product_ids" not in rollup
@@ -0,0 +1,39 @@
+import fastapi.routing
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_fastapi_serialization_is_not_patched():
+    assert fastapi.routing.serialize_response.__module__ == "fastapi.routing"
+    assert all(isinstance(r, server.TimedRoute) for r in server.api_router.routes)
+
+
+async def test_response_model_serialization_is_timed(db, api, create_product, monkeypatch):
+    monkeypatch.setattr(server, "request_serialize_seconds", server.Counter())
+    for _ in range(3):
+        await create_product()
+    res = await api.get("/api/products")
+    assert res.status_code == 200
+    timings = dict(part.strip().split(";", 1) for part in res.headers["Server-Timing"].split(","))
+    assert set(timings) == {"db", "upstream", "serialize", "app", "total"}
+    assert server.request_serialize_seconds.values[("GET", "/api/products")] > 0
+
+
+async def test_timed_route_keeps_parameter_validation(db, api):
+    assert (await api.get("/api/products", params={"limit": 0})).status_code == 422
+
+
+async def test_metrics_require_a_session(db, api, make_client):
+    assert (await make_client().get("/metrics")).status_code == 401
+    res = await api.get("/metrics")
+    assert res.status_code == 200
+    assert "http_request_duration_seconds" in res.text
+
+
+async def test_metrics_use_the_health_token_when_set(db, api, make_client, monkeypatch):
+    monkeypatch.setattr(server, "HEALTH_TOKEN", "secret-token")
+    assert (await api.get("/metrics")).status_code == 403
+    assert (await make_client(headers={"X-Health-Token": "secret-token"}).get("/metrics")).status_code == 200
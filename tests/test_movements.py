@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def move(api, product, quantity, type="saida", color="preto", **headers):
+    return await api.post("/api/movements", headers=headers, json={
+        "product_id": product["product_id"], "type": type, "quantity": quantity, "color": color
+    })
+
+
+async def stored(db, product):
+    return await db.products.find_one({"product_id": product["product_id"]}, {"_id": 0})
+
+
+async def test_sale_updates_color_and_total_in_one_write(db, api, create_product):
+    product = await create_product(colors=[{"color": "preto", "quantity": 20}, {"color": "azul", "quantity": 5}])
+    res = await move(api, product, 3)
+    assert res.status_code == 200
+    movement = res.json()
+    assert (movement["unit_cost"], movement["unit_price"]) == (None, 25)
+    doc = await stored(db, product)
+    assert doc["colors"] == [{"color": "preto", "quantity": 17}, {"color": "azul", "quantity": 5}]
+    assert (doc["current_stock"], doc.get("pending_movements")) == (22, [])
+    assert await db.stock_movements.count_documents({"movement_id": movement["movement_id"]}) == 1
+
+    assert (await move(api, product, 4, type="entrada", color="azul")).status_code == 200
+    assert (await stored(db, product))["current_stock"] == 26
+
+
+async def test_concurrent_sales_do_not_lose_updates(db, api, create_product):
+    product = await create_product()
+    results = await asyncio.gather(*[move(api, product, 2) for _ in range(5)])
+    assert [r.status_code for r in results] == [200] * 5
+    doc = await stored(db, product)
+    assert (doc["current_stock"], doc["colors"][0]["quantity"]) == (10, 10)
+    assert await db.stock_movements.count_documents({"product_id": product["product_id"]}) == 5
+
+
+async def test_oversell_is_rejected_without_writing(db, api, create_product):
+    product = await create_product()
+    res = await move(api, product, 21)
+    assert (res.status_code, res.json()["detail"]) == (400, "Insufficient stock for this color")
+    res = await move(api, product, 1, color="verde")
+    assert (res.status_code, res.json()["detail"]) == (400, "Color 'verde' not found in product")
+    res = await move(api, {"product_id": "prod_inexistente"}, 1)
+    assert res.status_code == 404
+    assert (await stored(db, product))["current_stock"] == 20
+    assert await db.stock_movements.count_documents({}) == 0
+
+
+async def test_idempotency_key_applies_the_movement_once(db, api, create_product):
+    product = await create_product()
+    first = await move(api, product, 2, **{"Idempotency-Key": "mov_checkout_1"})
+    again = await move(api, product, 2, **{"Idempotency-Key": "mov_checkout_1"})
+    assert first.json()["movement_id"] == again.json()["movement_id"] == "mov_checkout_1"
+    assert (await stored(db, product))["current_stock"] == 18
+
+
+async def checkout(api, *lines):
+    return await api.post("/api/movements/batch", json={"items": [
+        {"product_id": product["product_id"], "type": "saida", "quantity": quantity, "color": color}
+        for product, color, quantity in lines
+    ]})
+
+
+async def test_batch_checkout_applies_the_whole_cart(db, api, create_product):
+    shirt = await create_product(colors=[{"color": "preto", "quantity": 20}, {"color": "azul", "quantity": 5}])
+    trousers = await create_product()
+    res = await checkout(api, (shirt, "preto", 2), (trousers, "preto", 1), (shirt, "azul", 5))
+    assert res.status_code == 200
+    results = res.json()["results"]
+    assert [(r["index"], r["status"]) for r in results] == [(0, "ok"), (1, "ok"), (2, "ok")]
+    assert results[2]["movement"]["unit_price"] == 25
+    assert (await stored(db, shirt))["colors"] == [{"color": "preto", "quantity": 18}, {"color": "azul", "quantity": 0}]
+    assert (await stored(db, shirt))["current_stock"] == 18
+    assert (await stored(db, trousers))["current_stock"] == 19
+    assert await db.stock_movements.count_documents({}) == 3
+    assert await db.products.count_documents({"pending_movements.0": {"$exists": True}}) == 0
+
+
+async def test_batch_is_rejected_as_a_whole(db, api, create_product):
+    product = await create_product()
+    # As linhas do mesmo produto são validadas em conjunto: 15 + 6 excede as 20 unidades
+    res = await checkout(api, (product, "preto", 15), (product, "verde", 1), (product, "preto", 6))
+    assert res.status_code == 400
+    detail = res.json()["detail"]
+    assert detail["message"] == "Batch rejected, no movements were applied"
+    assert [r["error"] for r in detail["results"]] == [
+        None, "Color 'verde' not found in product", "Insufficient stock for this color"
+    ]
+    assert (await stored(db, product))["current_stock"] == 20
+    assert await db.stock_movements.count_documents({}) == 0
@@ -0,0 +1,104 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+URL = "https://rates.test/latest"
+
+
+class Upstream:
+    # Respostas por ordem; "hold" bloqueia o pedido até release.set()
+    def __init__(self, *statuses):
+        self.statuses = list(statuses)
+        self.calls = 0
+        self.release = asyncio.Event()
+
+    async def __call__(self, request):
+        self.calls += 1
+        status = self.statuses.pop(0) if self.statuses else 200
+        if status == "hold":
+            await self.release.wait()
+            status = 200
+        if status == "error":
+            raise httpx.ConnectError("down", request=request)
+        return httpx.Response(status, json={"ok": True})
+
+
+@pytest.fixture
+async def http(monkeypatch):
+    monkeypatch.setattr(server, "HTTP_BACKOFF_SECONDS", 0)
+    outbound = server.OutboundHTTP()
+
+    def connect(upstream):
+        outbound.client = httpx.AsyncClient(transport=httpx.MockTransport(upstream))
+        return upstream
+    outbound.connect = connect
+    yield outbound
+    await outbound.close()
+
+
+def open_circuit(http, elapsed):
+    breaker = http._breaker("rates.test")
+    breaker.failures = breaker.failure_threshold
+    breaker.opened_at = time.monotonic() - elapsed
+    return breaker
+
+
+async def test_retries_transient_failures(http):
+    upstream = http.connect(Upstream(503, "error", 200))
+    res = await http.get(URL)
+    assert res.status_code == 200
+    assert upstream.calls == 3
+    assert http.host_stats["rates.test"]["retries"] == 2
+
+
+async def test_circuit_opens_after_repeated_failures(http):
+    upstream = http.connect(Upstream(*[500] * 20))
+    for _ in range(server.CIRCUIT_FAILURE_THRESHOLD):
+        assert (await http.get(URL, retries=0)).status_code == 500
+    with pytest.raises(server.CircuitOpenError):
+        await http.get(URL)
+    assert upstream.calls == server.CIRCUIT_FAILURE_THRESHOLD
+    assert http.pool_stats()["hosts"]["rates.test"]["circuit"] == "open"
+
+
+async def test_half_open_lets_a_single_probe_through(http):
+    upstream = http.connect(Upstream("hold"))
+    breaker = open_circuit(http, server.CIRCUIT_RESET_SECONDS)
+    probe = asyncio.create_task(http.get(URL))
+    await asyncio.sleep(0.01)
+    assert breaker.probing
+    for _ in range(3):
+        with pytest.raises(server.CircuitOpenError):
+            await http.get(URL)
+    assert http.host_stats["rates.test"]["circuit_rejections"] == 3
+
+    upstream.release.set()
+    assert (await probe).status_code == 200
+    assert (breaker.state, breaker.probing) == ("closed", False)
+    assert (await http.get(URL)).status_code == 200
+    assert upstream.calls == 2
+
+
+async def test_failed_probe_reopens_the_circuit(http):
+    http.connect(Upstream(500))
+    breaker = open_circuit(http, server.CIRCUIT_RESET_SECONDS)
+    assert (await http.get(URL, retries=0)).status_code == 500
+    assert (breaker.state, breaker.probing) == ("open", False)
+
+
+async def test_cancelled_probe_frees_the_slot(http):
+    http.connect(Upstream("hold"))
+    breaker = open_circuit(http, server.CIRCUIT_RESET_SECONDS)
+    probe = asyncio.create_task(http.get(URL))
+    await asyncio.sleep(0.01)
+    probe.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await probe
+    assert breaker.state == "half-open"
+    assert breaker.allow()
@@ -0,0 +1,80 @@
+from datetime import datetime, timezone, timedelta
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+START = datetime(2026, 3, 1, tzinfo=timezone.utc)
+
+
+async def pages(api, url, **params):
+    # Segue os cursores até ao fim e devolve as páginas
+    result = []
+    while True:
+        res = await api.get(url, params=params)
+        assert res.status_code == 200, res.text
+        result.append(res.json())
+        if server.NEXT_CURSOR_HEADER not in res.headers:
+            return result
+        params["cursor"] = res.headers[server.NEXT_CURSOR_HEADER]
+
+
+async def insert_movements(db, user, count, **fields):
+    await db.stock_movements.insert_many([
+        {"movement_id": f"mov_{i:03d}", "user_id": user["user_id"], "product_id": "prod_a", "quantity": 1,
+         "type": "saida" if i % 2 else "entrada", "color": "azul" if i % 3 else "preto",
+         "date": START + timedelta(days=i // 2), **fields}
+        for i in range(count)
+    ])
+
+
+async def test_products_are_paginated_by_keyset(db, api, create_product):
+    created = [await create_product(name=f"Produto {i}") for i in range(5)]
+    # Empates em created_at são desfeitos pelo product_id
+    await db.products.update_many({"product_id": {"$in": [p["product_id"] for p in created[1:4]]}},
+                                  {"$set": {"created_at": START}})
+    res = await api.get("/api/products", params={"limit": 2, "include_total": "true"})
+    assert res.headers[server.TOTAL_COUNT_HEADER] == "5"
+    result = await pages(api, "/api/products", limit=2)
+    assert [len(page) for page in result] == [2, 2, 1]
+    ids = [p["product_id"] for page in result for p in page]
+    assert sorted(ids) == sorted(p["product_id"] for p in created)
+    assert ids[:3] == sorted(p["product_id"] for p in created[1:4])
+
+
+async def test_products_filter_by_color(db, api, create_product):
+    blue = await create_product(colors=[{"color": "azul", "quantity": 1}])
+    await create_product()
+    res = await api.get("/api/products", params={"color": "azul"})
+    assert [p["product_id"] for p in res.json()] == [blue["product_id"]]
+
+
+async def test_movements_are_newest_first_across_pages(db, api, user):
+    await insert_movements(db, user, 9)
+    result = await pages(api, "/api/movements", limit=4)
+    assert [len(page) for page in result] == [4, 4, 1]
+    ids = [m["movement_id"] for page in result for m in page]
+    # Mesma data: desempate por movement_id descendente
+    assert ids == [f"mov_{i:03d}" for i in (8, 7, 6, 5, 4, 3, 2, 1, 0)]
+
+
+async def test_movement_filters(db, api, user):
+    await insert_movements(db, user, 12)
+    await db.stock_movements.insert_one({
+        "movement_id": "mov_outro", "user_id": user["user_id"], "product_id": "prod_b",
+        "quantity": 1, "type": "saida", "date": START
+    })
+    res = await api.get("/api/movements", params={
+        "product_id": "prod_a", "type": "saida", "color": "azul",
+        "date_from": (START + timedelta(days=1)).isoformat(), "date_to": (START + timedelta(days=5)).isoformat(),
+        "include_total": "true"
+    })
+    assert [m["movement_id"] for m in res.json()] == ["mov_007", "mov_005"]
+    assert res.headers[server.TOTAL_COUNT_HEADER] == "2"
+
+
+async def test_invalid_cursor_and_page_size(db, api):
+    assert (await api.get("/api/movements", params={"cursor": "nao-e-um-cursor"})).status_code == 400
+    assert (await api.get("/api/products", params={"limit": server.MAX_PAGE_SIZE + 1})).status_code == 422
@@ -0,0 +1,109 @@
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def product_writes(db, monkeypatch):
+    # Conta as escritas à coleção de produtos feitas pelo pedido
+    writes = []
+    collection_class = type(db.products)
+    for method in ("update_one", "find_one_and_update"):
+        original = getattr(collection_class, method)
+
+        def counted(self, *args, _original=original, _method=method, **kwargs):
+            if self.name == "products":
+                writes.append(_method)
+            return _original(self, *args, **kwargs)
+        monkeypatch.setattr(collection_class, method, counted)
+    return writes
+
+
+async def search(api, q):
+    res = await api.get("/api/products/search", params={"q": q})
+    assert res.status_code == 200
+    return [p["product_id"] for p in res.json()]
+
+
+async def search_keys(db, product):
+    return (await db.products.find_one({"product_id": product["product_id"]}))["search_keys"]
+
+
+async def test_patch_only_changes_the_sent_fields(db, api, create_product):
+    product = await create_product(name="Camisola", sale_price=30)
+    res = await api.patch(f"/api/products/{product['product_id']}", json={"sale_price": 35})
+    assert res.status_code == 200
+    stored = await db.products.find_one({"product_id": product["product_id"]})
+    assert (stored["name"], stored["sale_price"], stored["purchase_price"]) == ("Camisola", 35, 10)
+
+
+async def test_name_only_patch_is_one_write_and_keeps_barcode_keys(db, api, create_product, product_writes):
+    product = await create_product(name="Camisola", barcode="ABC12345")
+    product_writes.clear()
+    res = await api.patch(f"/api/products/{product['product_id']}", json={"name": "Calça"})
+    assert res.status_code == 200
+    assert product_writes == ["find_one_and_update"]
+    assert await search(api, "calc") == [product["product_id"]]
+    assert await search(api, "abc123") == [product["product_id"]]
+    assert "camis" not in await search_keys(db, product)
+
+
+async def test_barcode_only_patch_keeps_name_keys(db, api, create_product, product_writes):
+    product = await create_product(name="Camisola", barcode="ABC12345")
+    product_writes.clear()
+    res = await api.patch(f"/api/products/{product['product_id']}", json={"barcode": "XYZ98765"})
+    assert res.status_code == 200
+    assert product_writes == ["find_one_and_update"]
+    assert await search(api, "xyz987") == [product["product_id"]]
+    assert await search(api, "camis") == [product["product_id"]]
+    assert "abc123" not in await search_keys(db, product)
+
+
+async def test_legacy_products_get_full_search_keys(db, api, create_product):
+    product = await create_product(name="Camisola", barcode="ABC12345")
+    await db.products.update_one(
+        {"product_id": product["product_id"]}, {"$unset": {"name_prefixes": "", "barcode_prefixes": ""}}
+    )
+    res = await api.patch(f"/api/products/{product['product_id']}", json={"name": "Calça"})
+    assert res.status_code == 200
+    stored = await db.products.find_one({"product_id": product["product_id"]})
+    assert stored["search_keys"] == server.product_search_fields("Calça", "ABC12345")["search_keys"]
+
+
+async def test_values_are_stored_literally(db, api, create_product):
+    product = await create_product()
+    res = await api.patch(f"/api/products/{product['product_id']}", json={"name": "$name"})
+    assert res.status_code == 200
+    assert (await db.products.find_one({"product_id": product["product_id"]}))["name"] == "$name"
+
+
+async def test_color_deltas(db, api, create_product):
+    product = await create_product(colors=[
+        {"color": "preto", "quantity": 5}, {"color": "azul", "quantity": 2, "reorder_threshold": 1}
+    ])
+    url = f"/api/products/{product['product_id']}"
+    res = await api.patch(url, json={"color_deltas": [{"color": "preto", "delta": -2}, {"color": "azul", "delta": 3}]})
+    assert res.status_code == 200
+    assert res.json()["current_stock"] == 8
+    stored = await db.products.find_one({"product_id": product["product_id"]})
+    assert stored["colors"] == [
+        {"color": "preto", "quantity": 3}, {"color": "azul", "quantity": 5, "reorder_threshold": 1}
+    ]
+    assert stored["current_stock"] == 8
+
+    res = await api.patch(url, json={"color_deltas": [{"color": "preto", "delta": -4}]})
+    assert res.json()["detail"] == "Insufficient stock for this color"
+    res = await api.patch(url, json={"color_deltas": [{"color": "verde", "delta": 1}]})
+    assert res.json()["detail"] == "Color 'verde' not found in product"
+    res = await api.patch(url, json={"colors": [{"color": "preto"}], "color_deltas": [{"color": "preto", "delta": 1}]})
+    assert res.status_code == 400
+
+
+async def test_duplicate_barcode_is_rejected(db, api, create_product):
+    first = await create_product(barcode="11111111")
+    second = await create_product()
+    res = await api.patch(f"/api/products/{second['product_id']}", json={"barcode": first["barcode"]})
+    assert res.status_code == 400
+    assert (await api.get(f"/api/products/{second['product_id']}")).json()["barcode"] == second["barcode"]
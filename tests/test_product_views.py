@@ -0,0 +1,59 @@
+from datetime import datetime, timezone
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def projections(db, monkeypatch):
+    # Regista a projecção enviada ao MongoDB em cada find de produtos
+    sent = []
+    collection_class = type(db.products)
+    find = collection_class.find
+
+    def recorded(self, *args, **kwargs):
+        if self.name == "products":
+            sent.append(args[1] if len(args) > 1 else kwargs.get("projection"))
+        return find(self, *args, **kwargs)
+    monkeypatch.setattr(collection_class, "find", recorded)
+    return sent
+
+
+async def test_summary_view_is_projected_in_the_database(db, api, create_product, projections):
+    await db.products.insert_one({
+        "product_id": "prod_antigo", "user_id": (await create_product())["user_id"], "name": "Sem moeda",
+        "barcode": "99", "purchase_price": 1, "sale_price": 2, "colors": [{"color": "preto", "quantity": 1}],
+        "image": "/api/images/abc", "created_at": datetime.now(timezone.utc)
+    })
+    res = await api.get("/api/products", params={"view": "summary"})
+    assert res.status_code == 200
+    assert projections[-1] == server.PRODUCT_SUMMARY_PROJECTION
+    products = res.json()
+    assert all(set(p) == set(server.ProductSummary.model_fields) for p in products)
+    # Campos em falta no documento recebem o valor por omissão do modelo
+    assert (products[-1]["currency"], products[-1]["current_stock"]) == ("MZN", 0)
+
+
+async def test_fields_select_the_returned_keys(db, api, create_product, projections):
+    await create_product(name="Camisa", sale_price=30)
+    res = await api.get("/api/products", params={"fields": "name, sale_price"})
+    assert res.json() == [{"product_id": res.json()[0]["product_id"], "name": "Camisa", "sale_price": 30}]
+    assert projections[-1] == {"_id": 0, "product_id": 1, "created_at": 1, "name": 1, "sale_price": 1}
+
+    res = await api.get("/api/products", params={"fields": "name,created_at"})
+    assert set(res.json()[0]) == {"product_id", "name", "created_at"}
+    res = await api.get("/api/products", params={"fields": "name,search_keys"})
+    assert (res.status_code, res.json()["detail"]) == (400, "Unknown product fields: search_keys")
+
+
+async def test_slim_views_keep_the_cursor(db, api, create_product):
+    for _ in range(3):
+        await create_product()
+    res = await api.get("/api/products", params={"view": "summary", "limit": 2})
+    cursor = res.headers[server.NEXT_CURSOR_HEADER]
+    res = await api.get("/api/products", params={"fields": "name", "limit": 2, "cursor": cursor})
+    assert len(res.json()) == 1
+    assert server.NEXT_CURSOR_HEADER not in res.headers
@@ -0,0 +1,91 @@
+import asyncio
+from datetime import datetime, timezone, timedelta
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+TABLES = {"MZN": {"USD": 0.0157, "EUR": 0.0145}}
+
+
+class CountingProvider(server.StaticRateProvider):
+    # Tabelas locais que contam as chamadas e podem falhar ou ficar à espera
+    def __init__(self, tables):
+        super().__init__(tables)
+        self.calls = 0
+        self.failing = False
+        self.release = asyncio.Event()
+        self.release.set()
+
+    async def fetch(self, base):
+        self.calls += 1
+        await self.release.wait()
+        if self.failing:
+            raise server.RatesUnavailable("upstream down")
+        return await super().fetch(base)
+
+
+@pytest.fixture
+def provider(db, monkeypatch):
+    provider = CountingProvider(TABLES)
+    monkeypatch.setattr(server, "rate_service", server.RateService(provider, ttl=3600, refresh_ahead=300))
+    return provider
+
+
+async def convert(api, amount=1000, to_currency="USD"):
+    return await api.post("/api/currency/convert", json={
+        "amount": amount, "from_currency": "MZN", "to_currency": to_currency
+    })
+
+
+async def test_concurrent_misses_share_one_upstream_call(db, api, provider):
+    provider.release.clear()
+    pending = [asyncio.create_task(convert(api)) for _ in range(5)]
+    await asyncio.sleep(0.05)
+    provider.release.set()
+    results = await asyncio.gather(*pending)
+    assert {r.json()["converted_amount"] for r in results} == {15.7}
+    assert provider.calls == 1
+
+    # A mesma tabela serve os dois endpoints, sem nova chamada
+    res = await api.get("/api/currency/rates/mzn")
+    assert res.json()["rates"] == {"MZN": 1, **TABLES["MZN"]}
+    assert (await convert(api, to_currency="EUR")).json()["rate"] == 0.0145
+    assert provider.calls == 1
+
+
+async def test_persisted_table_is_reused_by_a_new_process(db, api, provider, monkeypatch):
+    assert (await convert(api)).status_code == 200
+    assert await db.rates_cache.count_documents({"cache_key": "table_MZN"}) == 1
+    monkeypatch.setattr(server, "rate_service", server.RateService(provider, ttl=3600, refresh_ahead=300))
+    assert (await convert(api)).status_code == 200
+    assert provider.calls == 1
+
+
+async def test_tables_are_refreshed_before_they_expire(db, api, provider):
+    assert (await convert(api)).status_code == 200
+    service = server.rate_service
+    service._tables["MZN"]["expires_at"] = datetime.now(timezone.utc) + timedelta(seconds=60)
+    assert (await convert(api)).status_code == 200
+    await asyncio.gather(*service._inflight.values())
+    assert provider.calls == 2
+    assert service._is_fresh(service._tables["MZN"], service.refresh_ahead)
+
+
+async def test_upstream_failures_fall_back_to_stale_rates(db, api, provider):
+    provider.failing = True
+    res = await convert(api)
+    assert (res.status_code, res.json()["detail"]) == (503, "Exchange rate service temporarily unavailable")
+
+    provider.failing = False
+    assert (await convert(api)).status_code == 200
+    server.rate_service._tables["MZN"]["expires_at"] = datetime.now(timezone.utc) - timedelta(seconds=1)
+    provider.failing = True
+    assert (await convert(api)).json()["rate"] == 0.0157
+
+
+async def test_unknown_currency_is_rejected(db, api, provider):
+    res = await convert(api, to_currency="XYZ")
+    assert (res.status_code, res.json()["detail"]) == (400, "Currency not supported")
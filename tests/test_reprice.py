@@ -0,0 +1,91 @@
+import csv
+import io
+import json
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def reprice(api, **rule):
+    return await api.post("/api/products/reprice", json=rule)
+
+
+async def prices(db):
+    return {p["barcode"]: (p["purchase_price"], p["sale_price"], p.get("currency", "MZN"))
+            async for p in db.products.find({}, {"_id": 0})}
+
+
+async def assert_rollup_consistent(user_id):
+    check = await server.check_rollup(user_id)
+    assert check["consistent"], check["differences"]
+
+
+async def test_dry_run_streams_the_diff_without_writing(db, api, create_product):
+    await create_product(barcode="P100", purchase_price=10, sale_price=25)
+    # Já ao preço pedido: não aparece na pré-visualização
+    await create_product(barcode="P200", purchase_price=20, sale_price=40)
+    before = await prices(db)
+    res = await reprice(api, mode="markup", value=100)
+    assert res.status_code == 200
+    [diff] = [json.loads(line) for line in res.text.splitlines()]
+    assert (diff["barcode"], diff["sale_price"], diff["new_sale_price"]) == ("P100", 25, 20)
+
+    res = await reprice(api, mode="markup", value=100, format="csv")
+    rows = list(csv.DictReader(io.StringIO(res.text)))
+    assert [(r["barcode"], r["new_sale_price"]) for r in rows] == [("P100", "20.0")]
+    assert await prices(db) == before
+
+
+async def test_rule_is_applied_to_the_filtered_products(db, api, user, create_product):
+    await create_product(barcode="CAM-1", name="Camisa Azul", purchase_price=12.3, sale_price=30)
+    await create_product(barcode="CAM-2", name="Camisa Preta", purchase_price=7, sale_price=30, colors=[])
+    await create_product(barcode="CAL-1", name="Calça Azul", purchase_price=12.3, sale_price=30)
+    res = await reprice(api, mode="margin", value=40, round_to=5, round_mode="up", dry_run=False,
+                        filters={"barcode_prefix": "CAM", "name": "camisa", "min_stock": 1})
+    assert res.json() == {"updated": 1, "conflicts": 0}
+    # 12,3 / 0,6 = 20,5 -> múltiplo de 5 acima
+    after = await prices(db)
+    assert (after["CAM-1"], after["CAM-2"], after["CAL-1"]) == ((12.3, 25, "MZN"), (7, 30, "MZN"), (12.3, 30, "MZN"))
+    await assert_rollup_consistent(user["user_id"])
+
+
+async def test_prices_are_converted_to_the_target_currency(db, api, user, create_product, monkeypatch):
+    monkeypatch.setattr(server, "rate_service", server.RateService(
+        server.StaticRateProvider({"MZN": {"USD": 0.016}, "USD": {"MZN": 62.5}}), ttl=3600, refresh_ahead=300
+    ))
+    await create_product(barcode="USD-1", purchase_price=1000)
+    res = await reprice(api, mode="markup", value=50, round_to=0.5, target_currency="usd", dry_run=False)
+    assert res.json()["updated"] == 1
+    assert (await prices(db))["USD-1"] == (16, 24, "USD")
+    res = await reprice(api, mode="markup", value=50, target_currency="EUR")
+    assert (res.status_code, res.json()["detail"]) == (400, "No exchange rate from USD to EUR")
+    await assert_rollup_consistent(user["user_id"])
+
+
+async def test_concurrent_edits_win_and_are_reported(db, api, user, create_product, monkeypatch):
+    edited = await create_product(barcode="E1")
+    await create_product(barcode="E2")
+    iter_reprice_diffs = server.iter_reprice_diffs
+
+    async def racing_diffs(*args):
+        async for diff in iter_reprice_diffs(*args):
+            if diff["product_id"] == edited["product_id"]:
+                # Outro terminal muda o preço entre a leitura e a escrita
+                await db.products.update_one({"product_id": diff["product_id"]}, {"$set": {"sale_price": 99}})
+            yield diff
+
+    monkeypatch.setattr(server, "iter_reprice_diffs", racing_diffs)
+    res = await reprice(api, mode="markup", value=10, dry_run=False)
+    assert res.json() == {"updated": 1, "conflicts": 1}
+    after = await prices(db)
+    assert (after["E1"][1], after["E2"][1]) == (99, 11)
+    await assert_rollup_consistent(user["user_id"])
+
+
+async def test_invalid_rules_are_rejected(db, api):
+    res = await reprice(api, mode="margin", value=100)
+    assert (res.status_code, res.json()["detail"]) == (400, "Margin must be below 100%")
+    assert (await reprice(api, mode="desconto", value=10)).status_code == 422
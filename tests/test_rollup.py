@@ -0,0 +1,83 @@
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def rollup(db, user_id):
+    return await db.report_rollups.find_one({"user_id": user_id}, {"_id": 0})
+
+
+async def test_check_rollup_treats_missing_totals_as_zero(db, user):
+    # Documento criado pelo upsert de update_rollup, sem totais de movimentos
+    await server.update_rollup(user["user_id"], {})
+    assert await server.check_rollup(user["user_id"]) == {
+        "user_id": user["user_id"], "consistent": True, "differences": {}
+    }
+
+
+async def test_rebuild_keeps_increments_made_while_computing(db, api, user, create_product, monkeypatch):
+    await create_product()
+    compute_rollup = server.compute_rollup
+    calls = []
+
+    async def racing_compute(user_id):
+        calls.append(user_id)
+        result = await compute_rollup(user_id)
+        if len(calls) == 1:
+            # Uma venda termina depois do cálculo e antes da gravação
+            await db.stock_movements.insert_one({"user_id": user_id, "type": "saida", "quantity": 1})
+            await server.update_rollup(user_id, {"total_exits": 1})
+        return result
+
+    monkeypatch.setattr(server, "compute_rollup", racing_compute)
+    rebuilt = await server.rebuild_rollup(user["user_id"])
+    assert len(calls) == 2
+    assert rebuilt["total_exits"] == 1
+    stored = await rollup(db, user["user_id"])
+    assert stored["total_exits"] == 1
+    assert stored["version"] == rebuilt["version"]
+
+
+async def test_rebuild_is_not_stored_when_it_keeps_racing(db, user, monkeypatch):
+    await server.update_rollup(user["user_id"], {})
+    monkeypatch.setattr(server, "ROLLUP_REBUILD_ATTEMPTS", 2)
+    compute_rollup = server.compute_rollup
+
+    async def racing_compute(user_id):
+        result = await compute_rollup(user_id)
+        await server.update_rollup(user_id, {"total_entries": 1})
+        return result
+
+    monkeypatch.setattr(server, "compute_rollup", racing_compute)
+    rebuilt = await server.rebuild_rollup(user["user_id"])
+    stored = await rollup(db, user["user_id"])
+    assert "schema" not in stored
+    assert stored["total_entries"] == 2
+    # A versão devolvida é anterior à gravada: o ETag não fica associado a este valor
+    assert rebuilt["version"] < stored["version"]
+
+
+async def test_recovered_movements_reach_the_rollup(db, api, user, create_product):
+    product = await create_product()
+    before = await rollup(db, user["user_id"])
+    # Processo caído depois da escrita do produto: o movimento ficou no outbox
+    movement = server.build_movement_doc(
+        server.MovementCreate(product_id=product["product_id"], type="saida", quantity=3, color="preto"),
+        user["user_id"]
+    )
+    await db.products.update_one(
+        {"product_id": product["product_id"]},
+        {"$inc": {"current_stock": -3, "colors.0.quantity": -3}, "$push": {"pending_movements": movement}}
+    )
+    await server.flush_pending_movements()
+    after = await rollup(db, user["user_id"])
+    assert after["total_exits"] == 1
+    assert after["total_stock_value"] == before["total_stock_value"] - 30
+    assert after["version"] > before["version"]
+    assert await db.stock_movements.count_documents({"movement_id": movement["movement_id"]}) == 1
+    assert (await server.check_rollup(user["user_id"]))["consistent"]
+    # Uma segunda recuperação não volta a contar o movimento
+    await server.flush_pending_movements()
+    assert (await rollup(db, user["user_id"]))["total_exits"] == 1
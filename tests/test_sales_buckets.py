@@ -0,0 +1,54 @@
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def buckets(db, user_id):
+    docs = await db.sales_buckets.find({"user_id": user_id}, {"_id": 0, "hour": 0}).to_list(None)
+    return sorted(docs, key=lambda d: (d["product_id"], d["color"] or ""))
+
+
+async def test_sales_write_hourly_buckets(db, api, user, create_product):
+    product = await create_product()
+    res = await api.post("/api/movements", json={
+        "product_id": product["product_id"], "type": "saida", "quantity": 2, "color": "preto"
+    })
+    assert res.status_code == 200
+    res = await api.post("/api/movements/batch", json={"items": [
+        {"product_id": product["product_id"], "type": "saida", "quantity": 1, "color": "preto"},
+        {"product_id": product["product_id"], "type": "entrada", "quantity": 5, "color": "preto"},
+    ]})
+    assert res.status_code == 200
+    assert await buckets(db, user["user_id"]) == [{
+        "user_id": user["user_id"], "product_id": product["product_id"], "color": "preto",
+        "units_in": 5, "units_out": 3, "revenue": 75.0, "cost": 30.0, "movements": 3
+    }]
+
+
+async def test_recovered_movements_write_buckets(db, api, user, create_product):
+    product = await create_product()
+    movement = server.build_movement_doc(
+        server.MovementCreate(product_id=product["product_id"], type="saida", quantity=4, color="preto"),
+        user["user_id"]
+    )
+    await db.products.update_one(
+        {"product_id": product["product_id"]},
+        {"$inc": {"current_stock": -4, "colors.0.quantity": -4}, "$push": {"pending_movements": movement}}
+    )
+    await server.flush_pending_movements()
+    [bucket] = await buckets(db, user["user_id"])
+    assert (bucket["units_out"], bucket["revenue"], bucket["movements"]) == (4, 100.0, 1)
+
+
+async def test_backfill_rebuilds_the_live_buckets(db, api, user, create_product):
+    product = await create_product()
+    for type_, quantity in (("saida", 3), ("entrada", 2), ("saida", 1)):
+        res = await api.post("/api/movements", json={
+            "product_id": product["product_id"], "type": type_, "quantity": quantity, "color": "preto"
+        })
+        assert res.status_code == 200
+    live = await buckets(db, user["user_id"])
+    assert await server.backfill_sales_buckets(user["user_id"]) == 3
+    assert await buckets(db, user["user_id"]) == live
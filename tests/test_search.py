@@ -0,0 +1,61 @@
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def search(client, q, **params):
+    res = await client.get("/api/products/search", params={"q": q, **params})
+    assert res.status_code == 200, res.text
+    return res
+
+
+def names(res):
+    return [p["name"] for p in res.json()]
+
+
+async def test_prefixes_ignore_accents_and_case(db, api, create_product):
+    await create_product(name="Calça Jeans")
+    await create_product(name="Camisa Azul")
+    await create_product(name="Camisola Azul-Marinho")
+    res = await search(api, "CALÇ")
+    assert (names(res), res.headers["X-Search-Mode"]) == (["Calça Jeans"], "prefix")
+    # Todos os termos têm de corresponder; resultados ordenados pelo nome normalizado
+    assert names(await search(api, "azu cami")) == ["Camisa Azul", "Camisola Azul-Marinho"]
+    assert names(await search(api, "marinho")) == ["Camisola Azul-Marinho"]
+
+
+async def test_results_are_slim_and_scoped_to_the_user(db, api, make_user, make_client, create_product):
+    await create_product(name="Sapato", barcode="ABC-12345")
+    await create_product(make_client((await make_user())["session_token"]), name="Sapatilha")
+    res = await search(api, "sapat")
+    assert names(res) == ["Sapato"]
+    assert set(res.json()[0]) == set(server.ProductSummary.model_fields) | {"thumbnail"}
+    # Códigos de barras: prefixos a partir de 3 caracteres, por segmento
+    assert names(await search(api, "abc")) == names(await search(api, "1234")) == ["Sapato"]
+
+
+async def test_long_words_match_past_the_stored_prefix_length(db, api, create_product):
+    await create_product(name="Casaco Impermeabilizado")
+    assert names(await search(api, "impermeabilizad")) == ["Casaco Impermeabilizado"]
+
+
+async def test_results_are_paginated(db, api, create_product):
+    for name in ("Meia A", "Meia B", "Meia C"):
+        await create_product(name=name)
+    res = await search(api, "meia", limit=2)
+    assert names(res) == ["Meia A", "Meia B"]
+    res = await search(api, "meia", limit=2, cursor=res.headers[server.NEXT_CURSOR_HEADER])
+    assert names(res) == ["Meia C"]
+    assert server.NEXT_CURSOR_HEADER not in res.headers
+    res = await api.get("/api/products/search", params={"q": "meia", "cursor": "bad"})
+    assert res.status_code == 400
+
+
+def test_search_keys():
+    fields = server.product_search_fields("Pão-de-Ló", "AB-1234")
+    assert fields["name_key"] == "pao de lo"
+    assert fields["name_prefixes"] == ["d", "de", "l", "lo", "p", "pa", "pao"]
+    assert fields["barcode_prefixes"] == ["123", "1234", "ab"]
+    assert fields["search_keys"] == sorted(set(fields["name_prefixes"]) | set(fields["barcode_prefixes"]))
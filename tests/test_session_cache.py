@@ -0,0 +1,73 @@
+from datetime import datetime, timezone, timedelta
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def me(client):
+    return await client.get("/api/auth/me")
+
+
+async def test_repeated_requests_are_served_from_the_cache(db, api, user):
+    assert (await me(api)).status_code == 200
+    # Com a sessão em cache, a base já não é consultada
+    await db.user_sessions.delete_many({})
+    assert (await me(api)).json()["user_id"] == user["user_id"]
+    stats = server.session_cache.stats()
+    assert (stats["hits"], stats["misses"], stats["size"]) == (1, 1, 1)
+
+
+async def test_logout_revokes_the_cached_session(db, api, user, monkeypatch):
+    monkeypatch.setattr(server, "SESSION_INVALIDATION_CHANNEL", "mongo")
+    assert (await me(api)).status_code == 200
+    assert (await api.post("/api/auth/logout")).status_code == 200
+    assert (await me(api)).status_code == 401
+    assert server.session_cache.stats()["invalidations"] == 1
+    # Os outros workers recebem o logout pela coleção de invalidações
+    assert await db.session_invalidations.count_documents({"session_token": user["session_token"]}) == 1
+
+
+async def test_entries_expire_after_the_ttl(db, api, monkeypatch):
+    monkeypatch.setattr(server.session_cache, "ttl", 0)
+    assert (await me(api)).status_code == 200
+    await db.user_sessions.delete_many({})
+    assert (await me(api)).status_code == 401
+
+
+async def test_ttl_never_outlives_the_session(db, api, user):
+    assert (await me(api)).status_code == 200
+    expires_at = datetime.now(timezone.utc) + timedelta(seconds=1)
+    user_doc = server.User(**await db.users.find_one({"user_id": user["user_id"]}, {"_id": 0}))
+    server.session_cache.put("short", user_doc, expires_at)
+    _, deadline = server.session_cache._entries["short"]
+    _, long_deadline = server.session_cache._entries[user["session_token"]]
+    assert deadline < long_deadline
+    server.session_cache.put("expired", user_doc, expires_at - timedelta(seconds=5))
+    assert server.session_cache.get("expired") is None
+
+
+async def test_least_recently_used_sessions_are_evicted(db, make_user, make_client, monkeypatch):
+    monkeypatch.setattr(server.session_cache, "maxsize", 2)
+    clients = [make_client((await make_user())["session_token"]) for _ in range(3)]
+    for client in clients:
+        assert (await me(client)).status_code == 200
+    stats = server.session_cache.stats()
+    assert (stats["size"], stats["evictions"]) == (2, 1)
+
+
+async def test_expired_sessions_are_rejected(db, user, make_client):
+    await db.user_sessions.update_one(
+        {"session_token": user["session_token"]},
+        {"$set": {"expires_at": datetime.now(timezone.utc) - timedelta(minutes=1)}}
+    )
+    assert (await me(make_client(user["session_token"]))).status_code == 401
+    assert server.session_cache.stats()["size"] == 0
+
+
+async def test_session_cookie_is_accepted(db, user, make_client):
+    client = make_client()
+    client.cookies.set("session_token", user["session_token"])
+    assert (await me(client)).json()["user_id"] == user["user_id"]
@@ -0,0 +1,81 @@
+import json
+
+import pytest
+from starlette.requests import Request
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+def drain(queue):
+    events = []
+    while not queue.empty():
+        events.append(queue.get_nowait())
+    return events
+
+
+async def test_writes_are_pushed_to_the_owner_only(db, api, user, make_user, create_product):
+    queue = server.change_bus.subscribe(user["user_id"])
+    other = server.change_bus.subscribe((await make_user())["user_id"])
+    product = await create_product(colors=[{"color": "preto", "quantity": 5}])
+    res = await api.post("/api/movements", json={
+        "product_id": product["product_id"], "type": "saida", "quantity": 2, "color": "preto"
+    })
+    assert res.status_code == 200
+    assert (await api.patch(f"/api/products/{product['product_id']}", json={"name": "Novo nome"})).status_code == 200
+    assert (await api.delete(f"/api/products/{product['product_id']}")).status_code == 200
+
+    events = drain(queue)
+    assert [e["type"] for e in events] == ["product", "stock", "movement", "product", "product_deleted"]
+    assert (events[1]["current_stock"], events[1]["colors"]) == (3, [{"color": "preto", "quantity": 3}])
+    assert events[2]["movement"]["movement_id"] == res.json()["movement_id"]
+    assert events[3]["product"]["name"] == "Novo nome"
+    # As versões seguem o ETag: cada escrita avança
+    versions = [e["version"] for e in events]
+    assert versions == sorted(versions) and versions[0] < versions[-1]
+    assert drain(other) == []
+
+
+async def test_slow_clients_are_asked_to_resync(db, user):
+    bus = server.ChangeBus(queue_size=2)
+    queue = bus.subscribe(user["user_id"])
+    for i in range(3):
+        bus.publish(user["user_id"], {"type": "stock", "version": i})
+    assert drain(queue) == [{"type": "resync"}]
+    assert bus.stats()["overflows"] == 1
+
+
+async def test_change_stream_events_are_routed_by_owner(db, user, monkeypatch):
+    monkeypatch.setattr(server, "STREAM_SOURCE", "changestream")
+    bus = server.ChangeBus(queue_size=10)
+    queue = bus.subscribe(user["user_id"])
+    # Com change stream, a publicação local é ignorada para não duplicar eventos
+    bus.publish(user["user_id"], {"type": "resync"})
+    doc = {"_id": "oid1", "user_id": user["user_id"], "product_id": "prod_a", "name": "A", "search_keys": ["a"]}
+    bus._apply_change({"ns": {"coll": "products"}, "operationType": "insert", "fullDocument": doc})
+    bus._apply_change({"ns": {"coll": "products"}, "operationType": "delete", "documentKey": {"_id": "oid1"}})
+    events = drain(queue)
+    assert events[0] == {"type": "product", "version": None, "product": {"product_id": "prod_a", "name": "A"}}
+    assert events[1] == {"type": "product_deleted", "product_id": "prod_a"}
+
+
+async def test_sse_endpoint_formats_events_and_unsubscribes(db, user):
+    request = Request({
+        "type": "http", "method": "GET", "path": "/api/stream", "query_string": b"",
+        "headers": [(b"authorization", f"Bearer {user['session_token']}".encode())]
+    })
+    response = await server.stream_changes(request)
+    assert response.media_type == "text/event-stream"
+    body = response.body_iterator
+    assert await body.__anext__() == "retry: 3000\n\n"
+
+    server.change_bus.publish(user["user_id"], {"type": "stock", "version": 7, "product_id": "prod_a"})
+    chunk = await body.__anext__()
+    head, data = chunk.rstrip("\n").rsplit("\n", 1)
+    assert head == "event: stock\nid: 7"
+    assert json.loads(data.removeprefix("data: ")) == {"type": "stock", "version": 7, "product_id": "prod_a"}
+    assert server.change_bus.stats()["connections"] == 1
+
+    await body.aclose()
+    assert server.change_bus.stats()["connections"] == 0
@@ -0,0 +1,62 @@
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def summary(api):
+    res = await api.get("/api/reports/summary")
+    assert res.status_code == 200
+    return res.json()
+
+
+@pytest.fixture
+def reads(db, monkeypatch):
+    # Regista as leituras por coleção feitas pelo pedido
+    calls = []
+    collection_class = type(db.products)
+    for method in ("find", "find_one", "aggregate"):
+        original = getattr(collection_class, method)
+
+        def counted(self, *args, _original=original, _method=method, **kwargs):
+            calls.append((self.name, _method))
+            return _original(self, *args, **kwargs)
+        monkeypatch.setattr(collection_class, method, counted)
+    return calls
+
+
+async def test_totals_are_aggregated_in_the_database(db, api, user, reads):
+    await db.products.insert_many([
+        {"product_id": f"prod_{i}", "user_id": user["user_id"], "name": f"Produto {i}", "barcode": f"B{i}",
+         "purchase_price": 2, "sale_price": 5, "current_stock": 50, "colors": []}
+        for i in range(40)
+    ])
+    await db.stock_movements.insert_many([
+        {"movement_id": f"mov_{i}", "user_id": user["user_id"], "product_id": "prod_0",
+         "type": "saida" if i % 4 else "entrada", "quantity": 1}
+        for i in range(120)
+    ])
+    body = await summary(api)
+    assert (body["products_count"], body["total_stock_value"], body["total_potential_revenue"]) == (40, 4000, 10000)
+    assert (body["total_entries"], body["total_exits"]) == (30, 90)
+    assert (body["low_stock_count"], body["low_stock_products"]) == (0, [])
+    # Os movimentos só são contados por $group, nunca carregados
+    assert ("stock_movements", "find") not in reads
+
+    reads.clear()
+    assert (await summary(api))["total_exits"] == 90
+    assert {name for name, _ in reads} <= {"user_sessions", "users", "report_rollups", "products"}
+
+
+async def test_summary_follows_writes(db, api, create_product):
+    products = [await create_product(colors=[{"color": "preto", "quantity": q}]) for q in (2, 3, 4, 5, 6, 7, 40)]
+    body = await summary(api)
+    assert (body["products_count"], body["total_stock_value"]) == (7, 670)
+    assert body["low_stock_count"] == 6
+    assert [p["current_stock"] for p in body["low_stock_products"]] == [2, 3, 4, 5, 6]
+
+    res = await api.post("/api/movements", json={
+        "product_id": products[-1]["product_id"], "type": "saida", "quantity": 10, "color": "preto"
+    })
+    assert res.status_code == 200
+    body = await summary(api)
+    assert (body["total_stock_value"], body["total_potential_revenue"], body["total_exits"]) == (570, 1425, 1)
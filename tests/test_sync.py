@@ -0,0 +1,108 @@
+import base64
+import json
+import uuid
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def insert_legacy_products(db, user_id, count):
+    # Produtos anteriores à sincronização: sem change_seq
+    await db.products.insert_many([{
+        "product_id": f"prod_legacy{i:04d}", "user_id": user_id, "name": f"Antigo {i}", "barcode": f"legacy{i:04d}",
+        "purchase_price": 1, "sale_price": 2, "current_stock": 0, "colors": []
+    } for i in range(count)])
+
+
+async def pull_all(api, since=None, limit=3):
+    pages = []
+    while True:
+        params = {"limit": limit, **({"since": since} if since else {})}
+        res = await api.get("/api/sync", params=params)
+        assert res.status_code == 200, res.text
+        page = res.json()
+        pages.append(page)
+        since = page["next"]
+        if not page["has_more"]:
+            return pages
+
+
+async def test_full_sync_pages_through_docs_sharing_a_sequence(db, api, user):
+    await insert_legacy_products(db, user["user_id"], 10)
+    assert await server.backfill_sync_sequences() == 10
+    pages = await pull_all(api)
+    assert len(pages) == 4
+    assert all(len(p["products"]) + len(p["movements"]) <= 3 for p in pages)
+    product_ids = [p["product_id"] for page in pages for p in page["products"]]
+    assert sorted(product_ids) == [f"prod_legacy{i:04d}" for i in range(10)]
+    assert pages[0]["reset"] and not any(p["reset"] for p in pages[1:])
+
+
+async def test_page_never_exceeds_the_limit_across_collections(db, api, create_product):
+    for _ in range(3):
+        product = await create_product()
+        res = await api.post("/api/movements", json={
+            "product_id": product["product_id"], "type": "entrada", "quantity": 1, "color": "preto"
+        })
+        assert res.status_code == 200
+    pages = await pull_all(api, limit=4)
+    assert [len(p["products"]) + len(p["movements"]) for p in pages] == [4, 2]
+    assert sum(len(p["products"]) for p in pages) == 3
+    assert sum(len(p["movements"]) for p in pages) == 3
+    assert "_id" not in pages[0]["products"][0]
+
+
+async def test_pull_does_not_write_legacy_sequences(db, api, user):
+    await insert_legacy_products(db, user["user_id"], 2)
+    res = await api.get("/api/sync")
+    assert res.json()["products"] == []
+    assert await db.products.count_documents({"change_seq": {"$exists": False}}) == 2
+    assert await server.backfill_sync_sequences(user["user_id"]) == 2
+    assert len((await api.get("/api/sync")).json()["products"]) == 2
+
+
+async def test_continuation_token_skips_the_tombstone_age_check(db, api, user, create_product):
+    await create_product()
+    product_id = (await db.products.find_one({}))["_id"]
+    token = server.encode_sync_token(0, exact=True, last_id=product_id)
+    res = await api.get("/api/sync", params={"since": token})
+    assert res.json()["reset"] is False
+    # Sem posição exacta, uma sequência tão antiga obriga a recomeçar
+    res = await api.get("/api/sync", params={"since": server.encode_sync_token(0, exact=False)})
+    assert res.json()["reset"] is True
+
+
+async def test_delta_pull_returns_changes_and_deletions(db, api, create_product):
+    kept = await create_product()
+    removed = await create_product()
+    since = (await api.get("/api/sync")).json()["next"]
+    assert (await api.delete(f"/api/products/{removed['product_id']}")).status_code == 200
+    res = await api.patch(f"/api/products/{kept['product_id']}", json={"name": "Renomeado"})
+    assert res.status_code == 200
+    page = (await api.get("/api/sync", params={"since": since})).json()
+    assert [p["name"] for p in page["products"]] == ["Renomeado"]
+    assert page["deleted_product_ids"] == [removed["product_id"]]
+
+
+async def test_push_replays_are_idempotent(db, api, create_product):
+    product = await create_product()
+    movement = {
+        "movement_id": f"dev-{uuid.uuid4().hex[:12]}", "product_id": product["product_id"],
+        "type": "saida", "quantity": 2, "color": "preto"
+    }
+    first = (await api.post("/api/sync", json={"movements": [movement]})).json()
+    second = (await api.post("/api/sync", json={"movements": [movement]})).json()
+    assert first["results"][0]["status"] == "applied"
+    assert second["results"][0]["status"] == "duplicate"
+    assert await db.stock_movements.count_documents({"movement_id": movement["movement_id"]}) == 1
+    stock = (await db.products.find_one({"product_id": product["product_id"]}))["current_stock"]
+    assert stock == 18
+
+
+async def test_invalid_token_is_rejected(db, api):
+    assert (await api.get("/api/sync", params={"since": "not-a-token"})).status_code == 400
+    bad_id = base64.urlsafe_b64encode(json.dumps({"s": 1, "x": 1, "i": "zz"}).encode()).decode()
+    assert (await api.get("/api/sync", params={"since": bad_id})).status_code == 400
@@ -0,0 +1,89 @@
+from datetime import datetime, timezone
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+JAN = datetime(2026, 1, 10, tzinfo=timezone.utc)
+FEB = datetime(2026, 2, 10, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+async def history(db, user):
+    # 10 unidades a 10 e 10 a 20 em janeiro; 15 vendidas a 30 em fevereiro
+    await db.products.insert_one({
+        "product_id": "prod_v", "user_id": user["user_id"], "name": "Casaco", "barcode": "V1",
+        "purchase_price": 20, "sale_price": 30, "current_stock": 5, "colors": []
+    })
+    movements = [("entrada", 10, JAN, {"unit_cost": 10}), ("entrada", 10, JAN.replace(day=20), {"unit_cost": 20}),
+                 ("saida", 15, FEB, {"unit_price": 30})]
+    await db.stock_movements.insert_many([
+        {"movement_id": f"mov_v{i}", "user_id": user["user_id"], "product_id": "prod_v",
+         "type": type, "quantity": quantity, "date": date, **prices}
+        for i, (type, quantity, date, prices) in enumerate(movements)
+    ])
+
+
+async def valuation(api, **params):
+    res = await api.get("/api/reports/valuation", params=params)
+    assert res.status_code == 200, res.text
+    return res.json()
+
+
+def figures(report, *fields):
+    [item] = report["products"]
+    return tuple(item[f] for f in fields)
+
+
+async def test_average_and_fifo_cost_of_goods(db, api, history):
+    fields = ("units_sold", "revenue", "cogs", "gross_margin", "closing_quantity", "closing_value", "stock_value")
+    assert figures(await valuation(api), *fields) == (15, 450, 225, 225, 5, 75, 75)
+    report = await valuation(api, method="fifo")
+    assert figures(report, *fields) == (15, 450, 200, 250, 5, 100, 100)
+    assert report["totals"]["MZN"]["gross_margin"] == 250
+
+
+async def test_period_report_starts_from_the_opening_state(db, api, history):
+    report = await valuation(api, method="fifo", date_from="2026-02-01T00:00:00Z", date_to="2026-03-01T00:00:00Z")
+    assert figures(report, "units_received", "units_sold", "purchases", "cogs") == (0, 15, 0, 200)
+    assert "stock_value" not in report["products"][0]
+    report = await valuation(api, date_to="2026-02-01T00:00:00Z")
+    assert figures(report, "units_received", "purchases", "closing_value") == (20, 300, 300)
+
+
+async def test_checkpoints_make_revaluation_incremental(db, api, user, history):
+    first = await valuation(api)
+    assert await db.valuation_checkpoints.count_documents({"user_id": user["user_id"], "method": "average"}) > 0
+    # Com os checkpoints gravados, os movimentos de janeiro já não são relidos
+    await db.stock_movements.delete_many({"date": {"$lt": FEB}})
+    assert (await valuation(api))["products"] == first["products"]
+
+
+async def test_backdated_movements_invalidate_later_checkpoints(db, api, user, history):
+    await valuation(api)
+    res = await api.post("/api/sync", json={"movements": [
+        {"movement_id": "mov_offline_1", "product_id": "prod_v", "type": "entrada", "quantity": 10,
+         "unit_cost": 40, "date": "2026-01-25T12:00:00Z"}
+    ]})
+    assert res.json()["results"][0]["status"] == "applied"
+    assert await db.valuation_checkpoints.count_documents({"at": {"$gt": datetime(2026, 1, 25)}}) == 0
+    # Média: (100 + 200 + 400) / 30 = 23,33 por unidade vendida
+    assert figures(await valuation(api), "cogs", "closing_quantity") == (350, 15)
+
+
+async def test_invalid_ranges_and_unknown_products(db, api, history):
+    res = await api.get("/api/reports/valuation", params={"date_from": "2026-03-01", "date_to": "2026-02-01"})
+    assert res.status_code == 400
+    res = await api.get("/api/reports/valuation", params={"product_id": "prod_inexistente"})
+    assert res.status_code == 404
+
+
+def test_fifo_matches_a_sequential_replay():
+    state = server.new_valuation_state("fifo")
+    rows = [{"type": "entrada", "quantity": 3, "unit_cost": 1}, {"type": "saida", "quantity": 5},
+            {"type": "entrada", "quantity": 4, "unit_cost": 2}, {"type": "saida", "quantity": 1}]
+    server.advance_valuation(state, "fifo", rows, {"purchase_price": 9, "sale_price": 10})
+    # A saída de 5 só tem 3 em stock: 2 unidades ao preço de compra; a seguinte consome a entrada a 2
+    assert (state["cogs"], state["layers"], state["quantity"]) == (3 + 18 + 2, [[3, 2.0]], 3)